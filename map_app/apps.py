@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MapAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'map_app'
+
+    def ready(self):
+        # keep the data-version stamp current when the models are edited
+        from . import signals  # noqa: F401
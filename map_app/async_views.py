@@ -0,0 +1,143 @@
+# Async variants of the map, download, export and tile views, for serving under ASGI.
+#
+# Under ASGI Django runs every sync view on one shared thread, so a slow tile cut or a long
+# export stalls every other request, down to /instructions/. The views here run the sync views
+# on a bounded thread pool instead (FIREFLIGHT_VIEW_WORKERS threads, 4 by default), so the event
+# loop keeps serving light pages while they work, and requests past the limit wait for a free
+# thread. A streamed response is iterated by one pool thread, which hands the event loop
+# batches of chunks, so database cursors never change threads mid-export.
+#
+# urls.py routes to these views when FIREFLIGHT_ASYNC_VIEWS is set, which mysite/asgi.py does by
+# default; WSGI deployments keep the sync views. Renders themselves still run on the render
+# queue (render_jobs.py).
+
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import views
+
+# batches of chunks waiting to be sent, per streamed response
+STREAM_BUFFER = 8
+
+# bytes (or characters) of a streamed response collected into one batch
+STREAM_BATCH = 64 * 1024
+
+# marks the end of a streamed response
+_END = object()
+
+
+# True when urls.py should route to the async views
+def enabled():
+    value = getattr(settings, 'FIREFLIGHT_ASYNC_VIEWS', None)
+    if value is None:
+        value = os.environ.get('FIREFLIGHT_ASYNC_VIEWS', '') not in ('', '0', 'false', 'False')
+    return bool(value)
+
+
+class ViewPool:
+    def __init__(self, max_workers=None):
+        self._max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # the pool is created on first use so settings are read after Django is configured
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                workers = self._max_workers or int(getattr(settings, 'FIREFLIGHT_VIEW_WORKERS',
+                                                           os.environ.get('FIREFLIGHT_VIEW_WORKERS', 4)))
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="view")
+            return self._executor
+
+    # awaits func(*args, **kwargs) on a pool thread, keeping the caller's context (timing stages)
+    async def run(self, func, *args, **kwargs):
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, _call, func, args, kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def stream(self, chunks):
+        """
+        Iterates a sync iterator of response chunks on one pool thread and yields
+        them to the event loop in batches of about STREAM_BATCH.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=STREAM_BUFFER)
+        stopped = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def produce():
+            try:
+                batch, size = [], 0
+                for chunk in chunks:
+                    if stopped.is_set():
+                        return
+                    batch.append(chunk)
+                    size += len(chunk)
+                    if size >= STREAM_BATCH:
+                        put(chunk[:0].join(batch))
+                        batch, size = [], 0
+                if batch and not stopped.is_set():
+                    put(batch[0][:0].join(batch))
+                put(_END)
+            except BaseException as e:
+                put(e)
+            finally:
+                close_old_connections()
+
+        producer = loop.run_in_executor(self.executor, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # the client went away or the stream failed: stop the producer and free its puts
+            stopped.set()
+            while not producer.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.wait([producer], timeout=0.05)
+
+
+# runs one view call on a pool thread, closing the thread's expired database connections after it
+def _call(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+# pool shared by the async views in this process
+view_pool = ViewPool()
+
+
+# async variant of a sync view, run on a view pool
+def async_view(view, pool=None):
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        viewPool = pool or view_pool
+        response = await viewPool.run(view, request, *args, **kwargs)
+        # streamed exports are iterated on the pool too
+        if getattr(response, "streaming", False) and not getattr(response, "is_async", False):
+            response.streaming_content = viewPool.stream(response.streaming_content)
+        return response
+    return wrapper
+
+
+map = async_view(views.map)
+download = async_view(views.download)
+query = async_view(views.query)
+tile = async_view(views.tile)
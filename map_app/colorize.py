@@ -0,0 +1,74 @@
+# Heatmap PNG colorizer.
+#
+# The overlay gradient is precomputed as a 256-entry lookup table, the raster is stretched over
+# its 5th to 95th percentile (both found in one partition of the data), quantized to table
+# indexes and written by Pillow as an 8-bit palette PNG. This matches what plt.imsave produced
+# with the LinearSegmentedColormap without importing matplotlib, and palette PNGs are a fraction
+# of the size of the RGBA ones.
+
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+
+from .heatmap import HEATMAP_COLORS
+
+# entries in the gradient lookup table
+LUT_SIZE = 256
+
+# percentiles the colors are stretched between
+CLIP_PERCENTILES = (5, 95)
+
+
+# 256 x 4 uint8 RGBA table of the overlay gradient
+@lru_cache(maxsize=1)
+def gradient_table():
+    positions = [position for position, _ in HEATMAP_COLORS]
+    colors = np.array([[int(color[i:i + 2], 16) / 255 for i in (1, 3, 5)] for _, color in HEATMAP_COLORS])
+
+    # sample the gradient evenly like matplotlib's colormap lookup table
+    samples = np.linspace(0, 1, LUT_SIZE)
+    table = np.full((LUT_SIZE, 4), 255, dtype=np.uint8)
+    for channel in range(3):
+        table[:, channel] = (np.interp(samples, positions, colors[:, channel]) * 255).astype(np.uint8)
+    table.flags.writeable = False
+    return table
+
+
+# (lower, upper) clip bounds of the data
+def clip_range(data):
+    lower, upper = np.percentile(data, CLIP_PERCENTILES)
+    return float(lower), float(upper)
+
+
+# maps data to lookup table indexes, stretching lower..upper over the whole gradient
+def quantize(data, lower, upper):
+    span = upper - lower
+    if span <= 0:
+        return np.zeros(data.shape, dtype=np.uint8)
+    scaled = (np.asarray(data, dtype=np.float32) - lower) * (LUT_SIZE / span)
+    return np.clip(scaled, 0, LUT_SIZE - 1).astype(np.uint8)
+
+
+def png_compress_level():
+    return getattr(settings, 'FIREFLIGHT_PNG_COMPRESS_LEVEL', 6)
+
+
+# writes lookup table indexes as a palette PNG
+def save_palette_png(indexes, path, compress_level=None):
+    from PIL import Image
+
+    image = Image.fromarray(indexes, 'P')
+    image.putpalette(gradient_table()[:, :3].tobytes())
+    image.save(path, format='PNG',
+               compress_level=png_compress_level() if compress_level is None else compress_level)
+
+
+def colorize(data, path, compress_level=None):
+    """
+    Writes data as the heatmap overlay PNG at path and returns the (lower, upper)
+    data range the gradient was stretched over.
+    """
+    lower, upper = clip_range(data)
+    save_palette_png(quantize(data, lower, upper), path, compress_level)
+    return lower, upper
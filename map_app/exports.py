@@ -0,0 +1,173 @@
+# Streaming table exports for the <modelName>/query/ endpoint.
+#
+# Rows are read with a chunked values_list iterator and serialized one at a time, so an export
+# of the whole Results table never sits in server memory. Query parameters:
+#   fields=a,b,c                       columns to include (default: every column)
+#   species=1,2                        speciesID filter (Species, Results)
+#   grid=1,2                           grid id filter (Grid, Results)
+#   bbox=min_lon,min_lat,max_lon,max_lat
+#                                      grid location filter (Grid, Results)
+#   after_id=N&limit=N                 keyset pagination: rows with id > after_id, ordered by id
+#   format=csv|ndjson                  output format (default csv)
+#   gzip=1                             gzip the output
+
+import csv
+import json
+import zlib
+
+from .models import Species, Grid, Results
+
+# models that can be exported
+MODELS = {
+    "Species": Species,
+    "species": Species,
+    "Grid": Grid,
+    "grid": Grid,
+    "Results": Results,
+    "results": Results
+}
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+# rows fetched from the database per round trip
+CHUNK_SIZE = 2000
+
+# uncompressed bytes collected before each gzip flush
+GZIP_BUFFER = 64 * 1024
+
+
+class ExportError(ValueError):
+    pass
+
+
+# parses a comma separated list of integers from a query parameter
+def intList(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        return [int(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        raise ExportError(f"'{name}' must be a comma separated list of integers")
+
+
+# parses a single integer query parameter
+def intParam(params, name):
+    value = params.get(name)
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ExportError(f"'{name}' must be an integer")
+
+
+# builds (fields, row iterator) for an export of model filtered by the query parameters
+def exportRows(model, params):
+    allFields = {field.name: field for field in model._meta.fields}
+
+    # column projection, in the order requested
+    fields = [name.strip() for name in params.get("fields", "").split(",") if name.strip()] or list(allFields)
+    unknown = [name for name in fields if name not in allFields]
+    if unknown:
+        raise ExportError(f"Unknown field(s): {', '.join(unknown)}")
+
+    querySet = model.objects.all()
+
+    # species filter
+    species = intList(params, "species")
+    if species is not None:
+        if model is Species:
+            querySet = querySet.filter(speciesID__in=species)
+        elif model is Results:
+            querySet = querySet.filter(bird_speciesID__speciesID__in=species)
+        else:
+            raise ExportError("'species' does not apply to this table")
+
+    # grid filters, on the grid itself or the result's grid
+    gridPrefix = "" if model is Grid else "gridID__"
+    grids = intList(params, "grid")
+    bbox = params.get("bbox")
+    if (grids is not None or bbox) and model is Species:
+        raise ExportError("'grid' and 'bbox' do not apply to this table")
+
+    if grids is not None:
+        querySet = querySet.filter(id__in=grids) if model is Grid else querySet.filter(gridID__in=grids)
+
+    if bbox:
+        try:
+            minLon, minLat, maxLon, maxLat = (float(value) for value in bbox.split(","))
+        except ValueError:
+            raise ExportError("'bbox' must be min_lon,min_lat,max_lon,max_lat")
+        querySet = querySet.filter(**{
+            f"{gridPrefix}Grid_Long_NAD83__gte": minLon,
+            f"{gridPrefix}Grid_Long_NAD83__lte": maxLon,
+            f"{gridPrefix}Grid_Lat_NAD83__gte": minLat,
+            f"{gridPrefix}Grid_Lat_NAD83__lte": maxLat,
+        })
+
+    # keyset pagination on the primary key
+    querySet = querySet.order_by("id")
+    afterID = intParam(params, "after_id")
+    if afterID is not None:
+        querySet = querySet.filter(id__gt=afterID)
+    limit = intParam(params, "limit")
+    if limit is not None:
+        if limit < 0:
+            raise ExportError("'limit' must not be negative")
+        querySet = querySet[:limit]
+
+    # relations are exported as their id, read straight from the foreign key column
+    columns = [allFields[name].attname for name in fields]
+    return fields, querySet.values_list(*columns).iterator(chunk_size=CHUNK_SIZE)
+
+
+# file-like object that hands back whatever is written to it, so csv.writer can feed a generator
+class Echo:
+    def write(self, value):
+        return value
+
+
+def csvLines(fields, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjsonLines(fields, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row))) + "\n"
+
+
+# gzips a stream of text, flushing every GZIP_BUFFER bytes
+def gzipChunks(lines):
+    compressor = zlib.compressobj(wbits=31)
+    buffer = []
+    size = 0
+    for line in lines:
+        data = line.encode()
+        buffer.append(data)
+        size += len(data)
+        if size >= GZIP_BUFFER:
+            yield compressor.compress(b"".join(buffer))
+            buffer = []
+            size = 0
+    yield compressor.compress(b"".join(buffer)) + compressor.flush()
+
+
+# returns (content type, file extension, chunk iterator) for an export
+def exportStream(model, params):
+    outputFormat = params.get("format", "csv").lower()
+    if outputFormat not in FORMATS:
+        raise ExportError(f"'format' must be one of {', '.join(FORMATS)}")
+
+    fields, rows = exportRows(model, params)
+    lines = csvLines(fields, rows) if outputFormat == "csv" else ndjsonLines(fields, rows)
+
+    if params.get("gzip") in ("1", "true", "yes"):
+        return "application/gzip", f"{outputFormat}.gz", gzipChunks(lines)
+    return FORMATS[outputFormat], outputFormat, lines
@@ -0,0 +1,57 @@
+# Shared heatmap render settings used by the map views and management commands.
+#
+# This module is imported by every render command before it parses its arguments, so it must
+# stay free of NumPy and the other heavy rendering imports.
+
+# Parameters every heatmap render uses. These are part of the render cache key,
+# so changing one invalidates all cached maps.
+RENDER_PARAMS = {
+    "sigma": 5,           # Gaussian smoothing used to blend points into larger masses
+    "pixel_size": 0.01,   # raster cell size in degrees
+    "multiplier": 20,     # intensity boost applied after smoothing
+    "aggregate": "sum",   # how results sharing a raster cell are combined (see AGGREGATIONS)
+    "richness_threshold": 0.5,  # posterior median a species needs to count towards "richness"
+}
+
+# Ways of combining several values that land in the same raster cell.
+#   sum      - total of the values (for occupancy probabilities, the expected number of species)
+#   mean     - average of the values
+#   max      - largest value
+#   presence - probability that at least one is present, 1 - prod(1 - p)
+#   richness - number of values at or above the richness threshold
+AGGREGATIONS = ("sum", "mean", "max", "presence", "richness")
+
+# Bands of every render: the aggregated posterior median, the aggregated lower and upper credible
+# bounds, and the width of that interval. The median band is the map shown by default; the shell
+# lets users switch between the bands without another render.
+BANDS = ("median", "lbci", "ubci", "width")
+
+BAND_LABELS = {
+    "median": "Posterior median",
+    "lbci": "Lower credible bound",
+    "ubci": "Upper credible bound",
+    "width": "Credible interval width",
+}
+
+
+# file name of a band's copy of a render file, e.g. heatmap_raster_lbci.npy; the median band
+# keeps the plain name
+def band_file(name, band):
+    if band == BANDS[0]:
+        return name
+    stem, extension = name.rsplit(".", 1)
+    return f"{stem}_{band}.{extension}"
+
+
+# Blue-white-orange gradient of the heatmap overlay, as (position, color) stops.
+HEATMAP_COLORS = [
+    (0.0, '#1f78b4'),   # Background blue (if needed)
+    (0.3, '#1f78b4'),   # Maintain blue at low intensities
+    (0.5, '#ffffff'),   # White (start of gradient)
+    (0.65, '#ffe5cc'),  # Lighter orange
+    (0.8, '#ffcc99'),   # Medium orange
+    (1.0, '#ff7f00'),   # Deep orange (center, highest intensity)
+]
+
+# Deepest zoom level the tile endpoint serves.
+TILE_MAX_ZOOM = 18
@@ -0,0 +1,174 @@
+import os
+import csv
+import json
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from io import StringIO
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from map_app import views
+from map_app.models import Species
+from map_app.management.commands.populate import SPECIES_FIELDS, GRID_FIELDS, RESULTS_FIELDS
+
+# south-west corner of the synthetic grid, inside the Enchanted Circle
+ORIGIN_LAT = 36.3
+ORIGIN_LON = -105.7
+# roughly 1km between neighbouring grid cells
+GRID_SPACING = 0.01
+
+
+class Command(BaseCommand):
+    help = ('Time populate, the CSV and query exports, the heatmap commands and map generation against '
+            'synthetic Species/Grid/Results data in a throwaway database, and write the timings as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--species', type=int, default=50, help="Number of synthetic species")
+        parser.add_argument('--grids', type=int, default=2000, help="Number of synthetic grid cells")
+        parser.add_argument('--selection', type=int, default=10,
+                            help="Number of species in the filtered exports and renders")
+        parser.add_argument('--repeat', type=int, default=3,
+                            help="Runs of every read-only stage; the best and mean are reported")
+        parser.add_argument('--chunk-size', type=int, default=5000, help="Chunk size passed to populate --bulk")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for the synthetic values")
+        parser.add_argument('--output', default='benchmark.json', help="File the JSON results are written to")
+
+    def handle(self, *args, **kwargs):
+        work_dir = tempfile.mkdtemp(prefix='fireflight-bench-')
+        old_name = None
+        try:
+            # never touch the configured database: load into a fresh test database instead
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+            # keep data-version stamps and renders inside the work directory
+            with override_settings(FIREFLIGHT_RENDER_CACHE_DIR=os.path.join(work_dir, 'render_cache')):
+                report = self.run_benchmarks(work_dir, kwargs)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        with open(kwargs['output'], 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+        for name, timing in report['timings'].items():
+            self.stdout.write(f"{name:<36} best {timing['best']:.3f}s  mean {timing['mean']:.3f}s")
+        self.stdout.write(self.style.SUCCESS(f"Benchmark results written to {kwargs['output']}"))
+
+    def run_benchmarks(self, work_dir, options):
+        species_csv, grid_csv, results_csv = self.write_dataset(work_dir, options['species'], options['grids'], options['seed'])
+        timings = {}
+
+        def timed(name, function, repeat=1):
+            seconds = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                function()
+                seconds.append(time.perf_counter() - start)
+            timings[name] = {'seconds': seconds, 'best': min(seconds), 'mean': statistics.mean(seconds)}
+
+        def populate(file_path):
+            call_command('populate', file_path, '--bulk', '--chunk-size', str(options['chunk_size']),
+                         stdout=StringIO(), stderr=StringIO())
+
+        # ingest, each file once since a second load measures updates instead of inserts
+        timed('populate_species', lambda: populate(species_csv))
+        timed('populate_grid', lambda: populate(grid_csv))
+        timed('populate_results', lambda: populate(results_csv))
+
+        # the selection is the first species by speciesID, the value the map form posts
+        selection = [str(species_id) for species_id in
+                     Species.objects.order_by('speciesID').values_list('speciesID', flat=True)[:options['selection']]]
+        selection_csv = os.path.join(work_dir, 'bird_data.csv')
+
+        def get_csv():
+            with open(selection_csv, 'w', newline='') as csv_output:
+                views.getCSV(selection, csv_output)
+
+        def query_export():
+            request = RequestFactory().get('/results/query/')
+            for _ in views.query(request, 'results').streaming_content:
+                pass
+
+        timed('get_csv', get_csv, options['repeat'])
+        timed('query_export_results', query_export, options['repeat'])
+
+        # renders, written to their own folder so nothing lands in the live static/template folders
+        render_dir = os.path.join(work_dir, 'render')
+
+        def command(name, *args):
+            return lambda: call_command(name, *args, '--output-dir', render_dir, stdout=StringIO(), stderr=StringIO())
+
+        timed('create_heatmap', command('create_heatmap', '--species', ','.join(selection)), options['repeat'])
+        timed('create_heatmap_all', command('create_heatmap_all'), options['repeat'])
+        timed('generate_enchanted_circle_map', command('generate_enchanted_circle_map', '--species', ','.join(selection)), options['repeat'])
+        timed('generate_enchanted_circle_map_all', command('generate_enchanted_circle_map_all'), options['repeat'])
+
+        return {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': self.git_commit(),
+            'database': connection.vendor,
+            'scale': {
+                'species': options['species'],
+                'grids': options['grids'],
+                'results': options['species'] * options['grids'],
+                'selection': len(selection),
+                'chunk_size': options['chunk_size'],
+                'repeat': options['repeat'],
+                'seed': options['seed'],
+            },
+            'timings': timings,
+        }
+
+    def write_dataset(self, work_dir, species_count, grid_count, seed):
+        """
+        Writes species.csv, grid.csv and results.csv in the layout populate expects: a square
+        lattice of grid cells and a posterior median for every species in every cell. Results
+        refer to species and grids by their row number, which matches their ids in a fresh database.
+        """
+        rng = random.Random(seed)
+        species_csv = os.path.join(work_dir, 'species.csv')
+        grid_csv = os.path.join(work_dir, 'grid.csv')
+        results_csv = os.path.join(work_dir, 'results.csv')
+
+        with open(species_csv, 'w', newline='') as species_file:
+            writer = csv.writer(species_file)
+            writer.writerow(SPECIES_FIELDS)
+            for species_id in range(1, species_count + 1):
+                writer.writerow([species_id, f"Synthetic Bird {species_id}", f"SB{species_id:04d}"])
+
+        columns = max(1, round(grid_count ** 0.5))
+        with open(grid_csv, 'w', newline='') as grid_file:
+            writer = csv.writer(grid_file)
+            writer.writerow(GRID_FIELDS)
+            for oid in range(1, grid_count + 1):
+                row, column = divmod(oid - 1, columns)
+                writer.writerow([oid, f"NM-SYNTH-{oid}", 388500 + column * 1000, 4091500 + row * 1000, 13,
+                                 round(ORIGIN_LAT + row * GRID_SPACING, 6), round(ORIGIN_LON + column * GRID_SPACING, 6),
+                                 16, "US Forest Service", "USFS Region 3", "Carson National Forest",
+                                 "Questa Ranger District", "Taos", "NM", "Enchanted Circle", oid % 2])
+
+        with open(results_csv, 'w', newline='') as results_file:
+            writer = csv.writer(results_file)
+            writer.writerow(RESULTS_FIELDS)
+            for species_id in range(1, species_count + 1):
+                for grid_id in range(1, grid_count + 1):
+                    median = rng.random()
+                    writer.writerow([f"psi[{species_id},{grid_id}]", round(median * 0.8, 4), round(median, 4),
+                                     round(min(1.0, median * 1.2), 4)])
+
+        return species_csv, grid_csv, results_csv
+
+    def git_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
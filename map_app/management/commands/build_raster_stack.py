@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from map_app.raster_stack import build_stack, stack_dir
+
+class Command(BaseCommand):
+    help = ('Precompute the smoothed raster of every species into the shared raster stack that '
+            'filtered maps are composited from; only species whose results changed are rebuilt')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help="Rebuild every layer instead of reusing unchanged ones")
+
+    def handle(self, *args, **kwargs):
+        try:
+            layers, rebuilt, seconds = build_stack(full=kwargs['full'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f'Raster stack built in {stack_dir()}: {layers} layers, {rebuilt} rebuilt in {seconds:.2f}s.'))
@@ -1,40 +1,93 @@
 import os
 import csv
-import numpy as np
-import rasterio
-import matplotlib.pyplot as plt
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from rasterio.transform import from_origin
-from scipy.ndimage import gaussian_filter  # For smoothing
 from map_app.models import Grid
+from map_app.heatmap import AGGREGATIONS, BANDS, RENDER_PARAMS
+from map_app.selection import grid_values, parse_species
+from map_app.timing import command_timing, stage
+
+# NumPy, SciPy and rasterio are imported where the raster is built, so starting the command stays cheap.
 
 class Command(BaseCommand):
     help = 'Generate heatmap raster from grid data (DB) and filtered posterior median values (CSV)'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--aggregate', choices=AGGREGATIONS, default=RENDER_PARAMS['aggregate'],
+                            help="How results that fall in the same raster cell are combined")
+        parser.add_argument('--output-dir',
+                            help="Write every output file into this directory instead of the live static/template folders")
+        parser.add_argument('--csv', default=os.path.join(settings.BASE_DIR, 'bird_data.csv'),
+                            help="CSV export of the selected results to render")
+        parser.add_argument('--species', type=parse_species,
+                            help="Comma-separated speciesID values to render, read straight from the database instead of --csv")
+
+    @command_timing
     def handle(self, *args, **kwargs):
         self.stdout.write(self.style.SUCCESS('Starting raster generation...'))
         
         # Define the output directory and ensure it exists.
-        output_dir = os.path.join('map_app', 'static', 'images')
+        output_dir = kwargs['output_dir'] or os.path.join('map_app', 'static', 'images')
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         
         # Set the output raster file path.
         output_raster = os.path.join(output_dir, 'heatmap_raster.tif')
         
-        self.create_heatmap_raster(output_raster)
+        self.create_heatmap_raster(output_raster, kwargs['aggregate'], kwargs['csv'], kwargs['species'])
         self.stdout.write(self.style.SUCCESS('Raster generation and visualization completed.'))
 
-    def create_heatmap_raster(self, output_raster):
+    def create_heatmap_raster(self, output_raster, aggregate=RENDER_PARAMS['aggregate'], csv_file_path=None, species=None):
+        with stage("read_data"):
+            if species is not None:
+                # One GROUP BY query over the selection, one row per grid
+                latitudes, longitudes, values, counts = grid_values(aggregate, species)
+            else:
+                latitudes, longitudes, values = self.read_csv(csv_file_path)
+                counts = None
+
+        # Ensure we have data to process.
+        if not latitudes or not longitudes or not values:
+            if species is not None:
+                self.stdout.write(self.style.ERROR("No results found for the selected species."))
+            else:
+                self.stdout.write(self.style.ERROR("No valid data found in CSV or matching grid records."))
+            return
+
+        import rasterio
+        from rasterio.transform import from_origin
+        from map_app.raster import build_raster
+
+        # Rasterize the median, lbci and ubci bands in one batch, combining results (or per-grid
+        # aggregates) that share a cell, apply Gaussian smoothing (sigma=2.0) to every band at
+        # once, add the interval width band and boost intensity.
+        pixel_size = 0.01  # Adjust as needed.
+        raster_data, west, north = build_raster(latitudes, longitudes, values, counts, aggregate,
+                                                pixel_size=pixel_size, sigma=2.0, multiplier=20)
+        nrows, ncols = raster_data.shape[1:]
+        transform = from_origin(west, north, pixel_size, pixel_size)
+
+        # Write the smoothed/scaled bands to one GeoTIFF, a band each.
+        with stage("write_geotiff"), rasterio.open(
+            output_raster, 'w', driver='GTiff', 
+            height=nrows, width=ncols, count=len(BANDS), dtype='float32',
+            crs='+proj=latlong', transform=transform
+        ) as dst:
+            dst.write(raster_data)
+            dst.descriptions = BANDS
+
+        self.stdout.write(self.style.SUCCESS(f"Raster file created at '{output_raster}'."))
+
+    def read_csv(self, csv_file_path=None):
         # Build a dictionary mapping grid_OID to Grid objects.
         grid_dict = {grid.id: grid for grid in Grid.objects.all()}
-        
-        # Path to the CSV file (assumed at the repo's top level).
-        csv_file_path = os.path.join(settings.BASE_DIR, 'bird_data.csv')
-        
-        latitudes, longitudes, medians = [], [], []
-        
+
+        # Path to the CSV file (defaults to the one at the repo's top level).
+        if csv_file_path is None:
+            csv_file_path = os.path.join(settings.BASE_DIR, 'bird_data.csv')
+
+        latitudes, longitudes, values = [], [], []
+
         # Read the CSV file.
         with open(csv_file_path, newline='') as csvfile:
             reader = csv.DictReader(csvfile)
@@ -46,55 +99,22 @@ class Command(BaseCommand):
                     grid_oid_int = int(grid_oid)
                 except ValueError:
                     continue  # Skip rows with invalid grid_OID
-                
+
                 grid = grid_dict.get(grid_oid_int)
                 if grid is None:
                     continue  # Skip if grid not found in the database
-                
+
                 # Append grid coordinates from the DB.
                 latitudes.append(grid.Grid_Lat_NAD83)
                 longitudes.append(grid.Grid_Long_NAD83)
-                
-                # Append the posterior median value from the CSV.
-                try:
-                    medians.append(float(row.get('posterior_median', 0)))
-                except ValueError:
-                    medians.append(0)
-        
-        # Ensure we have data to process.
-        if not latitudes or not longitudes or not medians:
-            self.stdout.write(self.style.ERROR("No valid data found in CSV or matching grid records."))
-            return
 
-        # Define raster grid parameters.
-        min_lat, max_lat = min(latitudes), max(latitudes)
-        min_lon, max_lon = min(longitudes), max(longitudes)
-        pixel_size = 0.01  # Adjust as needed.
-        nrows = int((max_lat - min_lat) / pixel_size) + 1
-        ncols = int((max_lon - min_lon) / pixel_size) + 1
-        raster_data = np.zeros((nrows, ncols), dtype=np.float32)
-
-        # Use from_origin(min_lon, max_lat, pixel_size, pixel_size) for correct alignment.
-        transform = from_origin(min_lon, max_lat, pixel_size, pixel_size)
-
-        # Populate the raster with posterior median values.
-        for lat, lon, median in zip(latitudes, longitudes, medians):
-            row = int((max_lat - lat) / pixel_size)
-            col = int((lon - min_lon) / pixel_size)
-            # Ensure indices are within bounds.
-            if 0 <= row < nrows and 0 <= col < ncols:
-                raster_data[row, col] = median
-
-        # Apply Gaussian smoothing (sigma=2.0) and boost intensity.
-        raster_data = gaussian_filter(raster_data, sigma=2.0)
-        raster_data = raster_data * 20  # Adjust multiplier as needed.
-
-        # Write the smoothed/scaled raster to a GeoTIFF.
-        with rasterio.open(
-            output_raster, 'w', driver='GTiff', 
-            height=nrows, width=ncols, count=1, dtype='float32',
-            crs='+proj=latlong', transform=transform
-        ) as dst:
-            dst.write(raster_data, 1)
+                # Append the posterior median and credible bounds from the CSV.
+                values.append(tuple(self.csv_float(row, column) for column in ('posterior_median', 'lbci', 'ubci')))
 
-        self.stdout.write(self.style.SUCCESS(f"Raster file created at '{output_raster}'."))
+        return latitudes, longitudes, values
+
+    def csv_float(self, row, column):
+        try:
+            return float(row.get(column, 0))
+        except (TypeError, ValueError):
+            return 0
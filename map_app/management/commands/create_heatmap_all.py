@@ -1,76 +1,81 @@
 import os
-import numpy as np
-import rasterio
-import matplotlib.pyplot as plt
 from django.core.management.base import BaseCommand
-from rasterio.transform import from_origin
-from scipy.ndimage import gaussian_filter
-from map_app.models import Results
+from map_app.heatmap import AGGREGATIONS, BANDS, RENDER_PARAMS
+from map_app.selection import grid_values
+from map_app.timing import command_timing, stage
+
+# NumPy, SciPy, rasterio and matplotlib are imported where they are used, so starting the
+# command stays cheap.
 
 class Command(BaseCommand):
     help = 'Generate heatmap raster from full DB data (Results) using posterior median values'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--aggregate', choices=AGGREGATIONS, default=RENDER_PARAMS['aggregate'],
+                            help="How results that fall in the same raster cell are combined")
+        parser.add_argument('--output-dir',
+                            help="Write every output file into this directory instead of the live static/template folders")
+
+    @command_timing
     def handle(self, *args, **kwargs):
         self.stdout.write(self.style.SUCCESS('Starting full database heatmap generation...'))
         
         # Define output directory and file path.
-        output_dir = os.path.join('map_app', 'static', 'images')
+        output_dir = kwargs['output_dir'] or os.path.join('map_app', 'static', 'images')
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         output_raster = os.path.join(output_dir, 'heatmap_raster.tif')
         
         # Create the raster using all database data.
-        self.create_heatmap_raster(output_raster)
+        self.create_heatmap_raster(output_raster, kwargs['aggregate'])
         
         # Optionally, you can include visualization here if needed.
         # self.visualize_raster(output_raster)
         
         self.stdout.write(self.style.SUCCESS('Full database heatmap generation completed.'))
 
-    def create_heatmap_raster(self, output_raster):
-        # Query the Results table to obtain grid coordinates and posterior median values.
-        latitudes, longitudes, medians = [], [], []
-        results = Results.objects.select_related('gridID').all()
-        for result in results:
-            grid = result.gridID
-            latitudes.append(grid.Grid_Lat_NAD83)
-            longitudes.append(grid.Grid_Long_NAD83)
-            medians.append(result.posterior_median)
-
-        # Determine the bounds and grid parameters.
-        min_lat, max_lat = min(latitudes), max(latitudes)
-        min_lon, max_lon = min(longitudes), max(longitudes)
+    def create_heatmap_raster(self, output_raster, aggregate=RENDER_PARAMS['aggregate']):
+        # Aggregate the posterior median values per grid in the database, one row per grid.
+        with stage("read_data"):
+            latitudes, longitudes, values, counts = grid_values(aggregate)
+
+        # Ensure we have data to process.
+        if not latitudes:
+            self.stdout.write(self.style.ERROR("No valid data found in DB."))
+            return
+
+        import rasterio
+        from rasterio.transform import from_origin
+        from map_app.raster import build_raster
+
+        # Rasterize the median, lbci and ubci bands in one batch, combining grids that share a cell,
+        # apply Gaussian smoothing (sigma=2.0) to every band at once, add the interval width band
+        # and boost intensity.
         pixel_size = 0.01  # Adjust as needed.
-        nrows = int((max_lat - min_lat) / pixel_size) + 1
-        ncols = int((max_lon - min_lon) / pixel_size) + 1
-        raster_data = np.zeros((nrows, ncols), dtype=np.float32)
-
-        # Create the affine transform for the raster.
-        transform = from_origin(min_lon, max_lat, pixel_size, pixel_size)
-
-        # Populate the raster array with posterior median values.
-        for lat, lon, median in zip(latitudes, longitudes, medians):
-            row = int((max_lat - lat) / pixel_size)
-            col = int((lon - min_lon) / pixel_size)
-            # If multiple results fall in the same cell, you might consider aggregating them.
-            raster_data[row, col] = median
-
-        # Apply Gaussian smoothing and boost intensity.
-        raster_data = gaussian_filter(raster_data, sigma=2.0)
-        raster_data = raster_data * 20  # Adjust multiplier as needed.
-
-        # Write the raster to a GeoTIFF.
-        with rasterio.open(
+        raster_data, west, north = build_raster(latitudes, longitudes, values, counts, aggregate,
+                                                pixel_size=pixel_size, sigma=2.0, multiplier=20)
+        nrows, ncols = raster_data.shape[1:]
+        transform = from_origin(west, north, pixel_size, pixel_size)
+
+        # Write the bands to one GeoTIFF, a band each.
+        with stage("write_geotiff"), rasterio.open(
             output_raster, 'w', driver='GTiff', 
-            height=nrows, width=ncols, count=1, dtype='float32',
+            height=nrows, width=ncols, count=len(BANDS), dtype='float32',
             crs='+proj=latlong', transform=transform
         ) as dst:
-            dst.write(raster_data, 1)
+            dst.write(raster_data)
+            dst.descriptions = BANDS
 
         self.stdout.write(self.style.SUCCESS(f"Raster file created at '{output_raster}'."))
 
     def visualize_raster(self, raster_file):
-        # Optional helper to visualize the raster.
+        # Optional helper to visualize the raster. It draws on matplotlib's Agg canvas and saves a
+        # PNG next to the raster, so pyplot and its GUI backends are never loaded.
+        import numpy as np
+        import rasterio
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
         with rasterio.open(raster_file) as src:
             data = src.read(1)
 
@@ -83,9 +88,13 @@ class Command(BaseCommand):
         norm_data = np.clip(norm_data, 0, thresh)
         norm_data = norm_data / thresh
 
-        cmap = plt.get_cmap('viridis')
-        plt.figure(figsize=(10, 6))
-        plt.imshow(norm_data, cmap=cmap, interpolation='bilinear', vmin=0, vmax=1)
-        plt.colorbar(label='Posterior Median (normalized)')
-        plt.title('Heatmap from Full DB Data')
-        plt.show()
+        fig = Figure(figsize=(10, 6))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        image = ax.imshow(norm_data, cmap='viridis', interpolation='bilinear', vmin=0, vmax=1)
+        fig.colorbar(image, ax=ax, label='Posterior Median (normalized)')
+        ax.set_title('Heatmap from Full DB Data')
+
+        preview = os.path.splitext(raster_file)[0] + '_preview.png'
+        fig.savefig(preview)
+        self.stdout.write(self.style.SUCCESS(f"Raster preview saved to '{preview}'."))
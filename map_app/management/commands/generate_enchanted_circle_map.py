@@ -1,33 +1,16 @@
 import os
 import csv
-import numpy as np
-import folium
-import rasterio
-import matplotlib.pyplot as plt
 from django.conf import settings
-from django.core.management.base import BaseCommand
-from rasterio.transform import from_origin
-from scipy.ndimage import gaussian_filter
-from matplotlib.colors import LinearSegmentedColormap
+from django.core.management.base import BaseCommand, CommandError
 from map_app.models import Grid
-from folium.elements import MacroElement
-from jinja2 import Template
-
-# Custom MacroElement to add a back button only if not in embed mode
-class BackButton(MacroElement):
-    _template = Template("""
-        {% macro script(this, kwargs) %}
-            if (window.location.search.indexOf('embed') === -1) {
-                var backButton = L.control({position: 'topleft'});
-                backButton.onAdd = function(map) {
-                    var div = L.DomUtil.create('div', 'leaflet-bar leaflet-control leaflet-control-custom');
-                    div.innerHTML = '<a href="/map" title="Back" style="display: block; width: 50px; height: 50px; line-height: 50px; font-size: 24px; text-align: center; background: white; border: 2px solid rgba(0,0,0,0.2); border-radius: 4px;">&#8592;</a>';
-                    return div;
-                };
-                backButton.addTo({{this._parent.get_name()}});
-            }
-        {% endmacro %}
-    """)
+from map_app.heatmap import AGGREGATIONS, BAND_LABELS, BANDS, RENDER_PARAMS, TILE_MAX_ZOOM, band_file
+from map_app.map_shell import BACK_BUTTON_SCRIPT, LEGEND_HTML, script_element
+from map_app.precompress import write_compressed
+from map_app.selection import grid_extent, parse_species
+from map_app.timing import command_timing, stage
+
+# NumPy, SciPy and folium are imported inside the code paths that use them, so starting the
+# command (and --overlay-only renders, which never build a folium map) stays cheap.
 
 
 class Command(BaseCommand):
@@ -35,109 +18,143 @@ class Command(BaseCommand):
             'blue-white-orange colormap with a gradual gradient and interpolated data '
             'sourced from a CSV (filtered values) and grid coordinates from the database.')
 
+    def add_arguments(self, parser):
+        parser.add_argument('--aggregate', choices=AGGREGATIONS, default=RENDER_PARAMS['aggregate'],
+                            help="How results that fall in the same raster cell are combined")
+        parser.add_argument('--csv', default=os.path.join(settings.BASE_DIR, 'bird_data.csv'),
+                            help="CSV export of the selected results to render")
+        parser.add_argument('--species', type=parse_species,
+                            help="Comma-separated speciesID values to render, read straight from the database instead of --csv")
+        parser.add_argument('--output-dir',
+                            help="Write every output file into this directory instead of the live static/template folders")
+        parser.add_argument('--render-id',
+                            help="Render id the map is served under; the overlay is then loaded from the tile endpoint")
+        parser.add_argument('--geotiff', action='store_true',
+                            help="Also export the raster as heatmap_raster.tif")
+        parser.add_argument('--overlay-only', action='store_true',
+                            help="Only write the overlay raster, PNG and metadata; the app's map shell draws the map")
+
+    @command_timing
     def handle(self, *args, **kwargs):
         self.stdout.write(self.style.SUCCESS('Starting heatmap raster generation and Folium map creation...'))
 
         # Ensure directories exist
-        static_dir = os.path.join('map_app', 'static', 'images')
+        static_dir = kwargs['output_dir'] or os.path.join('map_app', 'static', 'images')
         if not os.path.exists(static_dir):
             os.makedirs(static_dir)
-        template_dir = os.path.join('map_app', 'templates')
+        template_dir = kwargs['output_dir'] or os.path.join('map_app', 'templates')
         if not os.path.exists(template_dir):
             os.makedirs(template_dir)
         
         # Define file paths
-        raster_tif = os.path.join(static_dir, 'heatmap_raster.tif')
-        raster_png = os.path.join(static_dir, 'heatmap_raster.png')
         map_output = os.path.join(template_dir, 'enchanted_circle_map.html')
 
-        # Generate the heatmap raster GeoTIFF
-        bounds = self.create_heatmap_raster(raster_tif)
-
-        # Create a custom blue-white-orange colormap with a gradual gradient:
-        custom_cmap = LinearSegmentedColormap.from_list(
-            'custom_white_to_orange', 
-            [
-                (0.0, '#1f78b4'),   # Background blue (if needed)
-                (0.3, '#1f78b4'),   # Maintain blue at low intensities
-                (0.5, '#ffffff'),   # White (start of gradient)
-                (0.65, '#ffe5cc'),  # Lighter orange
-                (0.8, '#ffcc99'),   # Medium orange
-                (1.0, '#ff7f00')    # Deep orange (center, highest intensity)
-            ]
-        )
-
-        # Convert the GeoTIFF to PNG using the custom colormap
-        bounds = self.convert_geotiff_to_png(raster_tif, raster_png, custom_cmap)
-        overlay_bounds = [[bounds.bottom, bounds.left], [bounds.top, bounds.right]]
+        # Build the heatmap raster in memory
+        raster = self.create_heatmap_raster(kwargs['aggregate'], kwargs['csv'], kwargs['species'])
+        if raster is None:
+            raise CommandError("No heatmap data to render.")
+        raster_data, west, north = raster
+
+        from map_app.raster import write_overlay
+
+        # Write the overlay PNGs, the rasters the tile server reads and the bounds/color range
+        # metadata of every band in one go, straight from the array (the GeoTIFF is only an
+        # optional export).
+        with stage("write_overlay"):
+            overlay_bounds = write_overlay(static_dir, raster_data, west, north, RENDER_PARAMS['pixel_size'],
+                                           geotiff=kwargs['geotiff'])
         self.stdout.write(self.style.SUCCESS(f"Raster bounds: {overlay_bounds}"))
 
-        # Create a Folium map with the PNG overlay
+        # The app shows every render in one shared map shell, so it only needs the overlay.
+        if kwargs['overlay_only']:
+            self.stdout.write(self.style.SUCCESS(f'Overlay written to: {static_dir}'))
+            return
+
+        import folium
+
+        # Create a Folium map with a heatmap overlay per band, the median shown first
         m = folium.Map(location=[36.5, -105.5], zoom_start=9)
-        folium.raster_layers.ImageOverlay(
-            image=raster_png,
-            bounds=overlay_bounds,
-            opacity=0.6,
-            name='Heatmap Overlay',
-            interactive=True,
-            cross_origin=False,
-            zindex=1,
-        ).add_to(m)
+        for band in BANDS:
+            if kwargs['render_id']:
+                # Served renders load their overlay as tiles cut on demand at each zoom level.
+                folium.raster_layers.TileLayer(
+                    tiles=f"/tiles/{kwargs['render_id']}/{band}/{{z}}/{{x}}/{{y}}.png",
+                    attr='FireFlight',
+                    name=BAND_LABELS[band],
+                    overlay=True,
+                    show=band == BANDS[0],
+                    opacity=0.6,
+                    max_zoom=TILE_MAX_ZOOM,
+                    zindex=1,
+                ).add_to(m)
+            else:
+                folium.raster_layers.ImageOverlay(
+                    image=os.path.join(static_dir, band_file('heatmap_raster.png', band)),
+                    bounds=overlay_bounds,
+                    opacity=0.6,
+                    name=BAND_LABELS[band],
+                    show=band == BANDS[0],
+                    interactive=True,
+                    cross_origin=False,
+                    zindex=1,
+                ).add_to(m)
         folium.LayerControl().add_to(m)
         
         # Add the back button control if not embedded
-        m.add_child(BackButton())
-
-        # Add a gradient legend with dynamic data values
-        legend_html = """
-        <div style="
-            position: absolute;
-            bottom: 10px;
-            left: 10px;
-            width: 200px;
-            background-color: rgba(255, 255, 255, 0.8);
-            border: 2px solid grey;
-            z-index: 9999;
-            font-size: 14px;
-            padding: 10px;">
-            <div style="text-align: center; font-size: 12px; margin-bottom: 0;">
-                <b>Bird Species</b><br>
-                <b>Probablity of Occupancy</b>
-            </div>
-            <div style="height: 20px; background: linear-gradient(to right, #1f78b4, #ffffff, #ff7f00);"></div>
-            <div style="display: flex; justify-content: space-between;">
-                <div style="text-align: center;">
-                    <div>Lowest</div>
-                    <div>0</div>
-                </div>
-                <div style="text-align: center;">
-                    <div>Highest</div>
-                    <div>1.0</div>
-                </div>
-            </div>
-        </div>
-        """
+        m.add_child(script_element(BACK_BUTTON_SCRIPT))
 
         # Add the legend to the map
-        m.get_root().html.add_child(folium.Element(legend_html))
+        m.get_root().html.add_child(folium.Element(LEGEND_HTML))
 
-        m.save(map_output)
+        with stage("save_map"):
+            m.save(map_output)
+            # gzip (and brotli) copies for servers that send precompressed files
+            write_compressed(map_output)
         self.stdout.write(self.style.SUCCESS(f'Folium map generated and saved to: {map_output}'))
 
-    def create_heatmap_raster(self, output_raster):
+    def create_heatmap_raster(self, aggregate=RENDER_PARAMS['aggregate'], csv_file_path=None, species=None):
+        """
+        Builds the heatmap raster of the selected species (speciesID values), the same
+        one the map view composites or prerender stores under the selection's render
+        key, or of the rows of a CSV export when no species are given. Returns the
+        (bands, rows, cols) raster of the median, lbci, ubci and interval width bands
+        with the longitude of its west edge and the latitude of its north edge.
+        """
+        from map_app.raster import build_raster, selection_raster
+
+        if species is not None:
+            raster = selection_raster(species, aggregate)
+            if raster is None:
+                self.stdout.write(self.style.ERROR("No results found for the selected species."))
+            return raster
+
+        with stage("read_data"):
+            latitudes, longitudes, values = self.read_csv(csv_file_path)
+            # laid out over the whole grid like every other selection render
+            extent = grid_extent()
+
+        if not latitudes or not longitudes or not values:
+            self.stdout.write(self.style.ERROR("No valid data found in CSV or matching grid records."))
+            return
+
+        # Rasterize the median, lbci and ubci bands of every row, smooth and scale them
+        return build_raster(latitudes, longitudes, values, aggregate=aggregate, extent=extent)
+
+    def read_csv(self, csv_file_path=None):
         """
-        Reads grid coordinates from the database and filtered posterior median values
-        from a CSV file, builds a raster grid, applies smoothing and scaling,
-        writes a GeoTIFF, and returns the raster bounds.
+        Reads filtered posterior median and credible bound values from a CSV file and matches them to grid
+        coordinates from the database. Returns (latitudes, longitudes, values) lists, with
+        a (median, lbci, ubci) tuple of values per row.
         """
         # Build a dictionary mapping grid_OID to Grid objects
         grid_dict = {grid.id: grid for grid in Grid.objects.all()}
-        
-        # Path to the CSV file (assumed to be in the repo's top level)
-        csv_file_path = os.path.join(settings.BASE_DIR, 'bird_data.csv')
-        
-        latitudes, longitudes, medians = [], [], []
-        
+
+        # Path to the CSV file (defaults to the one at the repo's top level).
+        if csv_file_path is None:
+            csv_file_path = os.path.join(settings.BASE_DIR, 'bird_data.csv')
+
+        latitudes, longitudes, values = [], [], []
+
         # Read the CSV file
         with open(csv_file_path, newline='') as csvfile:
             reader = csv.DictReader(csvfile)
@@ -149,69 +166,21 @@ class Command(BaseCommand):
                     grid_oid_int = int(grid_oid)
                 except ValueError:
                     continue
-                
+
                 grid = grid_dict.get(grid_oid_int)
                 if grid is None:
                     continue
-                
+
                 # Append grid coordinates from the DB
                 latitudes.append(grid.Grid_Lat_NAD83)
                 longitudes.append(grid.Grid_Long_NAD83)
-                # Append the posterior median value from the CSV
-                try:
-                    medians.append(float(row.get('posterior_median', 0)))
-                except ValueError:
-                    medians.append(0)
-                    
-        if not latitudes or not longitudes or not medians:
-            self.stdout.write(self.style.ERROR("No valid data found in CSV or matching grid records."))
-            return
-        
-        # Define raster grid parameters
-        min_lat, max_lat = min(latitudes), max(latitudes)
-        min_lon, max_lon = min(longitudes), max(longitudes)
-        pixel_size = 0.01 
-        nrows = int((max_lat - min_lat) / pixel_size) + 1
-        ncols = int((max_lon - min_lon) / pixel_size) + 1
-        raster_data = np.zeros((nrows, ncols), dtype=np.float32)
-        transform = from_origin(min_lon, max_lat, pixel_size, pixel_size)
-        
-        # Populate the raster with the posterior median values
-        for lat, lon, median in zip(latitudes, longitudes, medians):
-            row = int((max_lat - lat) / pixel_size)
-            col = int((lon - min_lon) / pixel_size)
-            if 0 <= row < nrows and 0 <= col < ncols:
-                raster_data[row, col] = median
-
-        # Increase the sigma value for Gaussian smoothing to blend points into larger masses
-        sigma_value = 5  # Adjust as needed for interpolation
-        raster_data = gaussian_filter(raster_data, sigma=sigma_value)
-        raster_data = raster_data * 20  # Adjust multiplier as needed
-
-        # Write the smoothed/scaled raster to a GeoTIFF
-        with rasterio.open(
-            output_raster, 'w', driver='GTiff',
-            height=nrows, width=ncols, count=1, dtype='float32',
-            crs='+proj=latlong', transform=transform
-        ) as dst:
-            dst.write(raster_data, 1)
-
-        self.stdout.write(self.style.SUCCESS(f"Raster file created at '{output_raster}'."))
-        with rasterio.open(output_raster) as src:
-            return src.bounds
-
-    def convert_geotiff_to_png(self, geotiff_path, png_path, cmap):
-        with rasterio.open(geotiff_path) as src:
-            data = src.read(1)
-            bounds = src.bounds
-
-        # Use percentile-based normalization to enhance mid-range variance
-        lower = np.percentile(data, 5)
-        upper = np.percentile(data, 95)
-        # Clip data to the 5th and 95th percentiles
-        norm_data = np.clip(data, lower, upper)
-        # Scale to the range [0, 1]
-        norm_data = (norm_data - lower) / (upper - lower)
-
-        plt.imsave(png_path, norm_data, cmap=cmap, vmin=0, vmax=1)
-        return bounds
+                # Append the posterior median and credible bounds from the CSV
+                values.append(tuple(self.csv_float(row, column) for column in ('posterior_median', 'lbci', 'ubci')))
+
+        return latitudes, longitudes, values
+
+    def csv_float(self, row, column):
+        try:
+            return float(row.get(column, 0))
+        except (TypeError, ValueError):
+            return 0
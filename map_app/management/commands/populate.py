@@ -1,6 +1,20 @@
 from django.core.management.base import BaseCommand
+from django.db import IntegrityError, connection, transaction
 from map_app.models import Species, Grid, Results
-import csv
+from map_app.render_cache import bump_data_version
+from map_app.signals import batch_changes
+from itertools import islice
+import csv, time
+
+# accepted headers for each file type
+SPECIES_FIELDS = ["speciesID","species","birdcode"]
+GRID_FIELDS = ["OID_","Grid_ID","Grid_E_NAD83","Grid_N_NAD83","UTM_Zone","Grid_Lat_NAD83","Grid_Long_NAD83","BCR",
+               "MgmtEntity","MgmtRegion","MgmtUnit","MgmtDistrict","County","State","PriorityLandscape","inPL"]
+RESULTS_FIELDS = ["parameter","lbci","posterior.median","ubci"]
+
+# grid columns that get overwritten when an existing OID is loaded again
+GRID_UPDATE_FIELDS = ["Grid_ID","Grid_E_NAD83","Grid_N_NAD83","UTM_Zone","Grid_Lat_NAD83","Grid_Long_NAD83","BCR",
+                      "MgmtEntity","MgmtRegion","MgmtUnit","MgmtDistrict","County","State","PriorityLandscape","inPL"]
 
 # define command's class
 class Command(BaseCommand):
@@ -11,14 +25,26 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         # add a file name/path argument
         parser.add_argument('filePath', type=str, help="File name of/path to file to extract data from")
+        # add the bulk ingest options
+        parser.add_argument('--bulk', action='store_true',
+                            help="Load the file in batched, transactional chunks instead of row by row")
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help="Number of rows written per transaction in bulk mode")
 
     # main command function, takes in self, positional args, and keyword arguments
+    # (row-by-row saves bump the data version once when it ends, not once per row)
+    @batch_changes()
     def handle(self, *args, **kwargs):
         # get the file/path
         filePath = kwargs['filePath']
         # get file type
         fileType = filePath[-3:-1] + filePath[-1]
 
+        # bulk mode has its own loader
+        if kwargs.get('bulk'):
+            self.bulk_populate(filePath, fileType, kwargs.get('chunk_size') or 5000)
+            return
+
         # error boolean- just print the first error
         error = False
 
@@ -33,6 +59,9 @@ class Command(BaseCommand):
                     # skip field names
                     fields = next(csvreader)
 
+                    # cleared if the file is not recognized
+                    loaded = True
+
                     match fields:
                         # if species file
                         case ["speciesID","species","birdcode"]:
@@ -231,11 +260,16 @@ class Command(BaseCommand):
 
                         #case of failure to recognize file
                         case _:
+                            loaded = False
                             if not error:
                                 print("Error: Invalid first field. File must be Species, Grid, or Results\n")
                                 self.stderr.write("Error: Invalid first field. File must be Species, Grid, or Results\n")
                                 error = True
 
+                    # the data changed, so cached maps are stale
+                    if loaded:
+                        bump_data_version()
+
                 # else file is the wrong type
                 else:
                     if not error:
@@ -246,4 +280,226 @@ class Command(BaseCommand):
         except:
             if not error:
                 print("Error: File inaccessible\n")
-                self.stderr.write("Error: File inaccessible\n")
\ No newline at end of file
+                self.stderr.write("Error: File inaccessible\n")
+
+
+    #####################################################
+    #                  Bulk ingest mode                 #
+    #####################################################
+
+    # loads a Species, Grid or Results file in chunks, one transaction and one batched upsert per chunk
+    def bulk_populate(self, filePath, fileType, chunkSize):
+        # make sure it is a csv
+        if fileType != "csv":
+            self.stderr.write("Error: Wrong file type. Must be csv\n")
+            return
+
+        try:
+            inFile = open(filePath, "r", newline="")
+        except OSError:
+            self.stderr.write("Error: File inaccessible\n")
+            return
+
+        start = time.perf_counter()
+        with inFile:
+            csvreader = csv.reader(inFile)
+
+            # pick the loader from the header, ignoring any byte order mark on the first field
+            fields = next(csvreader, [])
+            if fields:
+                fields = [fields[0].replace("\ufeff", "").replace("ï»¿", "")] + fields[1:]
+
+            if fields == SPECIES_FIELDS:
+                counts = self.bulk_load_species(csvreader, chunkSize)
+            elif fields == GRID_FIELDS:
+                counts = self.bulk_load_grid(csvreader, chunkSize)
+            elif fields == RESULTS_FIELDS:
+                counts = self.bulk_load_results(csvreader, chunkSize)
+            else:
+                self.stderr.write("Error: Invalid first field. File must be Species, Grid, or Results\n")
+                return
+
+        inserted, updated, rejected = counts
+        elapsed = time.perf_counter() - start
+        total = inserted + updated + rejected
+        rate = total / elapsed if elapsed > 0 else 0.0
+
+        if rejected:
+            self.stderr.write(f"Error: Incorrect file value ({rejected} rows rejected)\n")
+
+        # the data changed, so cached maps are stale
+        if inserted or updated:
+            bump_data_version()
+
+        # one summary line for the whole file
+        self.stdout.write(self.style.SUCCESS(
+            f"Bulk load of {filePath} complete: {inserted} inserted, {updated} updated, {rejected} rejected "
+            f"in {elapsed:.2f}s ({rate:.0f} rows/sec)"
+        ))
+
+    # species rows are upserted on speciesID
+    def bulk_load_species(self, csvreader, chunkSize):
+        existing = set(Species.objects.values_list("speciesID", flat=True))
+        inserted = updated = rejected = 0
+
+        for chunk in chunked(csvreader, chunkSize):
+            # keep the last row for every key in the chunk
+            objs = {}
+            for line in chunk:
+                try:
+                    obj = Species(speciesID=int(line[0]), species=line[1], birdcode=line[2])
+                except (ValueError, IndexError):
+                    rejected += 1
+                    continue
+                # a repeated key in the same chunk replaces the earlier row
+                if obj.speciesID in objs:
+                    updated += 1
+                objs[obj.speciesID] = obj
+
+            written = self.upsert(Species, list(objs.values()), ["speciesID"], ["species", "birdcode"])
+            rejected += len(objs) - len(written)
+            for obj in written:
+                if obj.speciesID in existing:
+                    updated += 1
+                else:
+                    inserted += 1
+                    existing.add(obj.speciesID)
+
+        return inserted, updated, rejected
+
+    # grid rows are upserted on OID; a row whose Grid_ID belongs to another OID is rejected
+    def bulk_load_grid(self, csvreader, chunkSize):
+        # Grid_ID of every OID and the other way around, kept up to date as chunks go in, so rows
+        # that would break the unique Grid_ID are caught before the upsert (MySQL would otherwise
+        # update the row holding that Grid_ID instead, as it upserts on any unique key)
+        gridIDs = dict(Grid.objects.values_list("OID", "Grid_ID"))
+        owners = {gridID: oid for oid, gridID in gridIDs.items()}
+        existing = set(gridIDs)
+        inserted = updated = rejected = conflicts = 0
+
+        for chunk in chunked(csvreader, chunkSize):
+            # keep the last row for every key in the chunk
+            objs = {}
+            for line in chunk:
+                try:
+                    obj = Grid(OID=int(line[0]), Grid_ID=line[1], Grid_E_NAD83=int(line[2]), Grid_N_NAD83=int(line[3]),
+                               UTM_Zone=int(line[4]), Grid_Lat_NAD83=float(line[5]), Grid_Long_NAD83=float(line[6]),
+                               BCR=int(line[7]), MgmtEntity=line[8], MgmtRegion=line[9], MgmtUnit=line[10],
+                               MgmtDistrict=line[11], County=line[12], State=line[13], PriorityLandscape=line[14],
+                               inPL=line[15].strip().lower() in ("1", "true", "t", "yes"))
+                except (ValueError, IndexError):
+                    rejected += 1
+                    continue
+                if owners.get(obj.Grid_ID, obj.OID) != obj.OID:
+                    conflicts += 1
+                    continue
+                # a repeated key in the same chunk replaces the earlier row
+                if obj.OID in objs:
+                    updated += 1
+                # the OID gives up its old Grid_ID
+                if obj.OID in gridIDs:
+                    owners.pop(gridIDs[obj.OID], None)
+                gridIDs[obj.OID] = obj.Grid_ID
+                owners[obj.Grid_ID] = obj.OID
+                objs[obj.OID] = obj
+
+            written = self.upsert(Grid, list(objs.values()), ["OID"], GRID_UPDATE_FIELDS)
+            writtenOIDs = {obj.OID for obj in written}
+            for obj in objs.values():
+                if obj.OID not in writtenOIDs:
+                    rejected += 1
+                elif obj.OID in existing:
+                    updated += 1
+                else:
+                    inserted += 1
+                    existing.add(obj.OID)
+            # rows the database refused left the maps ahead of it
+            if len(written) != len(objs):
+                gridIDs = dict(Grid.objects.values_list("OID", "Grid_ID"))
+                owners = {gridID: oid for oid, gridID in gridIDs.items()}
+
+        if conflicts:
+            self.stderr.write(f"Error: {conflicts} grid rows rejected, their Grid_ID belongs to another OID\n")
+        return inserted, updated, rejected + conflicts
+
+    # results rows are matched on their (species, grid) pair
+    def bulk_load_results(self, csvreader, chunkSize):
+        # the foreign keys are checked against these instead of querying per row
+        speciesKeys = set(Species.objects.values_list("id", flat=True))
+        gridKeys = set(Grid.objects.values_list("id", flat=True))
+        # (species, grid) pairs already in the database, used to count inserts and updates
+        existing = set(Results.objects.values_list("bird_speciesID_id", "gridID_id").iterator(chunk_size=chunkSize))
+        inserted = updated = rejected = 0
+
+        for chunk in chunked(csvreader, chunkSize):
+            # keep the last row for every key in the chunk
+            objs = {}
+            for line in chunk:
+                try:
+                    birdGrid = line[0].strip("psi[]").split(",")
+                    birdID = int(birdGrid[0])
+                    gridNum = int(birdGrid[1])
+                    obj = Results(bird_speciesID_id=birdID, gridID_id=gridNum, lbci=float(line[1]),
+                                  posterior_median=float(line[2]), ubci=float(line[3]))
+                except (ValueError, IndexError):
+                    rejected += 1
+                    continue
+                # reject rows pointing at species or grids that are not loaded
+                if birdID not in speciesKeys or gridNum not in gridKeys:
+                    rejected += 1
+                    continue
+                # a repeated key in the same chunk replaces the earlier row
+                if (birdID, gridNum) in objs:
+                    updated += 1
+                objs[(birdID, gridNum)] = obj
+
+            # the (species, grid) unique constraint lets the chunk go in as one upsert
+            written = self.upsert(Results, list(objs.values()), ["bird_speciesID", "gridID"], ["lbci", "posterior_median", "ubci"])
+            rejected += len(objs) - len(written)
+
+            for obj in written:
+                key = (obj.bird_speciesID_id, obj.gridID_id)
+                if key in existing:
+                    updated += 1
+                else:
+                    inserted += 1
+                    existing.add(key)
+
+        return inserted, updated, rejected
+
+    # writes one chunk as a single INSERT ... ON CONFLICT/ON DUPLICATE KEY UPDATE inside a transaction,
+    # returns the objects written
+    def upsert(self, model, objs, uniqueFields, updateFields):
+        if not objs:
+            return []
+        # MySQL upserts on any unique key and does not accept a conflict target
+        if not connection.features.supports_update_conflicts_with_target:
+            uniqueFields = None
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create(objs, update_conflicts=True, unique_fields=uniqueFields, update_fields=updateFields)
+            return objs
+        except IntegrityError:
+            pass
+
+        # a row broke another unique constraint (or a concurrent write got in first), so the chunk
+        # goes in row by row and only the rows the database refuses are left out
+        written = []
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create([obj], update_conflicts=True, unique_fields=uniqueFields, update_fields=updateFields)
+            except IntegrityError:
+                continue
+            written.append(obj)
+        return written
+
+
+# yields lists of up to size rows from an iterator
+def chunked(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
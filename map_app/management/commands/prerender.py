@@ -0,0 +1,137 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from map_app.heatmap import RENDER_PARAMS
+from map_app.models import Species
+from map_app.render_cache import META_NAME, render_cache, render_key
+from map_app.selection import format_species, grid_coordinates, parse_species
+
+# Grid coordinates of the worker process, loaded once by init_worker
+worker_coordinates = None
+
+
+# runs in every worker process before its first render
+def init_worker():
+    global worker_coordinates
+    import django
+    from django.apps import apps
+    # spawned workers start without Django; forked ones inherit it
+    if not apps.ready:
+        django.setup()
+    worker_coordinates = grid_coordinates()
+
+
+# renders one selection into the render cache, returns (status, seconds)
+def render_selection(species):
+    start = time.perf_counter()
+    key = render_key(species)
+    if render_cache.path(key, META_NAME) is not None:
+        return "cached", time.perf_counter() - start
+
+    from map_app.raster import selection_raster, write_overlay
+
+    # the raster the map view would composite or render on demand for this key
+    raster = selection_raster(species, coordinates=worker_coordinates)
+    if raster is None:
+        return "empty", time.perf_counter() - start
+
+    staging_dir = render_cache.new_staging_dir()
+    try:
+        write_overlay(staging_dir, *raster, RENDER_PARAMS['pixel_size'])
+    except BaseException:
+        render_cache.discard(staging_dir)
+        raise
+    # the command evicts once after the whole run instead of after every render
+    render_cache.commit(key, staging_dir, maintain=False)
+    return "rendered", time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = ('Render the filtered map of every species, and of any configured species groups, into the '
+            'render cache ahead of time across several processes; selections already cached are skipped')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                            help="Number of worker processes (default: one per CPU)")
+        parser.add_argument('--species', type=parse_species,
+                            help="Comma-separated speciesID values to render (default: every species)")
+        parser.add_argument('--group', type=parse_species, action='append', default=[],
+                            help="Comma-separated speciesID values rendered together as one selection; may be repeated. "
+                                 "FIREFLIGHT_PRERENDER_GROUPS adds groups from the settings")
+        parser.add_argument('--no-species', action='store_true',
+                            help="Only render the groups, not the single species")
+        parser.add_argument('--allow-eviction', action='store_true',
+                            help="Render even when there are more selections than the render cache keeps "
+                                 "(FIREFLIGHT_RENDER_CACHE_MAX_ENTRIES); the least recently used are evicted at the end")
+
+    def handle(self, *args, **kwargs):
+        if kwargs['jobs'] < 1:
+            raise CommandError("--jobs must be at least 1")
+
+        selections = self.selections(kwargs)
+        # a catalogue bigger than the cache would evict its own renders
+        if len(selections) > render_cache.max_entries and not kwargs['allow_eviction']:
+            raise CommandError(
+                f"{len(selections)} selections do not fit in the render cache, which keeps {render_cache.max_entries} "
+                f"entries; raise FIREFLIGHT_RENDER_CACHE_MAX_ENTRIES or pass --allow-eviction")
+
+        # entries from an interrupted run (or the site) are kept, so a rerun picks up where it stopped
+        pending = [species for species in selections if render_cache.path(render_key(species), META_NAME) is None]
+        self.stdout.write(f"{len(selections)} selections, {len(selections) - len(pending)} already cached, "
+                          f"{len(pending)} to render on {kwargs['jobs']} workers.")
+        if not pending:
+            return
+
+        # workers open their own database connections; a forked copy of ours must not be shared
+        connections.close_all()
+
+        counts = {"rendered": 0, "empty": 0, "failed": 0, "cached": 0}
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=kwargs['jobs'], initializer=init_worker) as executor:
+            futures = {executor.submit(render_selection, species): species for species in pending}
+            for done, future in enumerate(as_completed(futures), 1):
+                label = format_species(futures[future])
+                try:
+                    status, seconds = future.result()
+                except Exception as e:
+                    counts["failed"] += 1
+                    self.stdout.write(self.style.ERROR(f"[{done}/{len(pending)}] {label}: failed: {e}"))
+                    continue
+                counts[status] += 1
+                self.stdout.write(f"[{done}/{len(pending)}] {label}: {status} in {seconds:.2f}s")
+
+        # one eviction and sweep for the whole run
+        render_cache.evict()
+        render_cache.sweep()
+        evicted = sum(1 for species in selections if render_cache.path(render_key(species), META_NAME) is None)
+        if evicted > counts["empty"] + counts["failed"]:
+            self.stdout.write(self.style.WARNING(
+                f"{evicted - counts['empty'] - counts['failed']} selections were evicted to keep the render cache within "
+                f"its limits (FIREFLIGHT_RENDER_CACHE_MAX_ENTRIES, FIREFLIGHT_RENDER_CACHE_MAX_BYTES)."))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Prerendered {counts['rendered']} selections in {time.perf_counter() - start:.1f}s "
+            f"({counts['empty']} without results, {counts['failed']} failed) into {render_cache.root}."))
+        if counts["failed"]:
+            raise CommandError(f"{counts['failed']} selections failed to render")
+
+    # single-species selections followed by the groups, each a sorted list of speciesID values, without repeats
+    def selections(self, options):
+        selections = []
+        if not options['no_species']:
+            species_ids = options['species']
+            if species_ids is None:
+                species_ids = sorted(Species.objects.values_list('speciesID', flat=True))
+            selections.extend([species_id] for species_id in species_ids)
+
+        groups = list(options['group']) + [sorted({int(species_id) for species_id in group})
+                                           for group in getattr(settings, 'FIREFLIGHT_PRERENDER_GROUPS', [])]
+        selections.extend(group for group in groups if group)
+
+        unique = {}
+        for species in selections:
+            unique.setdefault(tuple(species), species)
+        return list(unique.values())
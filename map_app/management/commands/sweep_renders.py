@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from map_app.render_cache import render_cache
+
+class Command(BaseCommand):
+    help = 'Remove stale rendered maps and abandoned render staging directories'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=None,
+                            help="Remove renders unused for this many seconds (default FIREFLIGHT_ARTIFACT_MAX_AGE, one week)")
+        parser.add_argument('--staging-age', type=int, default=3600,
+                            help="Remove unfinished renders untouched for this many seconds")
+
+    def handle(self, *args, **kwargs):
+        removed = render_cache.sweep(kwargs['max_age'], kwargs['staging_age'])
+        self.stdout.write(self.style.SUCCESS(f'Removed {removed} stale render directories from {render_cache.root}.'))
@@ -0,0 +1,187 @@
+# The folium page every rendered map is shown in.
+#
+# The base map, Leaflet includes, legend, back button and layer control are the same for every
+# render, so they are built once into a static shell page. The shell reads ?render=<id> from its
+# own URL and fetches that render's overlay description from /overlay/<id>/, which makes a
+# new selection cost one PNG and a few bytes of JSON instead of a full folium document. Renders
+# carry several bands (median, credible bounds, interval width); the shell adds a layer for each
+# and switches between them in the browser. Clicking the map asks /probe/ what is at that point.
+
+import os
+import threading
+import uuid
+
+from .heatmap import TILE_MAX_ZOOM
+from .precompress import write_compressed
+from .render_cache import cache_root
+
+# bump when the shell's markup or script changes so a fresh copy is built
+SHELL_VERSION = 4
+
+_lock = threading.Lock()
+
+# Leaflet control that links back to the map page, hidden when the map is embedded
+BACK_BUTTON_SCRIPT = """
+    {% macro script(this, kwargs) %}
+        if (window.location.search.indexOf('embed') === -1) {
+            var backButton = L.control({position: 'topleft'});
+            backButton.onAdd = function(map) {
+                var div = L.DomUtil.create('div', 'leaflet-bar leaflet-control leaflet-control-custom');
+                div.innerHTML = '<a href="/map" title="Back" style="display: block; width: 50px; height: 50px; line-height: 50px; font-size: 24px; text-align: center; background: white; border: 2px solid rgba(0,0,0,0.2); border-radius: 4px;">&#8592;</a>';
+                return div;
+            };
+            backButton.addTo({{this._parent.get_name()}});
+        }
+    {% endmacro %}
+"""
+
+# loads the overlay of the render named in the page URL
+OVERLAY_SCRIPT = """
+    {% macro script(this, kwargs) %}
+        (function(map) {
+            var render = new URLSearchParams(window.location.search).get('render');
+            if (!render) {
+                return;
+            }
+            fetch('/overlay/' + encodeURIComponent(render) + '/')
+                .then(function(response) {
+                    if (!response.ok) {
+                        throw new Error('Overlay not found');
+                    }
+                    return response.json();
+                })
+                .then(function(overlay) {
+                    var bands = overlay.bands && overlay.bands.length ? overlay.bands : [overlay];
+                    var layers = {};
+                    bands.forEach(function(band, index) {
+                        var layer = band.tiles
+                            ? L.tileLayer(band.tiles, {opacity: 0.6, maxZoom: overlay.max_zoom, zIndex: 1})
+                            : L.imageOverlay(band.image, overlay.bounds, {opacity: 0.6, interactive: true, zIndex: 1});
+                        layers[band.label || 'Heatmap Overlay'] = layer;
+                        if (index === 0) {
+                            layer.addTo(map);
+                        }
+                    });
+                    // the bands are alternative views of one render, so they get radio buttons
+                    if (bands.length > 1) {
+                        L.control.layers(layers, null, {collapsed: false}).addTo(map);
+                    } else {
+                        L.control.layers(null, layers).addTo(map);
+                    }
+                })
+                .catch(function(error) {
+                    console.error(error);
+                });
+        })({{this._parent.get_name()}});
+    {% endmacro %}
+"""
+
+# shows the nearest grid and its likeliest species in a popup where the map is clicked
+PROBE_SCRIPT = """
+    {% macro script(this, kwargs) %}
+        (function(map) {
+            function text(value) {
+                var div = document.createElement('div');
+                div.textContent = value;
+                return div.innerHTML;
+            }
+            map.on('click', function(event) {
+                fetch('/probe/?lat=' + event.latlng.lat + '&lon=' + event.latlng.lng + '&max_distance=5000')
+                    .then(function(response) {
+                        return response.ok ? response.json() : null;
+                    })
+                    .then(function(probe) {
+                        if (!probe) {
+                            return;
+                        }
+                        var rows = probe.species.map(function(species) {
+                            return '<tr><td>' + text(species.species) + '</td><td>' + species.posterior_median.toFixed(2) +
+                                '</td><td>' + species.lbci.toFixed(2) + ' - ' + species.ubci.toFixed(2) + '</td></tr>';
+                        }).join('');
+                        L.popup()
+                            .setLatLng(event.latlng)
+                            .setContent('<b>' + text(probe.grid.Grid_ID) + '</b><br>' + text(probe.grid.MgmtUnit) + ', ' +
+                                text(probe.grid.MgmtDistrict) + '<table><tr><th>Species</th><th>Median</th><th>95% CI</th></tr>' +
+                                rows + '</table>')
+                            .openOn(map);
+                    })
+                    .catch(function(error) {
+                        console.error(error);
+                    });
+            });
+        })({{this._parent.get_name()}});
+    {% endmacro %}
+"""
+
+LEGEND_HTML = """
+<div style="
+    position: absolute;
+    bottom: 10px;
+    left: 10px;
+    width: 200px;
+    background-color: rgba(255, 255, 255, 0.8);
+    border: 2px solid grey;
+    z-index: 9999;
+    font-size: 14px;
+    padding: 10px;">
+    <div style="text-align: center; font-size: 12px; margin-bottom: 0;">
+        <b>Bird Species</b><br>
+        <b>Probablity of Occupancy</b>
+    </div>
+    <div style="height: 20px; background: linear-gradient(to right, #1f78b4, #ffffff, #ff7f00);"></div>
+    <div style="display: flex; justify-content: space-between;">
+        <div style="text-align: center;">
+            <div>Lowest</div>
+            <div>0</div>
+        </div>
+        <div style="text-align: center;">
+            <div>Highest</div>
+            <div>1.0</div>
+        </div>
+    </div>
+</div>
+"""
+
+
+def shell_path():
+    return os.path.join(cache_root(), f'map_shell-v{SHELL_VERSION}.html')
+
+
+# folium element that renders one of the script macros above; folium and jinja2 are only
+# imported once a map is actually built
+def script_element(source):
+    from branca.element import MacroElement
+    from jinja2 import Template
+
+    element = MacroElement()
+    element._template = Template(source)
+    return element
+
+
+# builds the shell page with folium
+def build_shell(outputPath):
+    import folium
+
+    m = folium.Map(location=[36.5, -105.5], zoom_start=9, max_zoom=TILE_MAX_ZOOM)
+    m.add_child(script_element(OVERLAY_SCRIPT))
+    m.add_child(script_element(BACK_BUTTON_SCRIPT))
+    m.add_child(script_element(PROBE_SCRIPT))
+    m.get_root().html.add_child(folium.Element(LEGEND_HTML))
+
+    # write through a temporary name so readers never see a partial page
+    os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+    tmpPath = f'{outputPath}.{uuid.uuid4().hex}.tmp'
+    m.save(tmpPath)
+    # the compressed copies land first, so the page is never served without them
+    write_compressed(tmpPath, outputPath)
+    os.replace(tmpPath, outputPath)
+
+
+# path of the shell page, building it on first use
+def get_shell():
+    outputPath = shell_path()
+    if not os.path.isfile(outputPath):
+        with _lock:
+            if not os.path.isfile(outputPath):
+                build_shell(outputPath)
+    return outputPath
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.5 on 2026-10-18 08:06
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+# keeps the most recently loaded row (highest id) for every duplicated (species, grid) pair
+def dedupe_results(apps, schema_editor):
+    Results = apps.get_model('map_app', 'Results')
+    duplicates = (Results.objects.values('bird_speciesID', 'gridID')
+                  .annotate(rows=Count('id'), keep=Max('id'))
+                  .filter(rows__gt=1))
+    for duplicate in duplicates.iterator():
+        (Results.objects
+         .filter(bird_speciesID=duplicate['bird_speciesID'], gridID=duplicate['gridID'])
+         .exclude(id=duplicate['keep'])
+         .delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_results, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='results',
+            index=models.Index(fields=['bird_speciesID', 'posterior_median', 'gridID'], name='results_species_median_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='results',
+            constraint=models.UniqueConstraint(fields=('bird_speciesID', 'gridID'), name='results_species_grid_unique'),
+        ),
+    ]
@@ -38,4 +38,13 @@ class Results(models.Model):
     lbci = models.FloatField()
     posterior_median = models.FloatField()
     ubci = models.FloatField()
-    
\ No newline at end of file
+    
+
+    # one result per species and grid; the second index covers species -> posterior_median reads
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bird_speciesID', 'gridID'], name='results_species_grid_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['bird_speciesID', 'posterior_median', 'gridID'], name='results_species_median_idx'),
+        ]
@@ -0,0 +1,86 @@
+# Precompressed siblings of generated text artifacts.
+#
+# Pages like the map shell are written once and served many times, so they are compressed when
+# they are written instead of on every request: <file>.gz always, and <file>.br when the optional
+# brotli package is installed. The views pick the smallest sibling the client accepts and send it
+# with Content-Encoding. Images are left alone, the overlay PNGs are already deflate-compressed.
+
+import gzip
+import os
+import uuid
+
+# content codings in order of preference, with the suffix of their sibling file
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def brotli_module():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def compress(data, encoding):
+    if encoding == "gzip":
+        # no timestamp in the header, so the same page always compresses to the same bytes
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == "br":
+        return brotli_module().compress(data)
+    raise ValueError(f"Unknown content coding '{encoding}'")
+
+
+def write_compressed(source, target=None):
+    """
+    Writes the compressed siblings of the file at source as target.gz (and
+    target.br when brotli is installed), each through a temporary name. target
+    defaults to source; pass the final name when source is a temporary file
+    that is renamed into place afterwards. Returns the paths written.
+    """
+    target = target or source
+    with open(source, 'rb') as sourceFile:
+        data = sourceFile.read()
+
+    written = []
+    for encoding, suffix in ENCODINGS:
+        if encoding == "br" and brotli_module() is None:
+            continue
+        outputPath = target + suffix
+        tmpPath = f'{outputPath}.{uuid.uuid4().hex}.tmp'
+        with open(tmpPath, 'wb') as outputFile:
+            outputFile.write(compress(data, encoding))
+        os.replace(tmpPath, outputPath)
+        written.append(outputPath)
+    return written
+
+
+# {content coding: quality} from an Accept-Encoding header
+def encoding_qualities(header):
+    qualities = {}
+    for item in (header or "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip():
+            qualities[name.strip().lower()] = quality
+    return qualities
+
+
+def compressed_variant(path, header):
+    """
+    Picks the file to send for path given the request's Accept-Encoding header.
+    Returns (path, content coding), with None as the coding when the plain file
+    is sent because the client accepts no sibling that exists.
+    """
+    qualities = encoding_qualities(header)
+    for encoding, suffix in ENCODINGS:
+        # a coding not listed is allowed by "*" unless that has q=0
+        if qualities.get(encoding, qualities.get("*", 0)) > 0 and os.path.isfile(path + suffix):
+            return path + suffix, encoding
+    return path, None
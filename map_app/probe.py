@@ -0,0 +1,83 @@
+# Nearest-grid lookups for the map's click-to-inspect probe.
+#
+# A KD-tree over every grid's location is built once per data version and kept in the process,
+# along with the grid attributes the probe reports, so a click costs one tree query instead of a
+# scan of the Grid table. Locations are projected onto a local plane (longitude scaled by the
+# cosine of the grid's mean latitude) so distances in the tree are proportional to metres across
+# the study area.
+
+import math
+import threading
+
+from .render_cache import data_version
+
+# metres per degree of latitude
+METRES_PER_DEGREE = 111320.0
+
+# grid columns returned with a probe
+GRID_FIELDS = ("id", "OID", "Grid_ID", "Grid_Lat_NAD83", "Grid_Long_NAD83", "BCR", "MgmtEntity", "MgmtRegion",
+               "MgmtUnit", "MgmtDistrict", "County", "State", "PriorityLandscape", "inPL")
+
+
+class GridIndex:
+    def __init__(self, grids, version=None):
+        import numpy as np
+        from scipy.spatial import cKDTree
+
+        self.version = version
+        self.grids = grids
+        latitudes = np.array([grid["Grid_Lat_NAD83"] for grid in grids], dtype=np.float64)
+        longitudes = np.array([grid["Grid_Long_NAD83"] for grid in grids], dtype=np.float64)
+        self.scale = math.cos(math.radians(float(latitudes.mean()))) if grids else 1.0
+        self.tree = cKDTree(np.column_stack([longitudes * self.scale, latitudes])) if grids else None
+
+    # (grid attributes, distance in metres) of the grid nearest to a point, or None without grids
+    def nearest(self, latitude, longitude):
+        if self.tree is None:
+            return None
+        distance, index = self.tree.query((longitude * self.scale, latitude))
+        return self.grids[int(index)], float(distance) * METRES_PER_DEGREE
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def load_index(version=None):
+    from .models import Grid
+
+    return GridIndex(list(Grid.objects.order_by("id").values(*GRID_FIELDS)), version)
+
+
+# the index for the current data version, rebuilt after the database changes
+def grid_index():
+    global _index
+    version = data_version()
+    index = _index
+    if index is None or index.version != version:
+        with _lock:
+            if _index is None or _index.version != version:
+                _index = load_index(version)
+            index = _index
+    return index
+
+
+def top_species(gridID, limit):
+    """
+    Lists the species with the highest posterior median at a grid, best first, as
+    dicts with the speciesID, name, bird code, posterior median and credible bounds.
+    """
+    from .models import Results
+
+    rows = (Results.objects.filter(gridID=gridID)
+            .order_by("-posterior_median", "bird_speciesID__speciesID")
+            .values_list("bird_speciesID__speciesID", "bird_speciesID__species", "bird_speciesID__birdcode",
+                         "posterior_median", "lbci", "ubci")[:limit])
+    return [{
+        "species_id": speciesID,
+        "species": species,
+        "birdcode": birdcode,
+        "posterior_median": median,
+        "lbci": lbci,
+        "ubci": ubci,
+    } for speciesID, species, birdcode, median, lbci, ubci in rows]
@@ -0,0 +1,243 @@
+# NumPy helpers shared by the heatmap management commands and the render views.
+
+import numpy as np
+
+from .heatmap import AGGREGATIONS, RENDER_PARAMS
+from .timing import stage
+
+# How per-grid aggregates (see selection.grid_values) of grids sharing a raster cell are combined
+# so the cell gets the same value as aggregating every result in it. Means are weighted by the
+# number of results behind them instead (see rasterize_grids).
+GRID_COMBINE = {
+    "sum": "sum",
+    "max": "max",
+    "presence": "presence",
+    "richness": "sum",
+}
+
+
+def rasterize(latitudes, longitudes, values, pixel_size, aggregate="sum", extent=None, threshold=None):
+    """
+    Bins point values into a north-up raster covering the extent of the points,
+    combining values that share a cell with the given aggregation. Pass extent as
+    (min_lat, max_lat, min_lon, max_lon) to lay the raster out over a fixed area
+    instead, so rasters of different point sets line up cell for cell. threshold
+    is the "richness" cutoff and defaults to RENDER_PARAMS["richness_threshold"].
+    values may also be an (n, bands) array, which bins every band from the same
+    cell indexes into a (bands, rows, cols) raster.
+
+    Returns the float32 raster plus the longitude of its west edge and the
+    latitude of its north edge, for building the raster transform.
+    """
+    if aggregate not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation '{aggregate}', expected one of {', '.join(AGGREGATIONS)}")
+
+    lats = np.asarray(latitudes, dtype=np.float64)
+    lons = np.asarray(longitudes, dtype=np.float64)
+    vals = np.asarray(values, dtype=np.float64)
+
+    # Define raster grid parameters.
+    if extent is None:
+        extent = (lats.min(), lats.max(), lons.min(), lons.max())
+    min_lat, max_lat, min_lon, max_lon = extent
+    nrows = int((max_lat - min_lat) / pixel_size) + 1
+    ncols = int((max_lon - min_lon) / pixel_size) + 1
+
+    # Compute every point's cell in one pass.
+    rows = ((max_lat - lats) / pixel_size).astype(np.intp)
+    cols = ((lons - min_lon) / pixel_size).astype(np.intp)
+    inside = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+    cells = rows[inside] * ncols + cols[inside]
+
+    if threshold is None:
+        threshold = RENDER_PARAMS["richness_threshold"]
+    if vals.ndim == 1:
+        raster_data = aggregate_cells(cells, vals[inside], nrows * ncols, aggregate, threshold)
+        return raster_data.reshape(nrows, ncols).astype(np.float32), min_lon, max_lat
+
+    raster_data = np.empty((vals.shape[1], nrows, ncols), dtype=np.float32)
+    for band in range(vals.shape[1]):
+        raster_data[band] = aggregate_cells(cells, vals[inside, band], nrows * ncols, aggregate, threshold).reshape(nrows, ncols)
+    return raster_data, min_lon, max_lat
+
+
+def rasterize_grids(latitudes, longitudes, values, counts, pixel_size, aggregate="sum", extent=None):
+    """
+    Rasterizes per-grid aggregates, one value per grid plus the number of results
+    it was aggregated from, into the raster rasterize() would build from the
+    results themselves. Returns the raster, west edge and north edge.
+    """
+    if aggregate not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation '{aggregate}', expected one of {', '.join(AGGREGATIONS)}")
+
+    if aggregate != "mean":
+        return rasterize(latitudes, longitudes, values, pixel_size, GRID_COMBINE[aggregate], extent)
+
+    # mean of the cell = total of the results / number of results
+    counts = np.asarray(counts, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    weights = counts if values.ndim == 1 else counts[:, None]
+    totals, west, north = rasterize(latitudes, longitudes, values * weights, pixel_size, "sum", extent)
+    numbers, _, _ = rasterize(latitudes, longitudes, counts, pixel_size, "sum", extent)
+    return np.divide(totals, numbers, out=np.zeros_like(totals), where=numbers > 0), west, north
+
+
+def add_width(bands):
+    """
+    Appends the interval width band (ubci - lbci) to a (median, lbci, ubci) band
+    raster, giving the raster of every band in heatmap.BANDS.
+    """
+    return np.concatenate([bands, bands[2:3] - bands[1:2]])
+
+
+def smooth(raster_data, sigma):
+    """
+    Gaussian-smooths a raster, or every band of a (bands, rows, cols) raster in
+    one pass without blurring across bands.
+    """
+    from scipy.ndimage import gaussian_filter
+
+    if raster_data.ndim == 3:
+        sigma = (0, sigma, sigma)
+    return gaussian_filter(raster_data, sigma=sigma)
+
+
+def build_raster(latitudes, longitudes, values, counts=None, aggregate=None, extent=None,
+                 pixel_size=None, sigma=None, multiplier=None):
+    """
+    Builds a heatmap raster from (median, lbci, ubci) point values: per-grid
+    aggregates with their result counts (see selection.grid_values), or one value
+    per result when counts is None. The bands are rasterized over extent (the
+    points' own when None), smoothed in one pass, extended with the interval width
+    band and scaled. pixel_size, sigma and multiplier default to RENDER_PARAMS.
+    Returns the (bands, rows, cols) raster, west edge and north edge.
+    """
+    aggregate = aggregate or RENDER_PARAMS["aggregate"]
+    pixel_size = pixel_size or RENDER_PARAMS["pixel_size"]
+    sigma = RENDER_PARAMS["sigma"] if sigma is None else sigma
+    multiplier = RENDER_PARAMS["multiplier"] if multiplier is None else multiplier
+
+    # Rasterize every band from the same cell indexes, combining points that share a cell.
+    with stage("rasterize"):
+        if counts is not None:
+            raster_data, west, north = rasterize_grids(latitudes, longitudes, values, counts, pixel_size, aggregate, extent)
+        else:
+            raster_data, west, north = rasterize(latitudes, longitudes, values, pixel_size, aggregate, extent)
+
+    import scipy.ndimage  # loaded here so the gaussian_filter stage only times the filter
+    with stage("gaussian_filter"):
+        raster_data = smooth(raster_data, sigma)
+    # Derive the interval width band from the smoothed bounds
+    return add_width(raster_data) * multiplier, west, north
+
+
+def selection_raster(species_ids, aggregate=None, coordinates=None, stack_only=False):
+    """
+    Builds the heatmap raster of a species selection (speciesID values) the way
+    it is stored under its render_key, whichever path renders it: summed from the
+    raster stack when the map is a sum and the stack is current, otherwise
+    aggregated per grid in the database and laid out over the whole grid like the
+    stack. coordinates (from selection.grid_coordinates) saves the join to Grid.
+    With stack_only the database is not read and None is returned instead.
+    Returns (raster, west, north), or None when the selection has no results.
+    """
+    from .raster_stack import composite
+    from .selection import grid_extent, grid_values
+
+    aggregate = aggregate or RENDER_PARAMS["aggregate"]
+    if aggregate == "sum":
+        with stage("composite"):
+            composited = composite(species_ids)
+        if composited is not None:
+            return composited[:3]
+    if stack_only:
+        return None
+
+    # One GROUP BY query over the selection, one row per grid
+    with stage("read_data"):
+        latitudes, longitudes, values, counts = grid_values(aggregate, species_ids, coordinates=coordinates)
+        extent = grid_extent(coordinates)
+    if not latitudes:
+        return None
+    return build_raster(latitudes, longitudes, values, counts, aggregate, extent)
+
+
+def aggregate_cells(cells, values, size, aggregate, threshold=0.5):
+    """
+    Combines values by flat cell index into an array of length size. Cells with
+    no values are 0.
+    """
+    if aggregate == "sum":
+        return np.bincount(cells, weights=values, minlength=size)
+
+    if aggregate == "mean":
+        sums = np.bincount(cells, weights=values, minlength=size)
+        counts = np.bincount(cells, minlength=size)
+        return np.divide(sums, counts, out=np.zeros(size), where=counts > 0)
+
+    if aggregate == "max":
+        out = np.full(size, -np.inf)
+        np.maximum.at(out, cells, values)
+        out[np.isneginf(out)] = 0
+        return out
+
+    if aggregate == "richness":
+        return np.bincount(cells, weights=(values >= threshold).astype(np.float64), minlength=size)
+
+    # presence: multiply the absence probabilities as a sum of logs
+    with np.errstate(divide="ignore"):
+        log_absent = np.log1p(-np.clip(values, 0, 1))
+    return 1 - np.exp(np.bincount(cells, weights=log_absent, minlength=size))
+
+
+def write_overlay(output_dir, raster_data, west, north, pixel_size, geotiff=False):
+    """
+    Writes a finished (smoothed and scaled) raster as a render's overlay files:
+    heatmap_raster.npy with the raster for the tile server, the colored
+    heatmap_raster.png stretched over the 5th to 95th percentile, and
+    heatmap_raster.json with the overlay bounds, that range and the raster's
+    west/north edges and pixel size. A (bands, rows, cols) raster holds the bands
+    of heatmap.BANDS in order; the first is written under the plain names and
+    every other band gets its own .npy and .png (see heatmap.band_file), with
+    the color range of each band recorded under "bands". The metadata is written
+    last, so its presence means the overlay is complete. With geotiff the raster
+    is also exported as heatmap_raster.tif, one GeoTIFF band per band. Returns
+    the overlay bounds.
+    """
+    import json
+    import os
+    from .colorize import colorize
+    from .heatmap import BANDS, band_file
+
+    raster_data = np.asarray(raster_data, dtype=np.float32)
+    bands = raster_data if raster_data.ndim == 3 else raster_data[None]
+    nrows, ncols = bands.shape[1:]
+
+    ranges = {}
+    for band, data in zip(BANDS, bands):
+        np.save(os.path.join(output_dir, band_file('heatmap_raster.npy', band)), data)
+        ranges[band] = list(colorize(data, os.path.join(output_dir, band_file('heatmap_raster.png', band))))
+
+    if geotiff:
+        import rasterio
+        from rasterio.transform import from_origin
+
+        with rasterio.open(
+            os.path.join(output_dir, 'heatmap_raster.tif'), 'w', driver='GTiff',
+            height=nrows, width=ncols, count=len(bands), dtype='float32',
+            crs='+proj=latlong', transform=from_origin(west, north, pixel_size, pixel_size)
+        ) as dst:
+            dst.write(bands)
+            dst.descriptions = BANDS[:len(bands)]
+
+    bounds = [[north - nrows * pixel_size, west], [north, west + ncols * pixel_size]]
+    with open(os.path.join(output_dir, 'heatmap_raster.json'), 'w') as meta_file:
+        json.dump({
+            'bounds': bounds,
+            'range': ranges[BANDS[0]],
+            'bands': ranges,
+            'west': float(west),
+            'north': float(north),
+            'pixel_size': float(pixel_size),
+        }, meta_file)
+    return bounds
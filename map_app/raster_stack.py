@@ -0,0 +1,200 @@
+# Precomputed per-species smoothed rasters for compositing filtered maps.
+#
+# Gaussian smoothing and the intensity multiplier are linear, so the "sum" heatmap of any species
+# selection equals the sum of every selected species' own smoothed raster, as long as all of them
+# share one extent. The build_raster_stack command rasterizes and smooths the median, lbci and ubci
+# bands of each species once over the extent of the whole grid and stores the layers as one
+# species x bands x rows x cols float32 .npy file. The views open it with mmap_mode='r', so every worker process shares the same pages, and
+# a filtered map becomes a sum over the selected layers with no database scan.
+#
+# The stack records the data version it was built from and is ignored once the database changes.
+# A rebuild reuses the layers of species whose results did not change.
+
+import hashlib
+import json
+import os
+import time
+import uuid
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+
+from .heatmap import RENDER_PARAMS
+from .render_cache import data_version
+from .raster import add_width, rasterize, smooth
+from .selection import BAND_FIELDS
+
+META_NAME = 'stack.json'
+STACK_PREFIX = 'stack-'
+
+
+def stack_dir():
+    return getattr(settings, 'FIREFLIGHT_RASTER_STACK_DIR', os.path.join(settings.BASE_DIR, 'raster_stack'))
+
+
+# the render parameters a stack layer depends on
+def stack_params():
+    return {"sigma": RENDER_PARAMS["sigma"], "pixel_size": RENDER_PARAMS["pixel_size"], "bands": list(BAND_FIELDS)}
+
+
+def read_meta(directory=None):
+    try:
+        with open(os.path.join(directory or stack_dir(), META_NAME)) as metaFile:
+            return json.load(metaFile)
+    except (OSError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=2)
+def open_layers(path, mtime):
+    return np.load(path, mmap_mode='r')
+
+
+# (meta, layers) of the current stack, or None if there is none or it is out of date
+def load_stack():
+    meta = read_meta()
+    if meta is None or meta.get("data_version") != data_version() or meta.get("params") != stack_params():
+        return None
+    path = os.path.join(stack_dir(), meta["file"])
+    try:
+        return meta, open_layers(path, os.path.getmtime(path))
+    except (OSError, ValueError):
+        return None
+
+
+def composite(speciesIDs):
+    """
+    Sums the stack layers of the selected species (speciesID values) into the
+    scaled (bands, rows, cols) heatmap raster, interval width band included.
+    Returns (raster, west, north, pixel_size), or None when the stack is missing,
+    out of date, or holds none of the species.
+    """
+    loaded = load_stack()
+    if loaded is None:
+        return None
+    meta, layers = loaded
+
+    positions = {speciesID: index for index, speciesID in enumerate(meta["species"])}
+    indexes = sorted({positions[int(speciesID)] for speciesID in speciesIDs if int(speciesID) in positions})
+    if not indexes:
+        return None
+
+    # accumulate layer by layer so only the selected pages are read
+    raster = np.zeros(layers.shape[1:], dtype=np.float32)
+    for index in indexes:
+        raster += layers[index]
+    raster = add_width(raster) * RENDER_PARAMS["multiplier"]
+    return raster, meta["west"], meta["north"], meta["params"]["pixel_size"]
+
+
+def build_stack(full=False):
+    """
+    Builds the stack from the database, reusing unchanged layers of the previous
+    stack unless full is set. Returns (layers, rebuilt layers, seconds).
+    """
+    from django.db import transaction
+    from .models import Grid, Results
+
+    start = time.perf_counter()
+    directory = stack_dir()
+    os.makedirs(directory, exist_ok=True)
+    version = data_version()
+    params = stack_params()
+    pixelSize = params["pixel_size"]
+
+    # grid coordinates indexed by grid id, and the extent every layer shares
+    grids = list(Grid.objects.order_by("id").values_list("id", "Grid_Lat_NAD83", "Grid_Long_NAD83"))
+    if not grids:
+        raise ValueError("There are no grids to build the raster stack from")
+    gridIDs, lats, lons = (np.array(column) for column in zip(*grids))
+    latByID = np.zeros(gridIDs.max() + 1)
+    lonByID = np.zeros(gridIDs.max() + 1)
+    latByID[gridIDs] = lats
+    lonByID[gridIDs] = lons
+    extent = (float(lats.min()), float(lats.max()), float(lons.min()), float(lons.max()))
+    gridDigest = hashlib.sha256(np.stack([gridIDs, lats, lons]).tobytes()).hexdigest()
+
+    # layers of the previous stack can be copied if the grid and parameters are unchanged
+    old = None if full else read_meta(directory)
+    oldLayers = None
+    if old is not None and old.get("params") == params and old.get("grid_digest") == gridDigest:
+        try:
+            oldLayers = np.load(os.path.join(directory, old["file"]), mmap_mode='r')
+        except (OSError, ValueError):
+            oldLayers = None
+    oldPositions = {speciesID: index for index, speciesID in enumerate(old["species"])} if oldLayers is not None else {}
+
+    # read the species count and the rows from one snapshot
+    with transaction.atomic():
+        speciesCount = Results.objects.values("bird_speciesID").distinct().count()
+        nrows = int((extent[1] - extent[0]) / pixelSize) + 1
+        ncols = int((extent[3] - extent[2]) / pixelSize) + 1
+        fileName = f"{STACK_PREFIX}{uuid.uuid4().hex}.npy"
+        layers = np.lib.format.open_memmap(os.path.join(directory, fileName), mode='w+', dtype=np.float32,
+                                           shape=(speciesCount, len(BAND_FIELDS), nrows, ncols))
+
+        species, digests = [], {}
+        rebuilt = 0
+
+        def addLayer(speciesID, gridList, valueList):
+            nonlocal rebuilt
+            index = len(species)
+            gridArray = np.array(gridList, dtype=np.int64)
+            valueArray = np.array(valueList, dtype=np.float64)
+            digest = hashlib.sha256(gridArray.tobytes() + valueArray.tobytes()).hexdigest()
+
+            oldIndex = oldPositions.get(speciesID)
+            if oldIndex is not None and old["digests"].get(str(speciesID)) == digest:
+                layers[index] = oldLayers[oldIndex]
+            else:
+                raster, _, _ = rasterize(latByID[gridArray], lonByID[gridArray], valueArray, pixelSize, "sum", extent)
+                layers[index] = smooth(raster, params["sigma"])
+                rebuilt += 1
+            species.append(speciesID)
+            digests[str(speciesID)] = digest
+
+        # one pass over Results in (species, grid) order, a layer per species; ordering on the
+        # foreign key columns themselves, since ordering by the relation would sort by species
+        # name (Species.Meta.ordering) and interleave species that share a name
+        rows = (Results.objects.order_by("bird_speciesID_id", "gridID_id")
+                .values_list("bird_speciesID__speciesID", "gridID_id", *BAND_FIELDS.values())
+                .iterator(chunk_size=10000))
+        current, gridList, valueList = None, [], []
+        for speciesID, gridID, *values in rows:
+            if speciesID != current:
+                if current is not None:
+                    addLayer(current, gridList, valueList)
+                current, gridList, valueList = speciesID, [], []
+            gridList.append(gridID)
+            valueList.append(values)
+        if current is not None:
+            addLayer(current, gridList, valueList)
+    layers.flush()
+    del layers
+
+    meta = {
+        "file": fileName,
+        "data_version": version,
+        "params": params,
+        "grid_digest": gridDigest,
+        "west": extent[2],
+        "north": extent[1],
+        "shape": [len(species), len(BAND_FIELDS), nrows, ncols],
+        "species": species,
+        "digests": digests,
+    }
+    tmpPath = os.path.join(directory, f".{META_NAME}.{uuid.uuid4().hex}")
+    with open(tmpPath, 'w') as metaFile:
+        json.dump(meta, metaFile)
+    os.replace(tmpPath, os.path.join(directory, META_NAME))
+
+    # workers still mapping an old file keep their pages until they reopen
+    for name in os.listdir(directory):
+        if name.startswith(STACK_PREFIX) and name != fileName:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    return len(species), rebuilt, time.perf_counter() - start
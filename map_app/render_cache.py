@@ -0,0 +1,312 @@
+# Content-addressed store of rendered heatmaps.
+#
+# Every render writes into its own staging directory and is renamed into place as
+# <root>/<render id>/ once complete, so concurrent renders never share a file and readers never
+# see a half-written map. For filtered maps the render id is a hash of the sorted species
+# selection, the render parameters and the current data-version stamp, which makes the store a
+# cache: a repeat selection finds its finished directory. The full-database map is keyed the same
+# way by full_map_key(), and FULL_MAP_NAME points at the newest one so it can still be shown while
+# the map for a new data version is being built. An entry holds the overlay raster (.npy)
+# and PNG plus heatmap_raster.json with the overlay bounds and color range; the page around it is
+# the shared map shell (see map_shell.py). The least recently used entries are evicted once the
+# store grows past its entry or byte limit, and sweep() clears out abandoned staging
+# directories and entries nobody has used for a while.
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from .heatmap import RENDER_PARAMS
+
+# files kept for every render
+PNG_NAME = 'heatmap_raster.png'
+RASTER_NAME = 'heatmap_raster.npy'
+HTML_NAME = 'enchanted_circle_map.html'
+META_NAME = 'heatmap_raster.json'
+
+# render ids are used as directory names, so only these characters are accepted
+RENDER_ID = re.compile(r'^[0-9A-Za-z_-]+$')
+
+STAGING_PREFIX = '.staging-'
+
+# name of the stamp file that changes whenever the database is repopulated
+VERSION_NAME = 'data_version'
+
+# name of the file holding the render id of the newest finished full-database map
+FULL_MAP_NAME = 'full_map'
+
+
+def cache_root():
+    return getattr(settings, 'FIREFLIGHT_RENDER_CACHE_DIR', os.path.join(settings.BASE_DIR, 'render_cache'))
+
+
+#####################################################
+#                Data version stamp                 #
+#####################################################
+
+# returns the current data-version stamp ("0" until the database is first populated)
+def data_version():
+    try:
+        with open(os.path.join(cache_root(), VERSION_NAME)) as stampFile:
+            return stampFile.read().strip() or "0"
+    except OSError:
+        return "0"
+
+
+# when the data-version stamp was last written (seconds since the epoch), or None before the
+# first populate
+def data_version_time():
+    try:
+        return os.path.getmtime(os.path.join(cache_root(), VERSION_NAME))
+    except OSError:
+        return None
+
+
+# atomically replaces one of the small stamp files in the cache root
+def write_stamp(name, value):
+    root = cache_root()
+    os.makedirs(root, exist_ok=True)
+    tmpPath = os.path.join(root, f".{name}.{uuid.uuid4().hex}")
+    with open(tmpPath, 'w') as stampFile:
+        stampFile.write(value)
+    os.replace(tmpPath, os.path.join(root, name))
+
+
+# writes a new data-version stamp, invalidating every cached render
+def bump_data_version():
+    stamp = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+    write_stamp(VERSION_NAME, stamp)
+    return stamp
+
+
+# canonical cache key for a species selection
+def render_key(speciesIDs, params=None, version=None):
+    payload = {
+        "species": sorted({int(speciesID) for speciesID in speciesIDs}),
+        "params": RENDER_PARAMS if params is None else params,
+        "data_version": data_version() if version is None else version,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+# render id of the full-database map for a data version
+def full_map_key(params=None, version=None):
+    payload = {
+        "params": RENDER_PARAMS if params is None else params,
+        "data_version": data_version() if version is None else version,
+    }
+    return "full-" + hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+# render id of the newest finished full-database map, which may be for an older data version
+def latest_full_map():
+    try:
+        with open(os.path.join(cache_root(), FULL_MAP_NAME)) as stampFile:
+            return stampFile.read().strip() or None
+    except OSError:
+        return None
+
+
+def set_latest_full_map(key):
+    write_stamp(FULL_MAP_NAME, key)
+
+
+#####################################################
+#                   Render cache                    #
+#####################################################
+
+# bytes of every file under an entry, the tiles cut from it included
+def entry_size(entryDir):
+    size = 0
+    for dirPath, _, fileNames in os.walk(entryDir):
+        for fileName in fileNames:
+            try:
+                size += os.path.getsize(os.path.join(dirPath, fileName))
+            except OSError:
+                # removed while walking (eviction or a tile being replaced)
+                pass
+    return size
+
+
+class RenderCache:
+    def __init__(self, root=None, max_entries=None, max_bytes=None):
+        self._root = root
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # settings are read lazily so the module can be imported before Django is configured
+    @property
+    def root(self):
+        return self._root or cache_root()
+
+    @property
+    def max_entries(self):
+        if self._max_entries is not None:
+            return self._max_entries
+        return getattr(settings, 'FIREFLIGHT_RENDER_CACHE_MAX_ENTRIES', 200)
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return getattr(settings, 'FIREFLIGHT_RENDER_CACHE_MAX_BYTES', 500 * 1024 * 1024)
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    # returns the cached entry for key (paths plus bounds) or None, and counts the hit/miss;
+    # for the render lookups of a selection, so the counters size the cache
+    def get(self, key):
+        entry = self.meta(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    # returns the cached entry for key like get(), without counting it as a lookup
+    def meta(self, key):
+        if not key or not RENDER_ID.match(key):
+            return None
+        entryDir = self.entry_dir(key)
+        metaPath = os.path.join(entryDir, META_NAME)
+        try:
+            with open(metaPath) as metaFile:
+                meta = json.load(metaFile)
+            # touch the entry so it counts as recently used
+            os.utime(metaPath)
+        except (OSError, ValueError):
+            return None
+
+        return {
+            "key": key,
+            "png": os.path.join(entryDir, PNG_NAME),
+            "html": os.path.join(entryDir, HTML_NAME),
+            "bounds": meta.get("bounds"),
+            "range": meta.get("range"),
+            "bands": meta.get("bands"),
+        }
+
+    # path of a file in a finished entry, or None if the entry or file does not exist
+    def path(self, key, name):
+        if not key or not RENDER_ID.match(key):
+            return None
+        filePath = os.path.join(self.entry_dir(key), name)
+        return filePath if os.path.isfile(filePath) else None
+
+    # creates an empty private directory for a render to write into
+    def new_staging_dir(self):
+        os.makedirs(self.root, exist_ok=True)
+        stagingDir = os.path.join(self.root, f"{STAGING_PREFIX}{uuid.uuid4().hex}")
+        os.makedirs(stagingDir)
+        return stagingDir
+
+    # atomically publishes a finished staging directory as the entry for key; batch writers pass
+    # maintain=False and call evict() and sweep() once at the end, since both walk every entry
+    def commit(self, key, stagingDir, maintain=True):
+        if not RENDER_ID.match(key):
+            raise ValueError(f"Invalid render id '{key}'")
+        try:
+            os.rename(stagingDir, self.entry_dir(key))
+        except OSError:
+            # another worker published the same key first, keep theirs
+            shutil.rmtree(stagingDir, ignore_errors=True)
+
+        if maintain:
+            self.evict()
+            self.sweep()
+        return self.entry_dir(key)
+
+    # throws away a staging directory after a failed render
+    def discard(self, stagingDir):
+        shutil.rmtree(stagingDir, ignore_errors=True)
+
+    # removes entries untouched for more than maxAge seconds and staging directories
+    # abandoned for more than stagingAge seconds
+    def sweep(self, maxAge=None, stagingAge=3600):
+        if maxAge is None:
+            maxAge = getattr(settings, 'FIREFLIGHT_ARTIFACT_MAX_AGE', 7 * 24 * 3600)
+        now = time.time()
+        removed = 0
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return removed
+
+        for name in names:
+            entryDir = os.path.join(self.root, name)
+            if not os.path.isdir(entryDir):
+                continue
+            # staging directories are dated by their last write, entries by their last use
+            if name.startswith(STAGING_PREFIX):
+                age = now - os.path.getmtime(entryDir)
+                stale = age > stagingAge
+            else:
+                metaPath = os.path.join(entryDir, META_NAME)
+                age = now - (os.path.getmtime(metaPath) if os.path.isfile(metaPath) else os.path.getmtime(entryDir))
+                stale = age > maxAge
+            if stale:
+                shutil.rmtree(entryDir, ignore_errors=True)
+                removed += 1
+        return removed
+
+    # lists (last used time, size in bytes including cached tiles, path) for every entry
+    def entries(self):
+        found = []
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return found
+
+        for name in names:
+            entryDir = os.path.join(self.root, name)
+            metaPath = os.path.join(entryDir, META_NAME)
+            if name.startswith('.') or not os.path.isfile(metaPath):
+                continue
+            size = entry_size(entryDir)
+            found.append((os.path.getmtime(metaPath), size, entryDir))
+        return found
+
+    # removes least recently used entries until the cache is within its limits
+    def evict(self):
+        found = sorted(self.entries())
+        count = len(found)
+        total = sum(size for _, size, _ in found)
+        for _, size, entryDir in found:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            shutil.rmtree(entryDir, ignore_errors=True)
+            count -= 1
+            total -= size
+
+    # hit/miss counters for this process plus the current size of the cache
+    def stats(self):
+        found = self.entries()
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": len(found),
+            "bytes": sum(size for _, size, _ in found),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "data_version": data_version(),
+        }
+
+
+# cache shared by the views in this process
+render_cache = RenderCache()
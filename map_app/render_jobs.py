@@ -0,0 +1,363 @@
+# Background render jobs for the filtered map.
+#
+# A filter submission enqueues a RenderJob and returns straight away with its ID. Jobs run on
+# a small thread pool, each one driving the render management commands as subprocesses, so a
+# job can be timed out or cancelled by killing its current command. Every client has at most
+# one live job: submitting a new selection cancels the one it replaces. The full-database map is
+# rebuilt by the same queue under its own client, one rebuild at a time.
+#
+# Jobs run in the process that accepted them, but their state is shared through the render cache
+# root so any worker can answer for them: every job keeps a small <jobs>/<job id>.json record
+# (replaced atomically like the stamp files) and every client a record of its latest job. A newer
+# selection accepted by another worker cancels the older job by dropping a <job id>.cancel marker,
+# which the owning worker checks while the job waits on its render command. A job whose record
+# stops changing long past its timeout belonged to a worker that was restarted and is reported
+# as failed.
+
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+from .render_cache import cache_root
+from .timing import command_errors, record_command
+
+# job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+# job ids are used as file names, so only these characters are accepted
+RENDER_JOB_ID = re.compile(r'^[0-9a-f]+$')
+
+# how long finished jobs stay visible to the status endpoint, in seconds
+JOB_RETENTION = 3600
+
+# folder under the render cache root holding the job records
+JOBS_DIR = 'jobs'
+
+# seconds past its timeout after which a live job nobody updates counts as lost
+JOB_STALE_AFTER = 600
+
+# how often a job waiting on a command looks for a cancel marker, in seconds
+CANCEL_POLL = 0.5
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+# path of a job's record (or of another file named after the job) in a jobs folder
+def job_path(jobsDir, jobID, suffix=".json"):
+    return os.path.join(jobsDir, f"{jobID}{suffix}")
+
+
+# atomically replaces a small file in a jobs folder
+def write_record(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpPath = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmpPath, 'w') as recordFile:
+        recordFile.write(value)
+    os.replace(tmpPath, path)
+
+
+# a job's record from any worker, or None if there is none (or it cannot be read)
+def read_record(jobsDir, jobID):
+    try:
+        with open(job_path(jobsDir, jobID)) as recordFile:
+            return json.load(recordFile)
+    except (OSError, ValueError):
+        return None
+
+
+class RenderJob:
+    def __init__(self, client, species, timeout, jobsDir=None):
+        self.id = uuid.uuid4().hex
+        self.client = client
+        self.species = list(species)
+        self.timeout = timeout
+        self.status = QUEUED
+        self.artifact_url = None
+        self.render_id = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._jobs_dir = jobsDir
+        self._cancelled = threading.Event()
+        self._process = None
+        self._lock = threading.Lock()
+
+    # cancelled here, or by a newer selection another worker accepted
+    @property
+    def cancelled(self):
+        if not self._cancelled.is_set() and self._jobs_dir is not None:
+            if os.path.exists(job_path(self._jobs_dir, self.id, ".cancel")):
+                self._cancelled.set()
+        return self._cancelled.is_set()
+
+    # writes the job's record for the other workers
+    def save(self):
+        if self._jobs_dir is None:
+            return
+        record = dict(self.as_dict(), client=self.client, timeout=self.timeout, updated=time.time())
+        try:
+            write_record(job_path(self._jobs_dir, self.id), json.dumps(record))
+        except OSError:
+            # the job still runs and this worker still answers for it
+            pass
+
+    # stops the job, killing the command it is running
+    def cancel(self):
+        self._cancelled.set()
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                self._process.kill()
+            if self.status == QUEUED:
+                self.status = CANCELLED
+                self.finished = time.time()
+                self.save()
+
+    # raises if the job was cancelled or ran past its deadline; called between render steps
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled()
+        if self.started is not None and time.time() - self.started > self.timeout:
+            raise JobTimeout()
+
+    # runs a management command (plus any extra arguments) for this job, returns True if it succeeded
+    def run_command(self, command, *args):
+        with self._lock:
+            # checked under the lock so a concurrent cancel() always sees the new process
+            self.check()
+            start = time.perf_counter()
+            self._process = subprocess.Popen(
+                [sys.executable, 'manage.py'] + command.split() + list(args),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+        process = self._process
+
+        # wait for the command, giving up at the job's deadline or when another worker cancels the job
+        try:
+            while True:
+                remaining = self.timeout - (time.time() - self.started)
+                try:
+                    _, stderr = process.communicate(timeout=max(min(remaining, CANCEL_POLL), 0))
+                    break
+                except subprocess.TimeoutExpired:
+                    if remaining <= CANCEL_POLL or self.cancelled:
+                        process.kill()
+                        process.communicate()
+                        self.check()
+                        raise JobTimeout()
+        finally:
+            with self._lock:
+                self._process = None
+
+        # the command's own stages come back in its stderr
+        record_command(command, time.perf_counter() - start, stderr)
+        self.check()
+        if process.returncode != 0:
+            print(f"Command '{command}' failed: {command_errors(stderr)}")
+            return False
+        return True
+
+    # JSON-friendly status for the status endpoint
+    def as_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "artifact_url": self.artifact_url,
+            "render_id": self.render_id,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class RenderQueue:
+    def __init__(self, max_workers=None, timeout=None, root=None):
+        self._max_workers = max_workers
+        self._timeout = timeout
+        self._root = root
+        self._executor = None
+        self._jobs = {}
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        if self._timeout is not None:
+            return self._timeout
+        return getattr(settings, 'FIREFLIGHT_RENDER_TIMEOUT', 120)
+
+    # folder of the job records shared by every worker
+    @property
+    def jobs_dir(self):
+        return os.path.join(self._root or cache_root(), JOBS_DIR)
+
+    # the pool is created on first use so settings are read after Django is configured
+    @property
+    def executor(self):
+        if self._executor is None:
+            workers = self._max_workers or getattr(settings, 'FIREFLIGHT_RENDER_WORKERS', 2)
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render")
+        return self._executor
+
+    # enqueues target(job) for a client's selection, cancelling the client's previous job;
+    # with replace=False a still-live previous job is returned instead of starting another
+    def submit(self, client, species, target, replace=True):
+        jobsDir = self.jobs_dir
+        job = RenderJob(client, species, self.timeout, jobsDir)
+        clientPath = job_path(jobsDir, "client-" + uuid.uuid5(uuid.NAMESPACE_URL, client).hex, "")
+        with self._lock:
+            self._prune()
+            previous = self._latest.get(client)
+            # the client's latest job may have been accepted by another worker
+            remote = None
+            try:
+                with open(clientPath) as clientFile:
+                    latestID = clientFile.read().strip()
+            except OSError:
+                latestID = None
+            if latestID and (previous is None or previous.id != latestID):
+                remote = self._record(latestID)
+                if remote is not None and remote["status"] in FINISHED_STATES:
+                    remote = None
+
+            if not replace:
+                if previous is not None and previous.status not in FINISHED_STATES:
+                    return previous
+                if remote is not None:
+                    return remote_job(remote, jobsDir)
+            self._jobs[job.id] = job
+            self._latest[client] = job
+            job.save()
+            try:
+                write_record(clientPath, job.id)
+            except OSError:
+                pass
+        if previous is not None and previous.status not in FINISHED_STATES:
+            previous.cancel()
+        if remote is not None:
+            try:
+                write_record(job_path(jobsDir, remote["job_id"], ".cancel"), job.id)
+            except OSError:
+                pass
+
+        self.executor.submit(self._run, job, target)
+        return job
+
+    # a job accepted by this worker
+    def get(self, jobID):
+        with self._lock:
+            return self._jobs.get(jobID)
+
+    # status of a job accepted by any worker, as for the status endpoint, or None if it is unknown
+    def status(self, jobID):
+        job = self.get(jobID)
+        if job is not None:
+            return job.as_dict()
+        record = self._record(jobID)
+        if record is None:
+            return None
+        for name in ("client", "timeout", "updated"):
+            record.pop(name, None)
+        return record
+
+    # the shared record of a job, or None if there is none
+    def _record(self, jobID):
+        if not RENDER_JOB_ID.match(jobID):
+            return None
+        record = read_record(self.jobs_dir, jobID)
+        if record is None:
+            return None
+        # the worker running it was restarted before the job finished
+        if record["status"] not in FINISHED_STATES and time.time() - record["updated"] > record["timeout"] + JOB_STALE_AFTER:
+            record.update(status=FAILED, error="Render was interrupted, submit the selection again")
+        return record
+
+    def _run(self, job, target):
+        with job._lock:
+            if job.cancelled:
+                if job.status != CANCELLED:
+                    job.status = CANCELLED
+                    job.finished = time.time()
+                    job.save()
+                return
+            job.status = RUNNING
+            job.started = time.time()
+        job.save()
+
+        try:
+            job.artifact_url = target(job)
+            job.check()
+            job.status = DONE
+        except JobCancelled:
+            job.status = CANCELLED
+        except JobTimeout:
+            job.status = FAILED
+            job.error = f"Render timed out after {job.timeout} seconds"
+        except Exception as e:
+            job.status = FAILED
+            job.error = str(e) or e.__class__.__name__
+        finally:
+            job.finished = time.time()
+            job.save()
+            # the worker thread's database connections are not reused by Django's request cycle
+            connections.close_all()
+
+    # forgets finished jobs past the retention window, along with old job records of any worker
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION
+        for jobID, job in list(self._jobs.items()):
+            if job.status in FINISHED_STATES and job.finished is not None and job.finished < cutoff:
+                del self._jobs[jobID]
+                if self._latest.get(job.client) is job:
+                    del self._latest[job.client]
+
+        jobsDir = self.jobs_dir
+        try:
+            names = os.listdir(jobsDir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(jobsDir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                # removed by another worker meanwhile
+                pass
+
+
+# read-only stand-in for a live job accepted by another worker
+def remote_job(record, jobsDir):
+    job = RenderJob(record["client"], [], record["timeout"], jobsDir)
+    job.id = record["job_id"]
+    for name in ("status", "artifact_url", "render_id", "error", "created", "started", "finished"):
+        setattr(job, name, record.get(name))
+    return job
+
+
+# queue shared by the views in this process
+render_queue = RenderQueue()
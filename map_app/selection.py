@@ -0,0 +1,124 @@
+# Reads the points of a species selection for the heatmap renders.
+#
+# The render commands take the selection as --species 3,17,42 (or every species) and aggregate
+# the selected results per grid in the database with one GROUP BY query joined to Grid: the sum,
+# mean or max of the posterior medians and credible bounds, the number of species at or above the richness threshold,
+# or the probability that any of them is present. Only one row per grid reaches Python, instead
+# of one per result, and rasterize_grids combines grids that share a raster cell. The CSV of a
+# selection is only written for downloads.
+
+import argparse
+
+from .heatmap import AGGREGATIONS, RENDER_PARAMS
+
+# Results field behind each band read from the database; the width band is derived from the
+# bounds after rasterizing (see raster.add_width)
+BAND_FIELDS = {"median": "posterior_median", "lbci": "lbci", "ubci": "ubci"}
+
+# smallest absence probability used for the presence aggregate, so a certain presence (p = 1)
+# does not take the log of zero
+PRESENCE_FLOOR = 1e-12
+
+
+def parse_species(value):
+    """
+    Parses a comma-separated list of speciesID values, as given to --species,
+    into a sorted list of unique ints. An empty string is an empty selection.
+    """
+    try:
+        return sorted({int(part) for part in value.split(",") if part.strip()})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a comma-separated list of species ids")
+
+
+# --species value for a list of speciesID values
+def format_species(species_ids):
+    return ",".join(str(species_id) for species_id in sorted({int(species_id) for species_id in species_ids}))
+
+
+# database expression aggregating one Results field over the results of one grid
+def grid_aggregate(aggregate, threshold, field="posterior_median"):
+    from django.db.models import Avg, Count, F, FloatField, Max, Q, Sum, Value
+    from django.db.models.functions import Exp, Greatest, Least, Ln
+
+    value = F(field)
+    if aggregate == "sum":
+        return Sum(value)
+    if aggregate == "mean":
+        return Avg(value)
+    if aggregate == "max":
+        return Max(value)
+    if aggregate == "richness":
+        return Count("id", filter=Q(**{f"{field}__gte": threshold}))
+    if aggregate == "presence":
+        # 1 - prod(1 - p) as a sum of logs, keeping 1 - p inside (0, 1] so the log is defined
+        absent = Least(Greatest(Value(1.0) - value, Value(PRESENCE_FLOOR)), Value(1.0), output_field=FloatField())
+        return Value(1.0) - Exp(Sum(Ln(absent)), output_field=FloatField())
+    raise ValueError(f"Unknown aggregation '{aggregate}', expected one of {', '.join(AGGREGATIONS)}")
+
+
+# {grid id: (latitude, longitude)} of every grid, for callers that run many grid_values queries
+def grid_coordinates():
+    from .models import Grid
+
+    return {gridID: (latitude, longitude)
+            for gridID, latitude, longitude in Grid.objects.values_list("id", "Grid_Lat_NAD83", "Grid_Long_NAD83")}
+
+
+def grid_extent(coordinates=None):
+    """
+    Returns the (min_lat, max_lat, min_lon, max_lon) extent of every grid, or None
+    when there are none. Selection renders are laid out over it, like the layers
+    of the raster stack, so a render is the same whichever path built it.
+    """
+    if coordinates is not None:
+        if not coordinates:
+            return None
+        latitudes, longitudes = zip(*coordinates.values())
+        return min(latitudes), max(latitudes), min(longitudes), max(longitudes)
+
+    from django.db.models import Max, Min
+    from .models import Grid
+
+    bounds = Grid.objects.aggregate(Min("Grid_Lat_NAD83"), Max("Grid_Lat_NAD83"), Min("Grid_Long_NAD83"), Max("Grid_Long_NAD83"))
+    if bounds["Grid_Lat_NAD83__min"] is None:
+        return None
+    return (bounds["Grid_Lat_NAD83__min"], bounds["Grid_Lat_NAD83__max"],
+            bounds["Grid_Long_NAD83__min"], bounds["Grid_Long_NAD83__max"])
+
+
+def grid_values(aggregate, species_ids=None, threshold=None, coordinates=None):
+    """
+    Aggregates the posterior medians and credible bounds of the selected species
+    (speciesID values, every species when None) per grid in the database, so one
+    row per grid reaches Python. Returns (latitudes, longitudes, values, counts)
+    lists, where values holds a (median, lbci, ubci) tuple per grid and counts is
+    the number of results behind it; rasterize them with raster.rasterize_grids.
+    With coordinates from grid_coordinates() the query skips the join to Grid.
+    """
+    from django.db.models import Count
+    from .models import Results
+
+    if threshold is None:
+        threshold = RENDER_PARAMS["richness_threshold"]
+
+    results = Results.objects.all()
+    if species_ids is not None:
+        results = results.filter(bird_speciesID__speciesID__in=species_ids)
+    # the coordinates come from the join to Grid unless the caller already has them
+    location = ("gridID__Grid_Lat_NAD83", "gridID__Grid_Long_NAD83") if coordinates is None else ()
+    rows = (results.order_by()
+            .values("gridID", *location)
+            .annotate(**{f"{band}_value": grid_aggregate(aggregate, threshold, field) for band, field in BAND_FIELDS.items()},
+                      result_count=Count("id"))
+            .values_list(*(location or ("gridID",)), *(f"{band}_value" for band in BAND_FIELDS), "result_count"))
+    if coordinates is not None:
+        rows = ((*coordinates[gridID], *rest) for gridID, *rest in rows if gridID in coordinates)
+
+    latitudes, longitudes, values, counts = [], [], [], []
+    for latitude, longitude, *bands, count in rows:
+        latitudes.append(latitude)
+        longitudes.append(longitude)
+        values.append(tuple(value or 0.0 for value in bands))
+        counts.append(count)
+    return latitudes, longitudes, values, counts
@@ -0,0 +1,48 @@
+# Keeps the data-version stamp in step with edits made through the ORM.
+#
+# populate bumps the stamp itself once a file is loaded (its bulk upserts send no signals). A
+# save or delete made anywhere else, such as the admin or a shell, bumps it when its transaction
+# commits, so the cached full map and filtered renders are rebuilt on the next request. Code that
+# saves many rows one at a time can wrap them in batch_changes() to bump once at the end.
+
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Species, Grid, Results
+from .render_cache import bump_data_version
+
+_state = threading.local()
+
+
+# defers the version bumps of the saves in the block to one bump when it ends
+@contextmanager
+def batch_changes():
+    outer = getattr(_state, "batch", None) is None
+    if outer:
+        _state.batch = {"changed": False}
+    try:
+        yield
+    finally:
+        if outer:
+            changed = _state.batch["changed"]
+            _state.batch = None
+            if changed:
+                bump_data_version()
+
+
+@receiver(post_save, sender=Species)
+@receiver(post_save, sender=Grid)
+@receiver(post_save, sender=Results)
+@receiver(post_delete, sender=Species)
+@receiver(post_delete, sender=Grid)
+@receiver(post_delete, sender=Results)
+def data_changed(sender, **kwargs):
+    batch = getattr(_state, "batch", None)
+    if batch is not None:
+        batch["changed"] = True
+        return
+    transaction.on_commit(bump_data_version)
@@ -0,0 +1,105 @@
+// how often to ask the server about a render job, in milliseconds
+var RENDER_POLL_INTERVAL = 1000;
+
+// how many times an unknown job is asked about again before giving up
+var RENDER_UNKNOWN_RETRIES = 5;
+
+// the job this page is currently waiting for
+var currentRenderJob = null;
+
+function setRenderStatus(text)
+{
+    var status = document.getElementById("renderStatus");
+    if (status)
+    {
+        status.textContent = text;
+    }
+}
+
+// submit the bird selection without reloading the page, then wait for the render job
+function submitBirdForm(event)
+{
+    event.preventDefault();
+
+    var form = document.getElementById("birdForm");
+
+    fetch(form.action, {
+        method: "POST",
+        body: new FormData(form),
+        headers: {"X-Requested-With": "XMLHttpRequest"},
+        credentials: "same-origin"
+    })
+    .then(function(response) { return response.json(); })
+    .then(function(job) { pollRenderJob(job.job_id); })
+    .catch(function() { setRenderStatus("Unable to start the map update."); });
+}
+
+// poll a render job until it finishes, then swap the map iframe to the new map
+function pollRenderJob(jobID, unknownRetries)
+{
+    if (unknownRetries === undefined)
+    {
+        unknownRetries = RENDER_UNKNOWN_RETRIES;
+    }
+    currentRenderJob = jobID;
+    setRenderStatus("Updating map...");
+
+    fetch("/map/jobs/" + jobID + "/", {credentials: "same-origin"})
+    .then(function(response) { return response.json(); })
+    .then(function(job)
+    {
+        // a newer submission replaced this job
+        if (currentRenderJob !== jobID)
+        {
+            return;
+        }
+
+        if (job.status === "done")
+        {
+            document.getElementById("mapFrame").src = job.artifact_url;
+            document.getElementById("largerMapLink").href = "/enchanted-circle-map/?render=" + job.render_id;
+            setRenderStatus("");
+        }
+        else if (job.status === "failed")
+        {
+            setRenderStatus("Map update failed: " + job.error);
+        }
+        else if (job.status === "queued" || job.status === "running")
+        {
+            setTimeout(function() { pollRenderJob(jobID, unknownRetries); }, RENDER_POLL_INTERVAL);
+        }
+        else if (job.status === "cancelled")
+        {
+            // replaced by a selection from another tab, or stopped on the server
+            setRenderStatus("Map update was cancelled. Submit your selection again to retry.");
+        }
+        else if (unknownRetries > 0)
+        {
+            // the job record may not have reached this server yet
+            setTimeout(function() { pollRenderJob(jobID, unknownRetries - 1); }, RENDER_POLL_INTERVAL);
+        }
+        else
+        {
+            setRenderStatus("Map update was lost. Submit your selection again to retry.");
+        }
+    })
+    .catch(function()
+    {
+        setTimeout(function() { pollRenderJob(jobID, unknownRetries); }, RENDER_POLL_INTERVAL);
+    });
+}
+
+document.addEventListener("DOMContentLoaded", function()
+{
+    var form = document.getElementById("birdForm");
+    if (form)
+    {
+        form.addEventListener("submit", submitBirdForm);
+    }
+
+    // the page was loaded for a job submitted without JavaScript
+    if (form && form.dataset.job)
+    {
+        pollRenderJob(form.dataset.job);
+    }
+});
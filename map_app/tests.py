@@ -1,12 +1,48 @@
 #Everyone
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, transaction
 from .models import Species, Grid, Results
-import csv
+from .render_cache import RenderCache, render_key, data_version, bump_data_version, full_map_key, set_latest_full_map
+from .render_jobs import RenderQueue
+from .async_views import STREAM_BATCH, ViewPool, async_view
+from .colorize import colorize, gradient_table, quantize
+from .raster import rasterize, rasterize_grids, selection_raster, write_overlay
+from .raster_stack import build_stack, composite
+from .selection import grid_coordinates, grid_values, parse_species
+from .management.commands import benchmark, prerender
+from .management.commands.populate import GRID_FIELDS
+from .signals import batch_changes
+from .precompress import compressed_variant, write_compressed
+from .tiles import RasterPyramid, tile_bounds
+from .timing import TIMING_PREFIX, metrics, record_command, stage
+from .views import FULL_MAP_CLIENT, current_full_map, getCSV, selectionRows
+from . import views
+import asyncio, csv, gzip, json, os, shutil, tempfile, threading, time, uuid
+import numpy as np
 from io import StringIO
+
+# keep cache and data-version writes out of the project folder while testing; the folder is
+# named here because the settings overrides below need it, and only exists while the tests run
+TEST_CACHE_DIR = os.path.join(tempfile.gettempdir(), f"fireflight-test-cache-{uuid.uuid4().hex}")
+
+
+def setUpModule():
+    os.makedirs(TEST_CACHE_DIR)
+
+
+def tearDownModule():
+    shutil.rmtree(TEST_CACHE_DIR, ignore_errors=True)
+
+
+# path of a file the tests write, inside the test folder
+def testFile(name):
+    return os.path.join(TEST_CACHE_DIR, name)
         
 # tests for adding data
+@override_settings(FIREFLIGHT_RENDER_CACHE_DIR=TEST_CACHE_DIR)
 class AddingDataTests(TestCase):
     def setUp(self):
         Species.objects.create(speciesID=0, species="Fake Bird", birdcode="BIRDCODE")
@@ -22,6 +58,7 @@ class AddingDataTests(TestCase):
         """
 
 # csv to db tests
+@override_settings(FIREFLIGHT_RENDER_CACHE_DIR=TEST_CACHE_DIR)
 class csvTests(TestCase):
     # create error-triggering files
     def setUp(self):
@@ -100,4 +137,1040 @@ class csvTests(TestCase):
     def test_invalid_file_type(self):
         errText = StringIO()
         call_command("populate", "abcdefghijklmnopqrstuvwxyz", stderr=errText)
-        self.assertIn("Error: File inaccessible", errText.getvalue())
\ No newline at end of file
+        self.assertIn("Error: File inaccessible", errText.getvalue())
+
+# bulk ingest tests
+@override_settings(FIREFLIGHT_RENDER_CACHE_DIR=TEST_CACHE_DIR)
+class bulkPopulateTests(TestCase):
+    # create species, grid, and results files
+    def setUp(self):
+        with open(testFile("bulkSpecies.csv"), "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["speciesID","species","birdcode"])
+            writer.writerow(["1", "American Crow", "AMCR"])
+            writer.writerow(["2", "Steller's Jay", "STJA"])
+            writer.writerow(["not an int", "Bad Bird", "BAD"])
+
+        with open(testFile("bulkGrid.csv"), "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["\ufeffOID_","Grid_ID","Grid_E_NAD83","Grid_N_NAD83","UTM_Zone","Grid_Lat_NAD83","Grid_Long_NAD83","BCR",
+                              "MgmtEntity","MgmtRegion","MgmtUnit","MgmtDistrict","County","State","PriorityLandscape","inPL"])
+            writer.writerow(["1","NM-CARSON-LE1","388500","4091500","13","36.96299337","-106.2525113","16","US Forest Service",
+                             "USFS Region 3","Carson National Forest","Tres Piedras Ranger District","Rio Arriba","NM","Enchanted Circle","0"])
+            writer.writerow(["2","NM-CARSON-LE2","389500","4091500","13","36.96310000","-106.2413000","16","US Forest Service",
+                             "USFS Region 3","Carson National Forest","Tres Piedras Ranger District","Rio Arriba","NM","Enchanted Circle","1"])
+
+        with open(testFile("bulkResults.csv"), "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["parameter","lbci","posterior.median","ubci"])
+            writer.writerow(["psi[1,1]", "0.1", "0.2", "0.3"])
+            writer.writerow(["psi[1,2]", "0.2", "0.3", "0.4"])
+            writer.writerow(["psi[2,1]", "0.3", "0.4", "0.5"])
+            # repeated key, last row wins
+            writer.writerow(["psi[2,1]", "0.4", "0.5", "0.6"])
+            # unknown species
+            writer.writerow(["psi[99,1]", "0.1", "0.2", "0.3"])
+
+    # test loading all three files in bulk mode
+    def test_bulk_load(self):
+        outText = StringIO()
+        call_command("populate", testFile("bulkSpecies.csv"), "--bulk", stdout=outText, stderr=StringIO())
+        call_command("populate", testFile("bulkGrid.csv"), "--bulk", stdout=outText, stderr=StringIO())
+        call_command("populate", testFile("bulkResults.csv"), "--bulk", "--chunk-size", "2", stdout=outText, stderr=StringIO())
+
+        self.assertEqual(Species.objects.count(), 2)
+        self.assertEqual(Grid.objects.count(), 2)
+        self.assertTrue(Grid.objects.get(OID=2).inPL)
+        self.assertFalse(Grid.objects.get(OID=1).inPL)
+        self.assertEqual(Results.objects.count(), 3)
+        self.assertEqual(Results.objects.get(bird_speciesID_id=2, gridID_id=1).posterior_median, 0.5)
+        self.assertIn("3 inserted, 1 updated, 1 rejected", outText.getvalue())
+
+    # test that loading a file again updates instead of inserting
+    def test_bulk_reload_updates(self):
+        call_command("populate", testFile("bulkSpecies.csv"), "--bulk", stdout=StringIO(), stderr=StringIO())
+        outText = StringIO()
+        call_command("populate", testFile("bulkSpecies.csv"), "--bulk", stdout=outText, stderr=StringIO())
+
+        self.assertEqual(Species.objects.count(), 2)
+        self.assertIn("0 inserted, 2 updated, 1 rejected", outText.getvalue())
+
+    # test that reloading results upserts on the (species, grid) pair
+    def test_bulk_results_reload(self):
+        call_command("populate", testFile("bulkSpecies.csv"), "--bulk", stdout=StringIO(), stderr=StringIO())
+        call_command("populate", testFile("bulkGrid.csv"), "--bulk", stdout=StringIO(), stderr=StringIO())
+        call_command("populate", testFile("bulkResults.csv"), "--bulk", stdout=StringIO(), stderr=StringIO())
+        outText = StringIO()
+        call_command("populate", testFile("bulkResults.csv"), "--bulk", stdout=outText, stderr=StringIO())
+
+        self.assertEqual(Results.objects.count(), 3)
+        self.assertIn("0 inserted, 4 updated, 1 rejected", outText.getvalue())
+
+    # test that a grid row taking another OID's Grid_ID is rejected instead of aborting the load
+    def test_bulk_grid_id_conflict(self):
+        call_command("populate", testFile("bulkGrid.csv"), "--bulk", stdout=StringIO(), stderr=StringIO())
+        with open(testFile("bulkGridConflict.csv"), "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(GRID_FIELDS)
+            # new OID with the Grid_ID of OID 1
+            writer.writerow(["3","NM-CARSON-LE1","390500","4091500","13","36.9632","-106.2301","16","US Forest Service",
+                             "USFS Region 3","Carson National Forest","Tres Piedras Ranger District","Rio Arriba","NM","Enchanted Circle","0"])
+            writer.writerow(["4","NM-CARSON-LE4","391500","4091500","13","36.9633","-106.2189","16","US Forest Service",
+                             "USFS Region 3","Carson National Forest","Tres Piedras Ranger District","Rio Arriba","NM","Enchanted Circle","0"])
+        outText, errText = StringIO(), StringIO()
+        call_command("populate", testFile("bulkGridConflict.csv"), "--bulk", stdout=outText, stderr=errText)
+
+        self.assertEqual(sorted(Grid.objects.values_list("OID", flat=True)), [1, 2, 4])
+        self.assertEqual(Grid.objects.get(Grid_ID="NM-CARSON-LE1").OID, 1)
+        self.assertIn("1 inserted, 0 updated, 1 rejected", outText.getvalue())
+        self.assertIn("Grid_ID belongs to another OID", errText.getvalue())
+
+    # test that the database refuses a second result for the same species and grid
+    def test_results_unique_pair(self):
+        call_command("populate", testFile("bulkSpecies.csv"), "--bulk", stdout=StringIO(), stderr=StringIO())
+        call_command("populate", testFile("bulkGrid.csv"), "--bulk", stdout=StringIO(), stderr=StringIO())
+        species, grid = Species.objects.get(speciesID=1), Grid.objects.get(OID=1)
+        Results.objects.create(bird_speciesID=species, gridID=grid, lbci=0.1, posterior_median=0.2, ubci=0.3)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Results.objects.create(bird_speciesID=species, gridID=grid, lbci=0.1, posterior_median=0.2, ubci=0.3)
+
+    # test the bulk loader's header check
+    def test_bulk_bad_file_header(self):
+        errText = StringIO()
+        with open(testFile("bulkBadHeader.csv"), "w") as file:
+            csv.writer(file).writerow(["this is", "NOT a valid", "csv"])
+        call_command("populate", testFile("bulkBadHeader.csv"), "--bulk", stderr=errText)
+        self.assertIn("Error: Invalid first field. File must be Species, Grid, or Results", errText.getvalue())
+
+
+# render cache tests
+class renderCacheTests(TestCase):
+    # create a cache in a temporary folder
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.cacheDir = os.path.join(self.tmpDir.name, "cache")
+        self.cache = RenderCache(root=self.cacheDir, max_entries=2)
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    # renders a fake map into a staging directory and publishes it under key
+    def store(self, key, bounds=None, maintain=True):
+        stagingDir = self.cache.new_staging_dir()
+        with open(os.path.join(stagingDir, "heatmap_raster.png"), "wb") as file:
+            file.write(b"png")
+        with open(os.path.join(stagingDir, "enchanted_circle_map.html"), "w") as file:
+            file.write("<html></html>")
+        with open(os.path.join(stagingDir, "heatmap_raster.json"), "w") as file:
+            json.dump({"bounds": bounds}, file)
+        return self.cache.commit(key, stagingDir, maintain)
+
+    # test that the key ignores selection order and repeats
+    def test_key_is_canonical(self):
+        self.assertEqual(render_key(["3", "1", "2"], version="v1"), render_key([1, 2, 3, 3], version="v1"))
+        self.assertNotEqual(render_key([1, 2], version="v1"), render_key([1, 2], version="v2"))
+        self.assertNotEqual(render_key([1, 2], params={"sigma": 1}, version="v1"), render_key([1, 2], version="v1"))
+
+    # test storing and reading back an entry
+    def test_commit_and_get(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.store("a", [[1, 2], [3, 4]])
+        entry = self.cache.get("a")
+
+        self.assertEqual(entry["bounds"], [[1, 2], [3, 4]])
+        with open(entry["html"]) as file:
+            self.assertEqual(file.read(), "<html></html>")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        # no staging directories are left behind
+        self.assertEqual(os.listdir(self.cacheDir), ["a"])
+
+    # test that a second render of the same key keeps the first one
+    def test_commit_existing_key(self):
+        self.store("a", [[1, 2], [3, 4]])
+        self.store("a", [[5, 6], [7, 8]])
+        self.assertEqual(self.cache.get("a")["bounds"], [[1, 2], [3, 4]])
+        self.assertEqual(os.listdir(self.cacheDir), ["a"])
+
+    # test that render ids cannot escape the cache folder
+    def test_path_rejects_bad_ids(self):
+        self.store("a")
+        self.assertIsNotNone(self.cache.path("a", "enchanted_circle_map.html"))
+        self.assertIsNone(self.cache.path("../a", "enchanted_circle_map.html"))
+        self.assertIsNone(self.cache.path(None, "enchanted_circle_map.html"))
+
+    # test that the least recently used entry is evicted first
+    def test_lru_eviction(self):
+        self.store("a")
+        self.store("b")
+        # make "a" the most recently used entry
+        os.utime(os.path.join(self.cacheDir, "b", "heatmap_raster.json"), (1, 1))
+        self.cache.get("a")
+        self.store("c")
+
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.stats()["entries"], 2)
+
+    # test that batch commits leave eviction to one evict() at the end
+    def test_batch_commit(self):
+        for key in ("a", "b", "c"):
+            self.store(key, maintain=False)
+        self.assertEqual(self.cache.stats()["entries"], 3)
+        self.cache.evict()
+        self.assertEqual(self.cache.stats()["entries"], 2)
+
+    # test that tiles cut from an entry count toward its size and the byte limit
+    def test_tiles_counted(self):
+        entryDir = self.store("a")
+        plainBytes = self.cache.stats()["bytes"]
+        tileDir = os.path.join(entryDir, "tiles", "median", "9", "106")
+        os.makedirs(tileDir)
+        with open(os.path.join(tileDir, "200.png"), "wb") as file:
+            file.write(b"x" * 1000)
+        self.assertEqual(self.cache.stats()["bytes"], plainBytes + 1000)
+
+        # a byte limit the tiles push the entries past evicts the older one
+        cache = RenderCache(root=self.cacheDir, max_entries=10, max_bytes=plainBytes + 1500)
+        os.utime(os.path.join(entryDir, "heatmap_raster.json"), (1, 1))
+        self.store("b")
+        cache.evict()
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+
+    # test that the sweep removes stale entries and abandoned staging folders
+    def test_sweep(self):
+        self.store("a")
+        os.utime(os.path.join(self.cacheDir, "a", "heatmap_raster.json"), (1, 1))
+        stagingDir = self.cache.new_staging_dir()
+        os.utime(stagingDir, (1, 1))
+        self.store("b")
+
+        self.assertEqual(os.listdir(self.cacheDir), ["b"])
+
+    # test that bumping the data version changes the key
+    def test_data_version_bump(self):
+        with override_settings(FIREFLIGHT_RENDER_CACHE_DIR=self.cacheDir):
+            before = render_key([1])
+            self.assertEqual(data_version(), "0")
+            bump_data_version()
+            self.assertNotEqual(render_key([1]), before)
+
+    # test that the map view serves the shared shell for a stored render
+    def test_map_view_resolves_render(self):
+        with override_settings(FIREFLIGHT_RENDER_CACHE_DIR=self.cacheDir):
+            self.store("a")
+            response = self.client.get("/enchanted-circle-map/?render=a&embed=True")
+            self.assertIn(b"/overlay/", b"".join(response.streaming_content))
+            self.assertEqual(self.client.get("/enchanted-circle-map/?render=missing").status_code, 404)
+
+            # without a render id the session's render is put in the URL for the shell
+            session = self.client.session
+            session["render"] = "a"
+            session.save()
+            self.assertRedirects(self.client.get("/enchanted-circle-map/?embed=True"),
+                                 "/enchanted-circle-map/?embed=True&render=a", fetch_redirect_response=False)
+
+    # test the overlay description the shell loads
+    def test_overlay_view(self):
+        with override_settings(FIREFLIGHT_RENDER_CACHE_DIR=self.cacheDir):
+            self.store("a", bounds=[[36.0, -106.0], [37.0, -105.0]])
+            counters = (views.render_cache.hits, views.render_cache.misses)
+            overlay = self.client.get("/overlay/a/").json()
+            self.assertEqual(overlay["bounds"], [[36.0, -106.0], [37.0, -105.0]])
+            self.assertEqual(overlay["image"], "/overlay/a/image.png")
+            # this fake render has no GeoTIFF to cut tiles from
+            self.assertIsNone(overlay["tiles"])
+            self.assertEqual(self.client.get("/overlay/a/image.png")["Content-Type"], "image/png")
+            self.assertEqual(self.client.get("/overlay/missing/").status_code, 404)
+            # loading a map is not a cache lookup
+            self.assertEqual((views.render_cache.hits, views.render_cache.misses), counters)
+
+    # test that the full map is reused until the data changes, then rebuilt once in the background
+    def test_full_map_versioned(self):
+        with override_settings(FIREFLIGHT_RENDER_CACHE_DIR=self.cacheDir):
+            oldKey = full_map_key()
+            self.store(oldKey)
+            set_latest_full_map(oldKey)
+            self.assertEqual(current_full_map(), (oldKey, None))
+
+            # hold the rebuild so both requests see it running
+            release = threading.Event()
+            bump_data_version()
+            rebuild = views.render_queue.submit(FULL_MAP_CLIENT, [], lambda job: release.wait(5))
+            try:
+                self.assertEqual(current_full_map(), (oldKey, rebuild))
+                self.assertEqual(current_full_map(), (oldKey, rebuild))
+            finally:
+                release.set()
+                # the job writes its last record into the cache folder before the folder goes
+                for _ in range(200):
+                    if rebuild.finished is not None:
+                        break
+                    time.sleep(0.01)
+
+    # test that model edits bump the data version when they commit
+    def test_save_bumps_data_version(self):
+        with override_settings(FIREFLIGHT_RENDER_CACHE_DIR=self.cacheDir):
+            with self.captureOnCommitCallbacks(execute=True):
+                Species.objects.create(speciesID=1, species="American Crow", birdcode="AMCR")
+            bumped = data_version()
+            self.assertNotEqual(bumped, "0")
+
+            # a batch of saves bumps once when it ends instead of on every commit
+            with self.captureOnCommitCallbacks() as callbacks, batch_changes():
+                Species.objects.create(speciesID=2, species="Steller's Jay", birdcode="STJA")
+                Species.objects.filter(speciesID=1).first().delete()
+            self.assertEqual(callbacks, [])
+            self.assertNotEqual(data_version(), bumped)
+
+
+# render job tests
+@override_settings(FIREFLIGHT_RENDER_CACHE_DIR=TEST_CACHE_DIR)
+class renderJobTests(TestCase):
+    def setUp(self):
+        # job records of this test only, shared by the queues standing in for other workers
+        self.root = tempfile.mkdtemp(dir=TEST_CACHE_DIR)
+        self.queue = RenderQueue(max_workers=2, timeout=5, root=self.root)
+
+    # waits for a job to reach a finished state
+    def wait(self, job):
+        for _ in range(200):
+            if job.finished is not None:
+                return
+            time.sleep(0.01)
+
+    # test that a job runs and reports its artifact url
+    def test_job_done(self):
+        job = self.queue.submit("client", ["1"], lambda job: "/enchanted-circle-map/?v=abc")
+        self.wait(job)
+        self.assertEqual(job.as_dict()["status"], "done")
+        self.assertEqual(job.artifact_url, "/enchanted-circle-map/?v=abc")
+        self.assertIs(self.queue.get(job.id), job)
+
+    # test that a newer selection from the same client cancels the older job
+    def test_newer_selection_cancels(self):
+        started = threading.Event()
+
+        def slowRender(job):
+            started.set()
+            while True:
+                job.check()
+                time.sleep(0.01)
+
+        first = self.queue.submit("client", ["1"], slowRender)
+        started.wait(1)
+        second = self.queue.submit("client", ["2"], lambda job: "/done")
+        self.wait(first)
+        self.wait(second)
+        self.assertEqual(first.status, "cancelled")
+        self.assertEqual(second.status, "done")
+
+    # test that submitting without replace reuses the client's live job
+    def test_submit_without_replace(self):
+        release = threading.Event()
+        first = self.queue.submit("client", [], lambda job: release.wait(1))
+        second = self.queue.submit("client", [], lambda job: "/done", replace=False)
+        release.set()
+        self.wait(first)
+        self.assertIs(second, first)
+        self.assertEqual(first.status, "done")
+
+    # test that a job past its deadline fails
+    def test_job_timeout(self):
+        queue = RenderQueue(max_workers=1, timeout=0.05, root=self.root)
+
+        def slowRender(job):
+            while True:
+                job.check()
+                time.sleep(0.01)
+
+        job = queue.submit("client", ["1"], slowRender)
+        self.wait(job)
+        self.assertEqual(job.status, "failed")
+        self.assertIn("timed out", job.error)
+
+    # test that another worker sees a job's status and can cancel it with a newer selection
+    def test_job_shared_between_workers(self):
+        other = RenderQueue(max_workers=1, timeout=5, root=self.root)
+        started = threading.Event()
+
+        def slowRender(job):
+            started.set()
+            while True:
+                job.check()
+                time.sleep(0.01)
+
+        first = self.queue.submit("client", ["1"], slowRender)
+        started.wait(1)
+        self.assertIsNone(other.get(first.id))
+        self.assertEqual(other.status(first.id)["status"], "running")
+
+        second = other.submit("client", ["2"], lambda job: "/done")
+        self.wait(first)
+        self.wait(second)
+        self.assertEqual(first.status, "cancelled")
+        self.assertEqual(self.queue.status(second.id)["status"], "done")
+        self.assertEqual(self.queue.status(second.id)["artifact_url"], "/done")
+
+    # test that a live job of another worker is reused without replace
+    def test_submit_without_replace_between_workers(self):
+        other = RenderQueue(max_workers=1, timeout=5, root=self.root)
+        release = threading.Event()
+        first = self.queue.submit("client", [], lambda job: release.wait(1))
+        second = other.submit("client", [], lambda job: "/done", replace=False)
+        release.set()
+        self.wait(first)
+        self.assertEqual(second.id, first.id)
+        self.assertIsNone(other.get(first.id))
+
+    # test that a job left running by a restarted worker is reported as failed
+    def test_stale_job_record(self):
+        job = self.queue.submit("client", ["1"], lambda job: "/done")
+        self.wait(job)
+        recordPath = os.path.join(self.queue.jobs_dir, f"{job.id}.json")
+        with open(recordPath) as recordFile:
+            record = json.load(recordFile)
+        record.update(status="running", updated=time.time() - 3600)
+        with open(recordPath, "w") as recordFile:
+            json.dump(record, recordFile)
+
+        status = RenderQueue(root=self.root).status(job.id)
+        self.assertEqual(status["status"], "failed")
+        self.assertIn("interrupted", status["error"])
+        self.assertIsNone(RenderQueue(root=self.root).status("../etc"))
+
+    # test the status endpoint for an unknown job
+    def test_unknown_job_status(self):
+        response = self.client.get("/map/jobs/doesnotexist/")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["status"], "unknown")
+
+
+# async view tests
+class asyncViewTests(TestCase):
+    def setUp(self):
+        self.pool = ViewPool(max_workers=2)
+
+    # test that no more views run at once than the pool has threads
+    def test_pool_bounds_concurrency(self):
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        lock, running, peak = threading.Lock(), [0], [0]
+
+        def slowView(request):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return HttpResponse("ok")
+
+        view = async_view(slowView, self.pool)
+
+        async def serve():
+            return await asyncio.gather(*(view(RequestFactory().get("/")) for _ in range(6)))
+
+        responses = asyncio.run(serve())
+        self.assertEqual([response.content for response in responses], [b"ok"] * 6)
+        self.assertEqual(peak[0], 2)
+
+    # test that a streamed response is iterated on the pool and sent in batches
+    def test_stream_batches(self):
+        from django.http import StreamingHttpResponse
+        from django.test import RequestFactory
+        rows = [f"{i},row\n" for i in range(20000)]
+        view = async_view(lambda request: StreamingHttpResponse(iter(rows), content_type="text/csv"), self.pool)
+
+        async def serve():
+            response = await view(RequestFactory().get("/"))
+            return response, [chunk async for chunk in response.streaming_content]
+
+        response, chunks = asyncio.run(serve())
+        self.assertTrue(response.is_async)
+        self.assertEqual(b"".join(chunks), "".join(rows).encode())
+        self.assertLessEqual(len(chunks), len("".join(rows)) // STREAM_BATCH + 1)
+
+    # test that closing a stream early stops the thread iterating it
+    def test_stream_closed_early(self):
+        produced = []
+
+        def rows():
+            for i in range(100000):
+                produced.append(i)
+                yield b"x" * 1024
+
+        async def serve():
+            stream = self.pool.stream(rows())
+            await stream.__anext__()
+            await stream.aclose()
+            count = len(produced)
+            await asyncio.sleep(0.05)
+            return count
+
+        count = asyncio.run(serve())
+        self.assertLess(count, 100000)
+        self.assertEqual(len(produced), count)
+
+
+# rasterization tests
+class rasterizeTests(TestCase):
+    # two results in the same cell and one in another cell
+    latitudes = [36.0, 36.0, 36.045]
+    longitudes = [-105.0, -105.0, -104.955]
+    values = [0.5, 0.2, 0.4]
+
+    def cellValue(self, aggregate):
+        raster, west, north = rasterize(self.latitudes, self.longitudes, self.values, 0.01, aggregate)
+        self.assertEqual((west, north), (-105.0, 36.045))
+        self.assertEqual(raster.shape, (5, 5))
+        # the lone result is not affected by the aggregation
+        self.assertAlmostEqual(float(raster[0, 4]), 0.4, places=6)
+        return float(raster[4, 0])
+
+    def test_sum(self):
+        self.assertAlmostEqual(self.cellValue("sum"), 0.7, places=6)
+
+    def test_mean(self):
+        self.assertAlmostEqual(self.cellValue("mean"), 0.35, places=6)
+
+    def test_max(self):
+        self.assertAlmostEqual(self.cellValue("max"), 0.5, places=6)
+
+    def test_presence(self):
+        self.assertAlmostEqual(self.cellValue("presence"), 1 - 0.5 * 0.8, places=6)
+
+    def test_richness(self):
+        raster, _, _ = rasterize(self.latitudes, self.longitudes, self.values, 0.01, "richness", threshold=0.3)
+        self.assertEqual((float(raster[4, 0]), float(raster[0, 4])), (1.0, 1.0))
+
+    def test_unknown_aggregation(self):
+        with self.assertRaises(ValueError):
+            rasterize(self.latitudes, self.longitudes, self.values, 0.01, "median")
+
+    # test that per-grid aggregates give the raster of the results behind them
+    def test_grid_aggregates(self):
+        # the first cell holds two grids, with two results and one result
+        latitudes = [36.0, 36.0, 36.004, 36.045]
+        longitudes = [-105.0, -105.0, -105.0, -104.955]
+        values = [0.5, 0.2, 0.9, 0.4]
+        grids = [0, 0, 1, 2]
+        for aggregate in ("sum", "mean", "max", "presence", "richness"):
+            perResult, west, north = rasterize(latitudes, longitudes, values, 0.01, aggregate)
+            gridValues, gridCounts = [], []
+            for grid in range(3):
+                members = [value for value, owner in zip(values, grids) if owner == grid]
+                cell, _, _ = rasterize([0.0] * len(members), [0.0] * len(members), members, 0.01, aggregate)
+                gridValues.append(float(cell[0, 0]))
+                gridCounts.append(len(members))
+            perGrid, _, _ = rasterize_grids([36.0, 36.004, 36.045], [-105.0, -105.0, -104.955], gridValues, gridCounts, 0.01, aggregate)
+            np.testing.assert_allclose(perGrid, perResult, rtol=1e-6, err_msg=aggregate)
+
+    # test the overlay files written straight from an array
+    def test_write_overlay(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            bounds = write_overlay(tmpDir, np.ones((3, 4), dtype=np.float32), -105.0, 36.0, 0.5)
+            self.assertEqual(bounds, [[34.5, -105.0], [36.0, -103.0]])
+            self.assertEqual(sorted(os.listdir(tmpDir)), ["heatmap_raster.json", "heatmap_raster.npy", "heatmap_raster.png"])
+
+            # the GeoTIFF is an optional export
+            write_overlay(tmpDir, np.ones((3, 4), dtype=np.float32), -105.0, 36.0, 0.5, geotiff=True)
+            self.assertTrue(os.path.isfile(os.path.join(tmpDir, "heatmap_raster.tif")))
+
+        # every band of a multi-band raster gets its own raster, image and color range
+        with tempfile.TemporaryDirectory() as tmpDir:
+            bands = np.arange(4 * 3 * 4, dtype=np.float32).reshape(4, 3, 4)
+            write_overlay(tmpDir, bands, -105.0, 36.0, 0.5)
+            np.testing.assert_array_equal(np.load(os.path.join(tmpDir, "heatmap_raster_width.npy")), bands[3])
+            self.assertTrue(os.path.isfile(os.path.join(tmpDir, "heatmap_raster_lbci.png")))
+            with open(os.path.join(tmpDir, "heatmap_raster.json")) as metaFile:
+                meta = json.load(metaFile)
+            self.assertEqual(list(meta["bands"]), ["median", "lbci", "ubci", "width"])
+            self.assertEqual(meta["range"], meta["bands"]["median"])
+
+
+# selection export tests
+class csvExportTests(TestCase):
+    def setUp(self):
+        crow = Species.objects.create(speciesID=1, species="American Crow", birdcode="AMCR")
+        jay = Species.objects.create(speciesID=2, species="Steller's Jay", birdcode="STJA")
+        grid = Grid.objects.create(OID=1, Grid_ID="NM-CARSON-LE1", Grid_E_NAD83=388500,Grid_N_NAD83=4091500,UTM_Zone=13,Grid_Lat_NAD83=36.96299337,Grid_Long_NAD83=-106.2525113,BCR=16,MgmtEntity="US Forest Service", MgmtRegion="USFS Region 3",MgmtUnit="Carson National Forest",MgmtDistrict="Tres Piedras Ranger District",County="Rio Arriba",State="NM",PriorityLandscape="Enchanted Circle",inPL=0)
+
+        Results.objects.create(bird_speciesID=crow, gridID=grid, lbci=0.1, posterior_median=0.2, ubci=0.3)
+        Results.objects.create(bird_speciesID=jay, gridID=grid, lbci=0.4, posterior_median=0.5, ubci=0.6)
+
+    # test that the export is built from a single query
+    def test_selection_is_one_query(self):
+        with self.assertNumQueries(1):
+            rows = list(selectionRows(["1", "2"]))
+        self.assertEqual(len(rows), 2)
+
+    # test the CSV written for a selection
+    def test_get_csv(self):
+        output = getCSV(["2"], StringIO())
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], "grid_OID,species,birdcode,lbci,posterior_median,ubci")
+        self.assertEqual(lines[1:], ["1,Steller's Jay,STJA,0.4,0.5,0.6"])
+
+    # test that the download streams the session's selection
+    def test_download_selection(self):
+        session = self.client.session
+        session["birdList"] = ["1"]
+        session.save()
+
+        response = self.client.post("/download/")
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn("American Crow", content)
+        self.assertNotIn("Steller's Jay", content)
+
+    # test aggregating a selection per grid for the renders in one query
+    def test_grid_values(self):
+        self.assertEqual(parse_species("2, 1,2"), [1, 2])
+        self.assertEqual(parse_species(""), [])
+        with self.assertNumQueries(1):
+            latitudes, longitudes, values, counts = grid_values("sum", [2])
+        # (median, lbci, ubci) of the grid
+        self.assertEqual((latitudes, longitudes, values, counts), ([36.96299337], [-106.2525113], [(0.5, 0.4, 0.6)], [1]))
+
+        expected = {"sum": 0.7, "mean": 0.35, "max": 0.5, "presence": 1 - 0.8 * 0.5, "richness": 1}
+        for aggregate, value in expected.items():
+            _, _, values, counts = grid_values(aggregate)
+            self.assertAlmostEqual(values[0][0], value, places=6, msg=aggregate)
+            self.assertEqual(counts, [2])
+        _, _, values, _ = grid_values("sum")
+        self.assertAlmostEqual(values[0][1], 0.5, places=6)
+        self.assertAlmostEqual(values[0][2], 0.9, places=6)
+
+    # test rendering a selection given as --species, without a CSV
+    def test_render_species(self):
+        with tempfile.TemporaryDirectory() as outputDir:
+            call_command("generate_enchanted_circle_map", "--species", "1,2", "--output-dir", outputDir, "--overlay-only",
+                         stdout=StringIO(), stderr=StringIO())
+            self.assertTrue(os.path.isfile(os.path.join(outputDir, "heatmap_raster.npy")))
+            self.assertFalse(os.path.exists(os.path.join(outputDir, "bird_data.csv")))
+
+    # test prerendering a selection into the render cache the way the prerender workers do
+    def test_prerender_selection(self):
+        self.assertEqual(grid_values("sum", [1, 2], coordinates=grid_coordinates()), grid_values("sum", [1, 2]))
+        with tempfile.TemporaryDirectory() as cacheDir, override_settings(FIREFLIGHT_RENDER_CACHE_DIR=cacheDir):
+            prerender.init_worker()
+            self.assertEqual(prerender.render_selection([1, 2])[0], "rendered")
+            self.assertEqual(prerender.render_selection([2, 1])[0], "cached")
+            self.assertEqual(prerender.render_selection([99])[0], "empty")
+
+            # a catalogue bigger than the cache is refused unless eviction is allowed
+            with override_settings(FIREFLIGHT_RENDER_CACHE_MAX_ENTRIES=1):
+                with self.assertRaises(CommandError):
+                    call_command("prerender", "--species", "1,2", stdout=StringIO())
+
+            # same raster as rendering the selection on demand
+            with tempfile.TemporaryDirectory() as outputDir:
+                call_command("generate_enchanted_circle_map", "--species", "1,2", "--output-dir", outputDir, "--overlay-only",
+                             stdout=StringIO(), stderr=StringIO())
+                np.testing.assert_array_equal(np.load(os.path.join(cacheDir, render_key([1, 2]), "heatmap_raster.npy")),
+                                              np.load(os.path.join(outputDir, "heatmap_raster.npy")))
+
+
+# query export tests
+class queryExportTests(TestCase):
+    def setUp(self):
+        self.crow = Species.objects.create(speciesID=1, species="American Crow", birdcode="AMCR")
+        self.jay = Species.objects.create(speciesID=2, species="Steller's Jay", birdcode="STJA")
+        self.north = Grid.objects.create(OID=1, Grid_ID="NM-CARSON-LE1", Grid_E_NAD83=388500,Grid_N_NAD83=4091500,UTM_Zone=13,Grid_Lat_NAD83=36.96,Grid_Long_NAD83=-106.25,BCR=16,MgmtEntity="US Forest Service", MgmtRegion="USFS Region 3",MgmtUnit="Carson National Forest",MgmtDistrict="Tres Piedras Ranger District",County="Rio Arriba",State="NM",PriorityLandscape="Enchanted Circle",inPL=0)
+        self.south = Grid.objects.create(OID=2, Grid_ID="NM-CARSON-LE2", Grid_E_NAD83=388500,Grid_N_NAD83=4001500,UTM_Zone=13,Grid_Lat_NAD83=36.16,Grid_Long_NAD83=-106.25,BCR=16,MgmtEntity="US Forest Service", MgmtRegion="USFS Region 3",MgmtUnit="Carson National Forest",MgmtDistrict="Tres Piedras Ranger District",County="Rio Arriba",State="NM",PriorityLandscape="Enchanted Circle",inPL=0)
+
+        for species in (self.crow, self.jay):
+            for grid in (self.north, self.south):
+                Results.objects.create(bird_speciesID=species, gridID=grid, lbci=0.1, posterior_median=0.2, ubci=0.3)
+
+    def get(self, url):
+        response = self.client.get(url)
+        return response, b"".join(response.streaming_content)
+
+    # test the default full csv export
+    def test_full_csv(self):
+        response, content = self.get("/results/query/")
+        lines = content.decode().splitlines()
+        self.assertEqual(lines[0], "id,bird_speciesID,gridID,lbci,posterior_median,ubci")
+        self.assertEqual(len(lines), 5)
+
+    # test species and bbox filters with a column projection as ndjson
+    def test_filtered_ndjson(self):
+        response, content = self.get("/results/query/?species=2&bbox=-107,36.5,-106,37&fields=bird_speciesID,gridID&format=ndjson")
+        rows = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(rows, [{"bird_speciesID": self.jay.id, "gridID": self.north.id}])
+
+    # test keyset pagination
+    def test_keyset_pagination(self):
+        ids = list(Results.objects.order_by("id").values_list("id", flat=True))
+        response, content = self.get(f"/results/query/?fields=id&after_id={ids[0]}&limit=2")
+        self.assertEqual(content.decode().split(), ["id", str(ids[1]), str(ids[2])])
+
+    # test the gzipped export
+    def test_gzip(self):
+        response, content = self.get("/grid/query/?gzip=1&fields=Grid_ID")
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertIn('grid_data.csv.gz', response["Content-Disposition"])
+        self.assertEqual(gzip.decompress(content).decode().split(), ["Grid_ID", "NM-CARSON-LE1", "NM-CARSON-LE2"])
+
+    # test bad parameters
+    def test_bad_parameters(self):
+        self.assertEqual(self.client.get("/results/query/?fields=nope").status_code, 400)
+        self.assertEqual(self.client.get("/grid/query/?species=1").status_code, 400)
+        self.assertEqual(self.client.get("/results/query/?after_id=x").status_code, 400)
+        self.assertEqual(self.client.get("/nothing/query/").status_code, 404)
+
+
+# probe tests
+@override_settings(FIREFLIGHT_RENDER_CACHE_DIR=TEST_CACHE_DIR)
+class probeTests(TestCase):
+    def setUp(self):
+        # a fresh data version so the grid index is rebuilt for this test's grids
+        bump_data_version()
+        crow = Species.objects.create(speciesID=1, species="American Crow", birdcode="AMCR")
+        jay = Species.objects.create(speciesID=2, species="Steller's Jay", birdcode="STJA")
+        self.north = Grid.objects.create(OID=1, Grid_ID="NM-CARSON-LE1", Grid_E_NAD83=388500,Grid_N_NAD83=4091500,UTM_Zone=13,Grid_Lat_NAD83=36.96,Grid_Long_NAD83=-106.25,BCR=16,MgmtEntity="US Forest Service", MgmtRegion="USFS Region 3",MgmtUnit="Carson National Forest",MgmtDistrict="Tres Piedras Ranger District",County="Rio Arriba",State="NM",PriorityLandscape="Enchanted Circle",inPL=0)
+        self.south = Grid.objects.create(OID=2, Grid_ID="NM-CARSON-LE2", Grid_E_NAD83=388500,Grid_N_NAD83=4001500,UTM_Zone=13,Grid_Lat_NAD83=36.16,Grid_Long_NAD83=-106.25,BCR=16,MgmtEntity="US Forest Service", MgmtRegion="USFS Region 3",MgmtUnit="Carson National Forest",MgmtDistrict="Questa Ranger District",County="Taos",State="NM",PriorityLandscape="Enchanted Circle",inPL=0)
+
+        Results.objects.create(bird_speciesID=crow, gridID=self.north, lbci=0.1, posterior_median=0.2, ubci=0.3)
+        Results.objects.create(bird_speciesID=jay, gridID=self.north, lbci=0.4, posterior_median=0.5, ubci=0.6)
+        Results.objects.create(bird_speciesID=crow, gridID=self.south, lbci=0.7, posterior_median=0.8, ubci=0.9)
+
+    # test that a point finds its nearest grid and that grid's likeliest species
+    def test_probe(self):
+        response = self.client.get("/probe/?lat=36.9&lon=-106.2")
+        self.assertEqual(response.status_code, 200)
+        probe = response.json()
+        self.assertEqual(probe["grid"]["Grid_ID"], "NM-CARSON-LE1")
+        self.assertEqual(probe["grid"]["MgmtDistrict"], "Tres Piedras Ranger District")
+        self.assertAlmostEqual(probe["grid"]["distance_m"], 8030, delta=100)
+        self.assertEqual([species["birdcode"] for species in probe["species"]], ["STJA", "AMCR"])
+        self.assertEqual((probe["species"][0]["lbci"], probe["species"][0]["ubci"]), (0.4, 0.6))
+
+        self.assertEqual(self.client.get("/probe/?lat=36.2&lon=-106.3&n=1").json()["species"][0]["birdcode"], "AMCR")
+        self.assertEqual(len(self.client.get("/probe/?lat=36.9&lon=-106.2&n=1").json()["species"]), 1)
+
+    # test that the index follows the data version
+    def test_index_rebuilt(self):
+        self.assertEqual(self.client.get("/probe/?lat=35.5&lon=-106.25").json()["grid"]["Grid_ID"], "NM-CARSON-LE2")
+        Grid.objects.create(OID=3, Grid_ID="NM-CARSON-LE3", Grid_E_NAD83=388500,Grid_N_NAD83=3930000,UTM_Zone=13,Grid_Lat_NAD83=35.5,Grid_Long_NAD83=-106.25,BCR=16,MgmtEntity="US Forest Service", MgmtRegion="USFS Region 3",MgmtUnit="Carson National Forest",MgmtDistrict="Questa Ranger District",County="Taos",State="NM",PriorityLandscape="Enchanted Circle",inPL=0)
+        bump_data_version()
+        self.assertEqual(self.client.get("/probe/?lat=35.5&lon=-106.25").json()["grid"]["Grid_ID"], "NM-CARSON-LE3")
+
+    # test bad and far away points
+    def test_bad_probe(self):
+        self.assertEqual(self.client.get("/probe/?lat=36.9").status_code, 400)
+        self.assertEqual(self.client.get("/probe/?lat=north&lon=-106.2").status_code, 400)
+        self.assertEqual(self.client.get("/probe/?lat=nan&lon=-106.2").status_code, 400)
+        self.assertEqual(self.client.get("/probe/?lat=36.9&lon=-106.2&n=0").status_code, 400)
+        self.assertEqual(self.client.get("/probe/?lat=10&lon=10&max_distance=5000").status_code, 404)
+
+
+# map tile tests
+@override_settings(FIREFLIGHT_RENDER_CACHE_DIR=TEST_CACHE_DIR)
+class tileTests(TestCase):
+    # test tile edges at the top zoom level
+    def test_tile_bounds(self):
+        west, south, east, north = tile_bounds(0, 0, 0)
+        self.assertEqual((west, east), (-180.0, 180.0))
+        self.assertAlmostEqual(north, 85.0511, places=3)
+        self.assertAlmostEqual(south, -85.0511, places=3)
+
+    # test that coarse zooms sample coarse pyramid levels
+    def test_pyramid_levels(self):
+        pyramid = RasterPyramid(np.ones((8, 8)), -105.0, 37.0, 0.01, 0.0, 1.0)
+        self.assertEqual([level.shape for level in pyramid.levels], [(8, 8), (4, 4), (2, 2), (1, 1)])
+        self.assertEqual(pyramid.level_for(0.005), 0)
+        self.assertEqual(pyramid.level_for(0.02), 1)
+        self.assertEqual(pyramid.level_for(10), 3)
+
+    # test serving and caching a tile from a stored render
+    def test_tile_view(self):
+        renderDir = os.path.join(TEST_CACHE_DIR, "tile-test")
+        os.makedirs(renderDir, exist_ok=True)
+        write_overlay(renderDir, np.linspace(0, 1, 2500, dtype=np.float32).reshape(50, 50), -105.5, 36.5, 0.01)
+
+        # zoom 9 tile over the raster
+        response = self.client.get("/tiles/tile-test/9/106/200.png")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertTrue(response.content.startswith(b"\x89PNG"))
+        self.assertTrue(os.path.isfile(os.path.join(renderDir, "tiles", "median", "9", "106", "200.png")))
+
+        # bands other than the median only exist for multi-band renders
+        self.assertEqual(self.client.get("/tiles/tile-test/width/9/106/200.png").status_code, 404)
+        write_overlay(renderDir, np.stack([np.linspace(0, 1, 2500, dtype=np.float32).reshape(50, 50)] * 4), -105.5, 36.5, 0.01)
+        self.assertEqual(self.client.get("/tiles/tile-test/width/9/106/200.png").status_code, 200)
+        self.assertEqual([band["band"] for band in self.client.get("/overlay/tile-test/").json()["bands"]],
+                         ["median", "lbci", "ubci", "width"])
+        self.assertEqual(self.client.get("/tiles/tile-test/bogus/9/106/200.png").status_code, 404)
+
+        self.assertEqual(self.client.get("/tiles/tile-test/30/0/0.png").status_code, 404)
+        self.assertEqual(self.client.get("/tiles/missing/1/0/0.png").status_code, 404)
+
+
+# conditional GET tests
+@override_settings(FIREFLIGHT_RENDER_CACHE_DIR=TEST_CACHE_DIR)
+class conditionalGetTests(TestCase):
+    def setUp(self):
+        crow = Species.objects.create(speciesID=1, species="American Crow", birdcode="AMCR")
+        jay = Species.objects.create(speciesID=2, species="Steller's Jay", birdcode="STJA")
+        grid = Grid.objects.create(OID=1, Grid_ID="NM-CARSON-LE1", Grid_E_NAD83=388500,Grid_N_NAD83=4091500,UTM_Zone=13,Grid_Lat_NAD83=36.96,Grid_Long_NAD83=-106.25,BCR=16,MgmtEntity="US Forest Service", MgmtRegion="USFS Region 3",MgmtUnit="Carson National Forest",MgmtDistrict="Tres Piedras Ranger District",County="Rio Arriba",State="NM",PriorityLandscape="Enchanted Circle",inPL=0)
+        for species in (crow, jay):
+            Results.objects.create(bird_speciesID=species, gridID=grid, lbci=0.1, posterior_median=0.2, ubci=0.3)
+
+    # test that the map page, overlay, images and tiles of a render are revalidated with 304s
+    def test_render_views(self):
+        renderDir = os.path.join(TEST_CACHE_DIR, "etag-test")
+        os.makedirs(renderDir, exist_ok=True)
+        write_overlay(renderDir, np.linspace(0, 1, 2500, dtype=np.float32).reshape(50, 50), -105.5, 36.5, 0.01)
+
+        for url in ("/enchanted-circle-map/?render=etag-test&embed=True", "/overlay/etag-test/",
+                    "/overlay/etag-test/median.png", "/tiles/etag-test/9/106/200.png"):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertTrue(response.has_header("Last-Modified"), url)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304, url)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]).status_code, 304, url)
+
+        # missing renders are still not found
+        self.assertEqual(self.client.get("/enchanted-circle-map/?render=nothing", HTTP_IF_NONE_MATCH="*").status_code, 404)
+        self.assertEqual(self.client.get("/overlay/nothing/median.png").status_code, 404)
+
+    # test that an unchanged export is answered with a 304 until the data version changes
+    def test_query_export(self):
+        with tempfile.TemporaryDirectory() as cacheDir, override_settings(FIREFLIGHT_RENDER_CACHE_DIR=cacheDir):
+            bump_data_version()
+            response = self.client.get("/results/query/?species=1")
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.has_header("Last-Modified"))
+            etag = response["ETag"]
+
+            self.assertEqual(self.client.get("/results/query/?species=1", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertNotEqual(self.client.get("/results/query/?species=2")["ETag"], etag)
+            bump_data_version()
+            self.assertEqual(self.client.get("/results/query/?species=1", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+# precompressed page tests
+@override_settings(FIREFLIGHT_RENDER_CACHE_DIR=TEST_CACHE_DIR)
+class precompressTests(TestCase):
+    # test that the map shell is sent precompressed to browsers that accept it
+    def test_precompressed_shell(self):
+        renderDir = os.path.join(TEST_CACHE_DIR, "gzip-test")
+        os.makedirs(renderDir, exist_ok=True)
+        write_overlay(renderDir, np.ones((5, 5), dtype=np.float32), -105.5, 36.5, 0.01)
+        url = "/enchanted-circle-map/?render=gzip-test"
+
+        plain = self.client.get(url)
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        compressed = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(compressed["Content-Encoding"], "gzip")
+        self.assertEqual(compressed["Vary"], "Accept-Encoding")
+        plainBody, compressedBody = b"".join(plain.streaming_content), b"".join(compressed.streaming_content)
+        self.assertEqual(gzip.decompress(compressedBody), plainBody)
+        self.assertLess(len(compressedBody), len(plainBody) / 2)
+        self.assertNotEqual(plain["ETag"], compressed["ETag"])
+
+        # a refused coding is never sent
+        self.assertFalse(self.client.get(url, HTTP_ACCEPT_ENCODING="gzip;q=0, br;q=0").has_header("Content-Encoding"))
+
+    # test picking the sibling file for an Accept-Encoding header
+    def test_compressed_variant(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path = os.path.join(tmpDir, "page.html")
+            with open(path, "wb") as pageFile:
+                pageFile.write(b"<html></html>" * 100)
+            write_compressed(path)
+
+            self.assertEqual(compressed_variant(path, "gzip"), (path + ".gz", "gzip"))
+            self.assertEqual(compressed_variant(path, "*"), compressed_variant(path, "br, gzip"))
+            self.assertEqual(compressed_variant(path, "identity"), (path, None))
+            self.assertEqual(compressed_variant(path, "gzip;q=0"), (path, None))
+            self.assertEqual(compressed_variant(path, None), (path, None))
+
+
+# benchmark command tests
+@override_settings(FIREFLIGHT_RENDER_CACHE_DIR=TEST_CACHE_DIR)
+class benchmarkTests(TestCase):
+    # test a tiny benchmark run in the test database (the command itself makes a throwaway one)
+    def test_benchmark_report(self):
+        options = {"species": 3, "grids": 16, "selection": 2, "repeat": 1, "chunk_size": 5000, "seed": 0}
+        with tempfile.TemporaryDirectory() as workDir:
+            report = benchmark.Command(stdout=StringIO()).run_benchmarks(workDir, options)
+
+        self.assertEqual(report["scale"]["selection"], 2)
+        self.assertEqual(report["scale"]["results"], 48)
+        self.assertEqual(Results.objects.count(), 48)
+        self.assertEqual(set(report["timings"]), {
+            "populate_species", "populate_grid", "populate_results", "get_csv", "query_export_results",
+            "create_heatmap", "create_heatmap_all", "generate_enchanted_circle_map", "generate_enchanted_circle_map_all"})
+
+
+# timing instrumentation tests
+class timingTests(TestCase):
+    def setUp(self):
+        metrics.clear()
+
+    # test that stages end up in the metrics histograms
+    def test_stage_histogram(self):
+        with stage("unit"):
+            pass
+        text = metrics.render()
+        self.assertIn('fireflight_stage_seconds_bucket{stage="unit",le="+Inf"} 1', text)
+        self.assertIn('fireflight_stage_seconds_count{stage="unit"} 1', text)
+
+    # test reading a command's stage report back from its stderr
+    def test_record_command(self):
+        record_command("create_heatmap", 0.5, "some warning\n" + TIMING_PREFIX + json.dumps([["gaussian_filter", 0.2]]))
+        text = metrics.render()
+        self.assertIn('fireflight_command_seconds_count{command="create_heatmap"} 1', text)
+        self.assertIn('fireflight_stage_seconds_sum{stage="create_heatmap.gaussian_filter"} 0.200000', text)
+
+    # test the Server-Timing header and the metrics endpoint
+    def test_server_timing_and_metrics(self):
+        response = self.client.get("/species/query/")
+        self.assertIn("total;dur=", response["Server-Timing"])
+        self.assertIn('fireflight_view_seconds_count{view="query"} 1', self.client.get("/metrics/").content.decode())
+        self.assertEqual(self.client.get("/metrics/", REMOTE_ADDR="10.0.0.1").status_code, 404)
+
+
+# raster stack tests
+@override_settings(FIREFLIGHT_RENDER_CACHE_DIR=TEST_CACHE_DIR, FIREFLIGHT_RASTER_STACK_DIR=os.path.join(TEST_CACHE_DIR, "stack"))
+class rasterStackTests(TestCase):
+    def setUp(self):
+        self.crow = Species.objects.create(speciesID=1, species="American Crow", birdcode="AMCR")
+        self.jay = Species.objects.create(speciesID=2, species="Steller's Jay", birdcode="STJA")
+        self.grids = []
+        for oid, (lat, lon) in enumerate([(36.0, -105.0), (36.1, -105.0), (36.0, -104.9), (36.1, -104.9)], start=1):
+            self.grids.append(Grid.objects.create(OID=oid, Grid_ID=f"NM-TEST-{oid}", Grid_E_NAD83=0, Grid_N_NAD83=0, UTM_Zone=13,
+                                                  Grid_Lat_NAD83=lat, Grid_Long_NAD83=lon, BCR=16, MgmtEntity="", MgmtRegion="",
+                                                  MgmtUnit="", MgmtDistrict="", County="", State="NM", PriorityLandscape="", inPL=0))
+        for species, medians in ((self.crow, [0.1, 0.2, 0.3, 0.4]), (self.jay, [0.5, 0.0, 0.5, 0.9])):
+            for grid, median in zip(self.grids, medians):
+                Results.objects.create(bird_speciesID=species, gridID=grid, lbci=0, posterior_median=median, ubci=1)
+
+    # test that the composite matches smoothing the selection directly
+    def test_composite_matches_direct_render(self):
+        from scipy.ndimage import gaussian_filter
+        self.assertEqual(build_stack()[:2], (2, 2))
+
+        raster, west, north, pixelSize = composite(["1", "2"])
+        results = Results.objects.select_related("gridID")
+        direct, _, _ = rasterize([r.gridID.Grid_Lat_NAD83 for r in results], [r.gridID.Grid_Long_NAD83 for r in results],
+                                 [(r.posterior_median, r.lbci, r.ubci) for r in results], pixelSize)
+        expected = np.stack([gaussian_filter(band, sigma=5) * 20 for band in direct])
+        self.assertEqual((west, north), (-105.0, 36.1))
+        # median, lbci and ubci bands, then the interval width
+        self.assertEqual(raster.shape[0], 4)
+        self.assertTrue(np.allclose(raster[:3], expected, atol=1e-5))
+        self.assertTrue(np.allclose(raster[3], expected[2] - expected[1], atol=1e-5))
+        self.assertIsNone(composite(["99"]))
+
+    # test that a composite and an on-demand render of a selection smaller than the grid match,
+    # since both are stored under the same render key
+    def test_composite_matches_render_command(self):
+        owl = Species.objects.create(speciesID=3, species="Flammulated Owl", birdcode="FLOW")
+        Results.objects.create(bird_speciesID=owl, gridID=self.grids[0], lbci=0.2, posterior_median=0.6, ubci=0.9)
+        self.assertIsNone(selection_raster(["3"], stack_only=True))
+        fromDatabase, _, _ = selection_raster(["3"], coordinates=grid_coordinates())
+        build_stack()
+        np.testing.assert_allclose(selection_raster(["3"], stack_only=True)[0], fromDatabase, atol=1e-5)
+
+        raster, west, north, pixelSize = composite(["3"])
+        with tempfile.TemporaryDirectory() as outputDir:
+            call_command("generate_enchanted_circle_map", "--species", "3", "--output-dir", outputDir, "--overlay-only",
+                         stdout=StringIO(), stderr=StringIO())
+            rendered = np.load(os.path.join(outputDir, "heatmap_raster.npy"))
+            with open(os.path.join(outputDir, "heatmap_raster.json")) as metaFile:
+                meta = json.load(metaFile)
+        self.assertEqual((meta["west"], meta["north"]), (west, north))
+        np.testing.assert_allclose(rendered, raster[0], atol=1e-5)
+
+    # test that species sharing a name still get one layer each
+    def test_duplicate_species_names(self):
+        twin = Species.objects.create(speciesID=3, species="American Crow", birdcode="AMC2")
+        for grid, median in zip(self.grids, [0.9, 0.8, 0.7, 0.6]):
+            Results.objects.create(bird_speciesID=twin, gridID=grid, lbci=0, posterior_median=median, ubci=1)
+        self.assertEqual(build_stack(full=True)[:2], (3, 3))
+
+        from scipy.ndimage import gaussian_filter
+        raster, _, _, pixelSize = composite(["3"])
+        results = Results.objects.filter(bird_speciesID=twin).select_related("gridID")
+        direct, _, _ = rasterize([r.gridID.Grid_Lat_NAD83 for r in results], [r.gridID.Grid_Long_NAD83 for r in results],
+                                 [(r.posterior_median, r.lbci, r.ubci) for r in results], pixelSize)
+        np.testing.assert_allclose(raster[0], gaussian_filter(direct[0], sigma=5) * 20, atol=1e-5)
+
+    # test that a rebuild only redoes changed species, and that new data makes the stack stale
+    def test_incremental_rebuild(self):
+        build_stack()
+        Results.objects.filter(bird_speciesID=self.jay, gridID=self.grids[0]).update(posterior_median=0.7)
+        self.assertEqual(build_stack()[:2], (2, 1))
+        self.assertIsNotNone(composite(["2"]))
+
+        bump_data_version()
+        self.assertIsNone(composite(["2"]))
+
+
+# PNG colorizer tests
+class colorizeTests(TestCase):
+    # test that the lookup table and quantization match the matplotlib colormap they replace
+    def test_matches_matplotlib(self):
+        from matplotlib.colors import LinearSegmentedColormap
+        from .heatmap import HEATMAP_COLORS
+
+        cmap = LinearSegmentedColormap.from_list("custom_white_to_orange", HEATMAP_COLORS)
+        data = np.random.default_rng(0).random((20, 20)).astype(np.float32)
+        expected = cmap(data, bytes=True)
+        actual = gradient_table()[quantize(data, 0.0, 1.0)]
+        self.assertLessEqual(np.abs(actual.astype(int) - expected.astype(int)).max(), 1)
+
+    # test writing a palette PNG and its clip range
+    def test_colorize_png(self):
+        from PIL import Image
+
+        data = np.arange(100, dtype=np.float32).reshape(10, 10)
+        with tempfile.TemporaryDirectory() as tmpDir:
+            pngPath = os.path.join(tmpDir, "overlay.png")
+            lower, upper = colorize(data, pngPath, compress_level=1)
+            with Image.open(pngPath) as image:
+                self.assertEqual((image.mode, image.size), ("P", (10, 10)))
+        self.assertAlmostEqual(lower, 4.95)
+        self.assertAlmostEqual(upper, 94.05)
+        # a flat raster has nothing to stretch
+        self.assertEqual(quantize(np.ones((2, 2)), 1.0, 1.0).max(), 0)
+
+
+
+# command import time tests
+class commandImportTests(TestCase):
+    # seconds a render command module may take to import once Django is set up
+    IMPORT_BUDGET = 0.25
+    HEAVY_MODULES = {"numpy", "scipy", "rasterio", "matplotlib", "folium", "branca", "jinja2"}
+    COMMANDS = ("create_heatmap", "create_heatmap_all", "generate_enchanted_circle_map", "generate_enchanted_circle_map_all")
+
+    # (top-level modules imported, cumulative seconds of the command module) from python -X importtime
+    def importCommand(self, command):
+        from django.conf import settings
+        import subprocess, sys
+        module = f"map_app.management.commands.{command}"
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import django; django.setup(); import {module}"],
+                                cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        modules, seconds = set(), None
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            _, cumulative, name = line.split("|")
+            modules.add(name.strip().split(".")[0])
+            if name.strip() == module:
+                seconds = int(cumulative) / 1e6
+        return modules, seconds
+
+    # test that the render commands start without loading the rendering libraries
+    def test_command_imports(self):
+        for command in self.COMMANDS:
+            modules, seconds = self.importCommand(command)
+            self.assertEqual(modules & self.HEAVY_MODULES, set(), command)
+            self.assertLess(seconds, self.IMPORT_BUDGET, command)
@@ -0,0 +1,144 @@
+# XYZ map tiles cut on demand from a render's heatmap raster.
+#
+# Tiles are 256px web-mercator tiles sampled from a pyramid of the render's raster: level 0 is
+# the raster itself and every level above it averages 2x2 blocks of the one below. Each tile
+# is sampled from the coarsest level that is still at least as fine as the tile's pixels, so low
+# zooms stay small and deep zooms show the raster at full resolution. Tiles are colored with
+# the overlay gradient, stretched over the same range as the render's PNG, and cached on disk
+# inside the render's directory. Every band of a render (see heatmap.BANDS) has its own tiles.
+
+import io
+import json
+import math
+import os
+import uuid
+from functools import lru_cache
+
+import numpy as np
+
+from .colorize import clip_range, gradient_table, png_compress_level, quantize
+from .heatmap import BANDS, TILE_MAX_ZOOM, band_file
+
+TILE_SIZE = 256
+
+# name of the tile cache folder inside a render directory
+TILES_DIR = 'tiles'
+
+
+# west, south, east, north edges of a tile in degrees
+def tile_bounds(z, x, y):
+    n = 2 ** z
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+# halves a raster by averaging 2x2 blocks, padding odd edges with zeros
+def downsample(data):
+    rows, cols = data.shape
+    padded = np.zeros((rows + rows % 2, cols + cols % 2), dtype=np.float32)
+    padded[:rows, :cols] = data
+    return padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).mean(axis=(1, 3))
+
+
+class RasterPyramid:
+    def __init__(self, data, west, north, pixel_size, lower, upper):
+        self.levels = [data.astype(np.float32)]
+        while max(self.levels[-1].shape) > 1:
+            self.levels.append(downsample(self.levels[-1]))
+        self.west = west
+        self.north = north
+        self.pixel_size = pixel_size
+        self.east = west + data.shape[1] * pixel_size
+        self.south = north - data.shape[0] * pixel_size
+        self.lower = lower
+        self.upper = upper
+
+    def intersects(self, west, south, east, north):
+        return west < self.east and east > self.west and south < self.north and north > self.south
+
+    # coarsest level whose cells are no larger than tile pixels of the given width in degrees
+    def level_for(self, tile_pixel_size):
+        level = 0
+        while level + 1 < len(self.levels) and self.pixel_size * 2 ** (level + 1) <= tile_pixel_size:
+            level += 1
+        return level
+
+    # RGBA array for tile z/x/y, transparent outside the raster
+    def render(self, z, x, y):
+        west, south, east, north = tile_bounds(z, x, y)
+        level = self.level_for((east - west) / TILE_SIZE)
+        data = self.levels[level]
+        cell = self.pixel_size * 2 ** level
+
+        # longitude is linear across the tile, latitude follows the mercator projection
+        n = 2 ** z
+        fractions = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+        lons = west + fractions * (east - west)
+        lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + fractions) / n))))
+
+        cols = np.floor((lons - self.west) / cell).astype(np.intp)
+        rows = np.floor((self.north - lats) / cell).astype(np.intp)
+        col_ok = (cols >= 0) & (cols < data.shape[1])
+        row_ok = (rows >= 0) & (rows < data.shape[0])
+
+        values = data[np.clip(rows, 0, data.shape[0] - 1)[:, None], np.clip(cols, 0, data.shape[1] - 1)[None, :]]
+        rgba = gradient_table()[quantize(values, self.lower, self.upper)]
+        rgba[~(row_ok[:, None] & col_ok[None, :])] = 0
+        return rgba
+
+
+# loads a render band's raster, placement and color range into a pyramid, cached per file version
+@lru_cache(maxsize=8)
+def load_pyramid(raster_path, meta_path, mtime, band=BANDS[0]):
+    data = np.load(raster_path)
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+
+    band_range = meta.get('bands', {}).get(band) or (meta.get('range') if band == BANDS[0] else None)
+    lower, upper = band_range or clip_range(data)
+    return RasterPyramid(data, meta['west'], meta['north'], meta['pixel_size'], float(lower), float(upper))
+
+
+# the empty tile served outside the raster
+@lru_cache(maxsize=1)
+def blank_tile():
+    return encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+
+def encode_png(rgba):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buffer, format='PNG', compress_level=png_compress_level())
+    return buffer.getvalue()
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= TILE_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+# PNG bytes of tile z/x/y of a band of the render stored in render_dir
+def get_tile(render_dir, raster_name, meta_name, z, x, y, band=BANDS[0]):
+    tile_path = os.path.join(render_dir, TILES_DIR, band, str(z), str(x), f'{y}.png')
+    try:
+        with open(tile_path, 'rb') as tile_file:
+            return tile_file.read()
+    except OSError:
+        pass
+
+    raster_path = os.path.join(render_dir, band_file(raster_name, band))
+    pyramid = load_pyramid(raster_path, os.path.join(render_dir, meta_name), os.path.getmtime(raster_path), band)
+    if not pyramid.intersects(*tile_bounds(z, x, y)):
+        return blank_tile()
+    tile = encode_png(pyramid.render(z, x, y))
+
+    # write through a temporary name so concurrent requests never read a partial tile
+    os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+    tmp_path = f'{tile_path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'wb') as tile_file:
+        tile_file.write(tile)
+    os.replace(tmp_path, tile_path)
+    return tile
@@ -0,0 +1,155 @@
+# Per-stage timing for the map pipeline.
+#
+# Wrap a piece of work in `with stage("name"):` to time it. Every stage is recorded in a latency
+# histogram served by the /metrics endpoint, next to the per-view and per-command histograms, and
+# logged as a key=value line on the "map_app.timing" logger. Inside a view decorated with
+# @server_timing the stages are also returned to the browser in a Server-Timing header.
+#
+# The render commands run as subprocesses, so they cannot record into the web process directly.
+# A command decorated with @command_timing prints its stages as one TIMING_PREFIX line on
+# stderr when it finishes, and record_command() in the web process reads that line back and
+# records the stages under the command's name.
+
+import contextvars
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger("map_app.timing")
+
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# marks the stderr line a command reports its stages on
+TIMING_PREFIX = "fireflight-timing "
+
+# (name, seconds) pairs collected for the current request or command, None outside of one
+_collected = contextvars.ContextVar("fireflight_timings", default=None)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    # records one observation for (metric, label value)
+    def observe(self, metric, name, seconds):
+        with self._lock:
+            self._histograms.setdefault((metric, name), Histogram()).observe(seconds)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    # Prometheus text exposition of every histogram
+    def render(self):
+        with self._lock:
+            snapshot = sorted((key, list(h.counts), h.total, h.count) for key, h in self._histograms.items())
+
+        lines = []
+        lastMetric = None
+        for (metric, name), counts, total, count in snapshot:
+            label = metric.split("_")[1]
+            if metric != lastMetric:
+                lines.append(f"# TYPE {metric} histogram")
+                lastMetric = metric
+            cumulative = 0
+            for bound, bucketCount in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += bucketCount
+                lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{{label}="{name}"}} {total:.6f}')
+            lines.append(f'{metric}_count{{{label}="{name}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+# histograms shared by this process
+metrics = Metrics()
+
+
+# records a finished stage everywhere it is reported
+def record(name, seconds, metric="fireflight_stage_seconds"):
+    metrics.observe(metric, name, seconds)
+    logger.info("stage=%s duration_ms=%.1f", name, seconds * 1000)
+    collected = _collected.get()
+    if collected is not None:
+        collected.append((name, seconds))
+
+
+# times the enclosed block as stage name
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+# view decorator that reports the request's stages in a Server-Timing header
+def server_timing(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        collected = []
+        token = _collected.set(collected)
+        start = time.perf_counter()
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _collected.reset(token)
+        total = time.perf_counter() - start
+        record(view.__name__, total, metric="fireflight_view_seconds")
+        if response is None:
+            return response
+        collected.append(("total", total))
+        response["Server-Timing"] = ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in collected)
+        return response
+    return wrapper
+
+
+# management command handle() decorator that reports the command's stages on stderr
+def command_timing(handle):
+    @wraps(handle)
+    def wrapper(self, *args, **kwargs):
+        collected = []
+        token = _collected.set(collected)
+        try:
+            return handle(self, *args, **kwargs)
+        finally:
+            _collected.reset(token)
+            self.stderr.write(TIMING_PREFIX + json.dumps(collected))
+    return wrapper
+
+
+# records a finished command and the stages it reported in its stderr output
+def record_command(command, seconds, stderr=""):
+    record(command, seconds, metric="fireflight_command_seconds")
+    for line in (stderr or "").splitlines():
+        if not line.startswith(TIMING_PREFIX):
+            continue
+        try:
+            stages = json.loads(line[len(TIMING_PREFIX):])
+        except ValueError:
+            continue
+        for name, stageSeconds in stages:
+            record(f"{command}.{name}", stageSeconds)
+
+
+# strips the timing report from a command's stderr, leaving any real error output
+def command_errors(stderr):
+    return "\n".join(line for line in (stderr or "").splitlines() if not line.startswith(TIMING_PREFIX))
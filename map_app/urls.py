@@ -1,12 +1,24 @@
 from django.urls import path
 
-from . import views
+from . import async_views, views
+
+# under ASGI the render, tile and export views run on a bounded thread pool (async_views.py)
+heavy = async_views if async_views.enabled() else views
 
 urlpatterns = [
     path("", views.index, name="index"),
-    path("map/", views.map, name="Map"),
+    path("map/", heavy.map, name="Map"),
+    path("map/jobs/<str:job_id>/", views.render_job_status, name="render_job_status"),
     path('enchanted-circle-map/', views.enchanted_circle_map, name='enchanted_circle_map'),
-    path("<str:modelName>/query/", views.query, name="query"),
+    path("overlay/<str:render_id>/", views.overlay, name="overlay"),
+    path("overlay/<str:render_id>/image.png", views.overlay_image, name="overlay_image"),
+    path("overlay/<str:render_id>/<str:band>.png", views.overlay_image, name="overlay_band_image"),
+    path("probe/", views.probe, name="probe"),
+    path("metrics/", views.metrics_view, name="metrics"),
+    path("render-cache/stats/", views.render_cache_stats, name="render_cache_stats"),
+    path("tiles/<str:render_id>/<int:z>/<int:x>/<int:y>.png", heavy.tile, name="tile"),
+    path("tiles/<str:render_id>/<str:band>/<int:z>/<int:x>/<int:y>.png", heavy.tile, name="band_tile"),
+    path("<str:modelName>/query/", heavy.query, name="query"),
     path("instructions/", views.instructions, name="instructions"),
-    path("download/", views.download, name="download"),
+    path("download/", heavy.download, name="download"),
 ]
\ No newline at end of file
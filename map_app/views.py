@@ -1,13 +1,25 @@
 #Everyone
 
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, HttpResponseNotFound, FileResponse
+from django.http import HttpResponse, FileResponse, HttpResponseBadRequest, HttpResponseNotFound, JsonResponse, StreamingHttpResponse
 from csp.decorators import csp_exempt
-import csv, datetime, time
-from django.core.management import call_command
-import subprocess, sys
-
-from .models import Species, Grid, Results
+import csv, datetime
+from django.conf import settings
+from django.views.decorators.http import condition
+
+from .models import Species, Results
+from .render_cache import render_cache, render_key, full_map_key, latest_full_map, set_latest_full_map, data_version, data_version_time, HTML_NAME, META_NAME, PNG_NAME, RASTER_NAME
+from .heatmap import BAND_LABELS, BANDS, RENDER_PARAMS, TILE_MAX_ZOOM, band_file
+from .raster import selection_raster, write_overlay
+from .selection import format_species
+from .map_shell import SHELL_VERSION, get_shell
+from .precompress import compressed_variant
+from .probe import grid_index, top_species
+from .tiles import get_tile, valid_tile
+from .render_jobs import render_queue
+from .exports import MODELS as EXPORT_MODELS, Echo, ExportError, exportStream
+from .timing import metrics, server_timing, stage
+import hashlib, os, uuid
 
 def index(request):
     # set page to load
@@ -19,6 +31,7 @@ def index(request):
 
 
 @csp_exempt  # currently not enforcing the set csp protection rules
+@server_timing
 def map(request):
     # set page to load
     map_page = "map.html"
@@ -27,144 +40,414 @@ def map(request):
     
 
     if request.method == "GET":
+            # A filtered render job the page should wait for, if any.
+            jobID = request.GET.get("job")
+
             # Check if an update was recently applied.
-            if not request.session.get("filter_applied", False):
-                # Initial load: generate the full DB heatmap.
-                run_django_command("create_heatmap_all")
-                run_django_command("generate_enchanted_circle_map_all")
+            if not request.session.get("filter_applied", False) and not jobID:
+                # Initial load: show the full DB heatmap for the current data version, or the last one
+                # while it is rebuilt in the background.
+                renderID, rebuild = current_full_map()
+                request.session["render"] = renderID
+                # The page swaps in the rebuilt map once it is done.
+                if rebuild is not None:
+                    jobID = rebuild.id
+                # The full map is on screen, so the export covers every species.
+                request.session.pop("birdList", None)
             else:
                 # Clear the flag so future GETs will run the full DB commands again.
                 request.session["filter_applied"] = False
 
-            timestamp = datetime.datetime.now().timestamp()
-            return render(request, map_page, {'birds': birds, 'timestamp': timestamp, 'embed': True})
+            with stage("species"):
+                birds = list(birds)
+
+            context = {
+                'birds': birds,
+                # the render id keys the overlay, the shell version the page around it
+                'shell_version': SHELL_VERSION,
+                'embed': True,
+                'job_id': jobID,
+                'render_id': request.session.get("render") or "",
+            }
+            with stage("template"):
+                return render(request, map_page, context)
         
     if request.method == "POST":
         # Get the list of bird species requested.
         birdList = request.POST.getlist("birdSpecies")
-        # Create new CSV file with current parameters.
-        getCSV(birdList)
-        # Update map with filtered commands.
-        run_django_command("create_heatmap")
-        run_django_command("generate_enchanted_circle_map")
+        # Remember the selection so the export matches the map on screen.
+        request.session["birdList"] = birdList
+
+        # Queue the render; a newer selection from the same client cancels the older job.
+        clientID = request.session.setdefault("render_client", uuid.uuid4().hex)
+        job = render_queue.submit(clientID, birdList, render_selection)
+
         # Set a flag so that the GET branch does not override the filtered map.
         request.session["filter_applied"] = True
-        time.sleep(10)
-        # Redirect to force a fresh GET request.
-        return redirect('/map/')
+
+        # The map page submits with fetch and polls the job itself.
+        if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+            return JsonResponse({
+                "job_id": job.id,
+                "status": job.status,
+                "status_url": f"/map/jobs/{job.id}/",
+            }, status=202)
+
+        # Without JavaScript, go back to the map page, which polls the job.
+        return redirect(f'/map/?job={job.id}')
+
+
+# render job target: builds (or reuses) the filtered map for job.species and returns its URL
+def render_selection(job):
+    # The render id is the selection's cache key.
+    try:
+        key = render_key(job.species)
+    except ValueError:
+        raise ValueError("Invalid species selection")
+
+    # A repeat selection is served from its finished directory without touching the DB or rerendering.
+    if render_cache.get(key) is None:
+        # Render into a private directory so concurrent jobs never share files.
+        stagingDir = render_cache.new_staging_dir()
+        try:
+            # Sum maps come straight from the precomputed per-species layers when they are current.
+            composited = selection_raster(job.species, stack_only=True)
+
+            if composited is not None:
+                with stage("write_overlay"):
+                    write_overlay(stagingDir, *composited, RENDER_PARAMS["pixel_size"])
+            else:
+                # Build the filtered overlay; the command reads the selection from the database itself.
+                rendered = job.run_command("generate_enchanted_circle_map", "--species", format_species(job.species),
+                                           "--output-dir", stagingDir, "--overlay-only")
+                if not rendered:
+                    raise RuntimeError("Heatmap render failed")
+        except BaseException:
+            render_cache.discard(stagingDir)
+            raise
+        # Publish the finished render in one rename.
+        render_cache.commit(key, stagingDir)
+
+    job.render_id = key
+    return f"/enchanted-circle-map/?render={key}&embed=True"
+
+
+# render queue client the full-database rebuilds run under
+FULL_MAP_CLIENT = "full-map"
+
+
+# render job target: builds the full-database map for the current data version and returns its URL
+def render_full_map(job):
+    key = full_map_key()
+    if render_cache.get(key) is None:
+        stagingDir = render_cache.new_staging_dir()
+        try:
+            rendered = job.run_command("generate_enchanted_circle_map_all", "--output-dir", stagingDir, "--overlay-only")
+            if not rendered:
+                raise RuntimeError("Heatmap render failed")
+        except BaseException:
+            render_cache.discard(stagingDir)
+            raise
+        render_cache.commit(key, stagingDir)
+
+    # later requests fall back to this map while the next data version is rendered
+    set_latest_full_map(key)
+    job.render_id = key
+    return f"/enchanted-circle-map/?render={key}&embed=True"
+
+
+# returns (render id of the full-database map to show or None, rebuild job or None)
+def current_full_map():
+    key = full_map_key()
+    if render_cache.path(key, META_NAME) is not None:
+        return key, None
+
+    # the data changed (or nothing was rendered yet): rebuild once in the background and
+    # keep showing the previous full map meanwhile
+    rebuild = render_queue.submit(FULL_MAP_CLIENT, [], render_full_map, replace=False)
+    previous = latest_full_map()
+    if render_cache.path(previous, META_NAME) is None:
+        previous = None
+    return previous, rebuild
+
+
+@csp_exempt
+def render_job_status(request, job_id):
+    # queued/running/done/failed/cancelled plus the map URL once the job is done
+    # any worker answers from the job records shared through the render cache (see render_jobs.py)
+    jobStatus = render_queue.status(job_id)
+    if jobStatus is None:
+        return JsonResponse({"job_id": job_id, "status": "unknown", "error": "Job not found"}, status=404)
+    return JsonResponse(jobStatus)
 
 
 #add search method
 
 
 
-def run_django_command(command):
-    try:
-        subprocess.run(
-            [sys.executable, 'manage.py'] + command.split(),
-            check=True,
-            capture_output=True,
-            text=True
-        )
-    except subprocess.CalledProcessError as e:
-        print(f"Command '{command}' failed: {e.stderr}")
+# latency histograms per stage and per command, for a local Prometheus scrape
+def metrics_view(request):
+    if request.META.get("REMOTE_ADDR") not in ("127.0.0.1", "::1") and not getattr(settings, "FIREFLIGHT_METRICS_PUBLIC", False):
+        return HttpResponseNotFound("<h1>Error: Page Not Found!</h1>")
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4")
+
+
+@csp_exempt
+def render_cache_stats(request):
+    # hit/miss counters and cache size, used for sizing the render cache
+    return JsonResponse(render_cache.stats())
+
+
+#####################################################
+#           Conditional GET validators              #
+#####################################################
+
+# Render ids are content addressed, so the files of a render never change: their validators come
+# from the render id and the file times. Exports change with the data version.
+
+# modification time of a file as an aware datetime, or None if there is no file
+def fileModified(filePath):
+    if filePath is None:
+        return None
+    return datetime.datetime.fromtimestamp(os.path.getmtime(filePath), tz=datetime.timezone.utc)
+
+
+# (file, content coding) of the map shell sent for a request, picked from Accept-Encoding
+def shellVariant(request):
+    return compressed_variant(get_shell(), request.headers.get('Accept-Encoding'))
+
+
+# ETag of the map shell for a render, None when the render does not exist; every content coding
+# is a different representation with its own ETag
+def mapEtag(request):
+    renderID = request.GET.get('render')
+    if render_cache.path(renderID, META_NAME) is None:
+        return None
+    _, encoding = shellVariant(request)
+    return f"shell-v{SHELL_VERSION}-{renderID}" + (f"-{encoding}" if encoding else "")
+
+
+def mapModified(request):
+    if mapEtag(request) is None:
+        return None
+    return fileModified(get_shell())
+
+
+def overlayEtag(request, render_id):
+    return f"overlay-{render_id}" if render_cache.path(render_id, META_NAME) else None
+
+
+def overlayModified(request, render_id):
+    if overlayEtag(request, render_id) is None:
+        return None
+    return fileModified(render_cache.path(render_id, PNG_NAME))
+
+
+def imageEtag(request, render_id, band=BANDS[0]):
+    return f"{render_id}-{band}" if band in BANDS and imageModified(request, render_id, band) else None
+
+
+def imageModified(request, render_id, band=BANDS[0]):
+    return fileModified(render_cache.path(render_id, band_file(PNG_NAME, band)) if band in BANDS else None)
+
+
+def tileEtag(request, render_id, z, x, y, band=BANDS[0]):
+    if band not in BANDS or render_cache.path(render_id, band_file(RASTER_NAME, band)) is None:
+        return None
+    return f"{render_id}-{band}-{z}-{x}-{y}"
+
+
+def tileModified(request, render_id, z, x, y, band=BANDS[0]):
+    return fileModified(render_cache.path(render_id, band_file(RASTER_NAME, band)) if band in BANDS else None)
+
+
+# exports are keyed by the data version and every query parameter
+def queryEtag(request, modelName):
+    if modelName not in EXPORT_MODELS:
+        return None
+    params = sorted((name, request.GET.getlist(name)) for name in request.GET)
+    payload = f"{data_version()}|{modelName}|{params}"
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def queryModified(request, modelName):
+    stampTime = data_version_time()
+    if stampTime is None:
+        return None
+    return datetime.datetime.fromtimestamp(stampTime, tz=datetime.timezone.utc)
 
 
 @csp_exempt  # currently not enforcing the set csp protection rules
+@server_timing
 def download(request):
     
     # get date and time for export name
     curTime = datetime.datetime.now()
     timeStr = curTime.strftime("%m-%d-%Y_%H_%M")
 
-    #create file download
-    response = FileResponse(open("bird_data.csv", 'rb'))
-    response['Content-Type'] = "text/csv"
+    # stream the export for this user's selection straight from the database
+    birdList = request.session.get("birdList")
+    response = StreamingHttpResponse(streamCSV(birdList), content_type="text/csv")
     response['Content-Disposition'] = f'attachment; filename="bird_data_{timeStr}.csv"'
 
     return response
 
 
 @csp_exempt  # currently not enforcing the set csp protection rules
+@condition(etag_func=mapEtag, last_modified_func=mapModified)
 def enchanted_circle_map(request):
-    # get the embed variable
-    embed = request.GET.get('embed')
-
-    # add to a dictionary to pass into the render template
-    context = {
-        'embed': embed
-    }
+    # find the requested render, or the last full map this user was shown
+    renderID = request.GET.get('render')
+    if not renderID:
+        renderID = request.session.get('render')
+        if render_cache.path(renderID, META_NAME) is None:
+            return HttpResponseNotFound("<h1>Error: Map Not Found!</h1>")
+        # the shell reads the render from its own URL
+        query = request.GET.copy()
+        query['render'] = renderID
+        return redirect(f"{request.path}?{query.urlencode()}")
+
+    if render_cache.path(renderID, META_NAME) is None:
+        return HttpResponseNotFound("<h1>Error: Map Not Found!</h1>")
+
+    # every render is shown in the same map shell, which loads the overlay itself; the shell is
+    # sent precompressed when the browser accepts it
+    shellPath, encoding = shellVariant(request)
+    response = FileResponse(open(shellPath, 'rb'), content_type="text/html", filename=HTML_NAME)
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Vary'] = 'Accept-Encoding'
+
+    # browsers keep the page but check back every time, getting a 304 while it is unchanged
+    response['Cache-Control'] = 'no-cache'
+    return response
 
-    # render the template, with embed variable
-    response = render(request, 'enchanted_circle_map.html', context)
 
-    # Force the browser not to cache this response
-    response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response['Pragma'] = 'no-cache'
-    response['Expires'] = '0'
-    return response
+@csp_exempt
+@condition(etag_func=overlayEtag, last_modified_func=overlayModified)
+def overlay(request, render_id):
+    # the overlay description the map shell draws: image, bounds, color range and tile URL of
+    # every band, the median first
+    # read without counting a cache lookup, the hit rate is about repeat selections, not page loads
+    entry = render_cache.meta(render_id)
+    if entry is None:
+        return JsonResponse({"render_id": render_id, "error": "Render not found"}, status=404)
+
+    # renders from before the bands were added only have the median
+    ranges = entry.get("bands") or {BANDS[0]: entry["range"]}
+    bands = []
+    for band in BANDS:
+        if band not in ranges or render_cache.path(render_id, band_file(PNG_NAME, band)) is None:
+            continue
+        hasTiles = render_cache.path(render_id, band_file(RASTER_NAME, band)) is not None
+        bands.append({
+            "band": band,
+            "label": BAND_LABELS[band],
+            "image": f"/overlay/{render_id}/{band}.png",
+            "range": ranges[band],
+            "tiles": f"/tiles/{render_id}/{band}/{{z}}/{{x}}/{{y}}.png" if hasTiles else None,
+        })
+
+    hasTiles = render_cache.path(render_id, RASTER_NAME) is not None
+    return JsonResponse({
+        "render_id": render_id,
+        "image": f"/overlay/{render_id}/image.png",
+        "bounds": entry["bounds"],
+        "range": entry["range"],
+        "tiles": f"/tiles/{render_id}/{{z}}/{{x}}/{{y}}.png" if hasTiles else None,
+        "bands": bands,
+        "max_zoom": TILE_MAX_ZOOM,
+    })
 
 
 @csp_exempt
-def query(request, modelName):
-    # Create the HttpResponse object with the appropriate CSV header.
-    filename = f"{modelName.lower()}_data.csv"
-    response = HttpResponse(
-        content_type="text/csv",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
-    )
+@condition(etag_func=imageEtag, last_modified_func=imageModified)
+def overlay_image(request, render_id, band=BANDS[0]):
+    imagePath = render_cache.path(render_id, band_file(PNG_NAME, band)) if band in BANDS else None
+    if imagePath is None:
+        return HttpResponseNotFound("<h1>Error: Image Not Found!</h1>")
+
+    # render ids never change content, so browsers may keep the image
+    response = FileResponse(open(imagePath, 'rb'), content_type="image/png")
+    response['Cache-Control'] = 'public, max-age=86400'
+    return response
 
-    # make sure a valid model type is being requested
-    modelDict = {
-        "Species": Species,
-        "species": Species,
-        "Grid": Grid,
-        "grid": Grid,
-        "Results": Results,
-        "results": Results
-    }
-
-    # get the db model/table we want:
-    modelChoice = modelDict.get(modelName)
-    # otherwise, return an error
-    if modelChoice is None:
-        return HttpResponseNotFound("<h1>Error: Model Not Found!</h1>")
-    
-    # start a csv writer
-    writer = csv.writer(response)
 
-    # get the fields and write them to the csv
-    fields = [field.name for field in modelChoice._meta.fields]
-    writer.writerow(fields)
+@csp_exempt
+@condition(etag_func=tileEtag, last_modified_func=tileModified)
+def tile(request, render_id, z, x, y, band=BANDS[0]):
+    # find the render band the tile is cut from
+    if band not in BANDS or not valid_tile(z, x, y) or render_cache.path(render_id, band_file(RASTER_NAME, band)) is None:
+        return HttpResponseNotFound("<h1>Error: Tile Not Found!</h1>")
+
+    # render ids never change content, so browsers may keep tiles
+    response = HttpResponse(get_tile(render_cache.entry_dir(render_id), RASTER_NAME, META_NAME, z, x, y, band),
+                            content_type="image/png")
+    response['Cache-Control'] = 'public, max-age=86400'
+    return response
 
-    # get all elements of model from db
-    modelQuerySet = modelChoice.objects.all()
 
-    # write all elements to the csv
-    for entry in modelQuerySet:
-        # variable for holding current row
-        row = []
+# species a probe lists by default, and at most
+PROBE_SPECIES = 5
+PROBE_MAX_SPECIES = 50
 
-        # for field in database row's fields
-        for field in fields:
-            # get the attribute's value
-            value = getattr(entry, field)
 
-            # find out what it is
-            fieldObj = modelChoice._meta.get_field(field)
-            
-            # if a primary key, get the key's id value
-            if fieldObj.is_relation:
-                value = getattr(value, "id", value)
+@csp_exempt
+@server_timing
+def probe(request):
+    # what is at a point: the nearest grid, its management attributes and its likeliest species
+    try:
+        latitude = float(request.GET["lat"])
+        longitude = float(request.GET["lon"])
+        limit = int(request.GET.get("n", PROBE_SPECIES))
+        maxDistance = float(request.GET["max_distance"]) if request.GET.get("max_distance") else None
+    except (KeyError, ValueError):
+        return JsonResponse({"error": "lat and lon must be numbers, n an integer and max_distance metres"}, status=400)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or limit < 1:
+        return JsonResponse({"error": "lat/lon out of range or n below 1"}, status=400)
+
+    # the KD-tree is built once per data version
+    with stage("grid_index"):
+        index = grid_index()
+    with stage("lookup"):
+        found = index.nearest(latitude, longitude)
+    if found is None or (maxDistance is not None and found[1] > maxDistance):
+        return JsonResponse({"lat": latitude, "lon": longitude, "error": "No grid near this point"}, status=404)
+    grid, distance = found
+
+    with stage("species"):
+        species = top_species(grid["id"], min(limit, PROBE_MAX_SPECIES))
+    return JsonResponse({
+        "lat": latitude,
+        "lon": longitude,
+        "grid": dict(grid, distance_m=round(distance, 1)),
+        "species": species,
+    })
 
-            # add value to the current row
-            row.append(value)
 
-        # write the current row to the csv
-        writer.writerow(row)
+@csp_exempt
+@server_timing
+@condition(etag_func=queryEtag, last_modified_func=queryModified)
+def query(request, modelName):
+    # get the db model/table we want, otherwise return an error
+    modelChoice = EXPORT_MODELS.get(modelName)
+    if modelChoice is None:
+        return HttpResponseNotFound("<h1>Error: Model Not Found!</h1>")
 
-    # return the http response, download the csv
-    return response
+    # build the filtered, streamed export
+    try:
+        contentType, extension, chunks = exportStream(modelChoice, request.GET)
+    except ExportError as e:
+        return HttpResponseBadRequest(f"<h1>Error: {e}</h1>")
+
+    # stream the rows out as they are read, download the file
+    filename = f"{modelName.lower()}_data.{extension}"
+    return StreamingHttpResponse(
+        chunks,
+        content_type=contentType,
+        # revalidated on every download, a 304 while the data version is unchanged
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "private, no-cache"},
+    )
 
 
 @csp_exempt
@@ -180,47 +463,37 @@ def instructions(request):
 #             Query to csv functions                #
 #####################################################
 
-# takes in list of bird species ids, creates and returns CSV file with specified results
-def getCSV(birdList):
-    # Create the csv file name
-    filename = "bird_data.csv"
-
-    # creates and opens new csv file
-    with open(filename, 'w', newline='') as csvOutput:
-        # start a csv writer
-        writer = csv.writer(csvOutput)
-
-        # get relevant rows
-        outputResults = Results.objects.filter(bird_speciesID__speciesID__in=birdList)
-
-        # get the fields and write them to the csv
-        fields = ["grid_OID", "species", "birdcode", "lbci", "posterior_median", "ubci"]
-        writer.writerow(fields)
-
-        # print all the lines in the results table to the csv
-        for entry in outputResults:
-            # variable for holding current row
-            row = []
-
-            # get grid OID
-            gridID = getattr(entry.gridID, "id")
-            gridObject = Grid.objects.get(id=gridID)
-            # add grid_OID to the current row
-            row.append(gridObject.OID)    
-            
-            # get species name and birdcode
-            speciesID = getattr(entry.bird_speciesID, "id")
-            speciesObject = Species.objects.get(id=speciesID)
-            # add species name and birdcode to the current row
-            row.append(speciesObject.species)
-            row.append(speciesObject.birdcode)
-
-            # add lbci, posterior median, and ubci to current row
-            row.append(entry.lbci)
-            row.append(entry.posterior_median)
-            row.append(entry.ubci)
-
-            # write the current row to the csv
-            writer.writerow(row)
+# columns of a selection export
+SELECTION_FIELDS = ["grid_OID", "species", "birdcode", "lbci", "posterior_median", "ubci"]
+
+
+# takes in list of bird species ids (None for every species), returns an iterator over the export rows
+def selectionRows(birdList, chunkSize=2000):
+    # one joined query, streamed from the database in chunks
+    outputResults = Results.objects.all()
+    if birdList is not None:
+        outputResults = outputResults.filter(bird_speciesID__speciesID__in=birdList)
+
+    return outputResults.values_list(
+        "gridID__OID", "bird_speciesID__species", "bird_speciesID__birdcode", "lbci", "posterior_median", "ubci"
+    ).iterator(chunk_size=chunkSize)
+
+
+# takes in list of bird species ids and an open text file, writes the CSV of specified results to it
+def getCSV(birdList, csvOutput):
+    # start a csv writer
+    writer = csv.writer(csvOutput)
+
+    # write the header and every row of the selection
+    writer.writerow(SELECTION_FIELDS)
+    writer.writerows(selectionRows(birdList))
 
     return csvOutput
+
+
+# takes in list of bird species ids, yields the CSV of specified results line by line
+def streamCSV(birdList):
+    writer = csv.writer(Echo())
+    yield writer.writerow(SELECTION_FIELDS)
+    for row in selectionRows(birdList):
+        yield writer.writerow(row)
@@ -12,5 +12,8 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+# serve the heavy views from a bounded thread pool instead of Django's single sync thread
+# (FIREFLIGHT_VIEW_WORKERS sets its size)
+os.environ.setdefault('FIREFLIGHT_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()